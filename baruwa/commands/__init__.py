@@ -21,7 +21,9 @@ import os
 import pwd
 import grp
 import sys
+import time
 import hashlib
+import threading
 import warnings
 
 import pytz
@@ -42,12 +44,13 @@ from baruwa.lib.regex import EMAIL_RE
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 
-def get_mako_lookup(tmpldir, cache_dir):
+def get_mako_lookup(tmpldir, cache_dir, filesystem_checks=True):
     """Get Mako lookup"""
     mako_lookup = TemplateLookup(
                     directories=[tmpldir],
                     error_handler=handle_mako_error,
                     module_directory=cache_dir,
+                    filesystem_checks=filesystem_checks,
                     input_encoding='utf-8',
                     default_filters=['escape'],
                     output_encoding='utf-8',
@@ -56,6 +59,102 @@ def get_mako_lookup(tmpldir, cache_dir):
     return mako_lookup
 
 
+class TemplateRegistry(object):
+    """Process wide registry of the theme template lookups and
+    translators used by the reporting commands
+
+    Themes do not change during a run so a single lookup is kept per
+    theme, without filesystem checks, and the templates are compiled
+    once at startup before the render workers are forked."""
+    def __init__(self):
+        "init"
+        self.lookups = {}
+        self.translators = {}
+        self.themes = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, tmpldir, cache_dir):
+        "Return the lookup of a theme"
+        key = (tmpldir, cache_dir)
+        if key not in self.lookups:
+            self.lookups[key] = get_mako_lookup(tmpldir, cache_dir, False)
+        return self.lookups[key]
+
+    def translator(self, lang, pkgname, localedir):
+        "Return the translator of a language"
+        key = (lang, pkgname, localedir)
+        if key not in self.translators:
+            self.translators[key] = set_lang(lang, pkgname, localedir)
+        return self.translators[key]
+
+    def theme_dirs(self, domains, themebase, cache_base):
+        "Return the theme directories of the domains"
+        key = (tuple([(domain.name, domain.status) for domain in domains]),
+                themebase, cache_base)
+        if key not in self.themes:
+            self.themes[key] = get_theme_dirs(domains, themebase,
+                                            cache_base)
+        return self.themes[key]
+
+    def precompile(self, tmpldir, cache_dir, names):
+        "Compile the templates of a theme that exist"
+        for name in names:
+            if os.path.exists(os.path.join(tmpldir, name.lstrip('/'))):
+                self.lookup(tmpldir, cache_dir).get_template(name)
+
+    def precompile_themes(self, themebase, cache_base, names):
+        "Compile the templates of all the installed themes"
+        templates = os.path.join(themebase, 'templates')
+        if not os.path.isdir(templates):
+            return
+        for theme in os.listdir(templates):
+            tmpldir = os.path.join(templates, theme)
+            if os.path.isdir(tmpldir):
+                self.precompile(tmpldir,
+                                os.path.join(cache_base, 'templates', theme),
+                                names)
+
+    def render(self, tmpldir, cache_dir, names, kwargs):
+        """Render templates with the same arguments, returns the
+        outputs and the (template, seconds) render timings"""
+        mako_lookup = self.lookup(tmpldir, cache_dir)
+        outputs = []
+        timings = []
+        for name in names:
+            start = time.time()
+            outputs.append(mako_lookup.get_template(name).render(**kwargs))
+            timings.append((os.path.join(tmpldir, name.lstrip('/')),
+                            time.time() - start))
+        return outputs, timings
+
+    def record(self, timings):
+        "Add render timings to the run statistics"
+        with self.lock:
+            for name, elapsed in timings:
+                stats = self.stats.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+
+    def report(self):
+        "Return the run statistics, one line per template"
+        with self.lock:
+            return ['%s: %d renders, %.1fms avg, %.1fms max' % (
+                    name, stats[0], stats[1] * 1000 / stats[0],
+                    stats[2] * 1000)
+                    for name, stats in sorted(self.stats.items())]
+
+
+TEMPLATES = TemplateRegistry()
+
+
+def render_templates(tmpldir, cache_dir, names, kwargs):
+    """Render templates with the same arguments, used by the report
+    render workers which inherit the registry of the command"""
+    return TEMPLATES.render(tmpldir, cache_dir, names, kwargs)
+
+
 def change_user(user, group):
     """Switch to the baruwa user"""
     try:
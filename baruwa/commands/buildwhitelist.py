@@ -19,15 +19,12 @@
 "Email a list of top spammers"
 
 import sys
-import datetime
 
-import arrow
-
-from sqlalchemy.sql import text
 from marrow.mailer import Message as Msg, Mailer
 from marrow.mailer.exc import TransportFailedException, MessageFailedException
 
 from baruwa.model.meta import Session
+from baruwa.lib.clientips import top_clientips, period_start, ClientIpWriter
 from baruwa.commands import BaseCommand, check_email, \
     get_conf_options, check_period
 
@@ -67,44 +64,52 @@ class BuildWhiteList(BaseCommand):
         default='daily',
         action='callback',
         callback=check_period,)
+    BaseCommand.parser.add_option('-o', '--output',
+        help='Also write the client IPs to this file',
+        dest='output',
+        type='str',
+        default=None,)
+    BaseCommand.parser.add_option('-f', '--output-format',
+        help='Output file format [list, cdb]',
+        dest='output_format',
+        type='choice',
+        choices=['list', 'cdb'],
+        default='list',)
     summary = 'Generates a list of top ham senders for whitelisting'
     group_name = 'baruwa'
 
     def command(self):
         "command"
         self.init()
-        if self.options.email is None:
-            print "\nA valid email is required\n"
+        if self.options.email is None and not (self.options.output or
+                                            self.options.dry_run):
+            print "\nA valid email or output file is required\n"
             print self.parser.print_help()
             sys.exit(2)
 
-        starttime = arrow.utcnow()
-
-        if self.options.report_period == 'daily':
-            endtime = starttime - datetime.timedelta(days=1)
-        elif self.options.report_period == 'weekly':
-            endtime = starttime - datetime.timedelta(weeks=1)
-        else:
-            endtime = starttime - datetime.timedelta(weeks=4)
-
-        params = dict(spamscore=self.options.spamscore, num=self.options.num,
-                    starttime=starttime.datetime, endtime=endtime.datetime)
-
-        sql = text("""SELECT clientip, COUNT(clientip) a
-                    FROM messages WHERE sascore <= :spamscore
-                    AND (timestamp BETWEEN :endtime AND :starttime)
-                    GROUP BY clientip HAVING COUNT(clientip) >= :num
-                    ORDER BY a DESC;""")
-        results = Session.execute(sql, params=params)
-        if results.rowcount:
+        startdate = period_start(self.options.report_period)
+        results = top_clientips(Session, startdate, self.options.spamscore,
+                                self.options.num, False)
+        writer = None
+        if self.options.output:
+            writer = ClientIpWriter(self.options.output,
+                                    self.options.output_format,
+                                    self.options.include_count)
+        records = []
+        for clientip, count in results:
             if self.options.include_count is False:
-                records = [result.clientip for result in results]
+                records.append(clientip)
             else:
-                records = ["%s\t%d" % tuple(result) for result in results]
+                records.append("%s\t%d" % (clientip, count))
+            if writer is not None:
+                writer.add(clientip, count)
+        if writer is not None:
+            writer.finish()
+        if records:
             content = "\n".join(records)
             if self.options.dry_run is True:
                 print content
-            else:
+            elif self.options.email is not None:
                 mailer = Mailer(get_conf_options(self.conf))
                 mailer.start()
                 email = Msg(author=self.conf['baruwa.reports.sender'],
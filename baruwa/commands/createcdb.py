@@ -20,7 +20,7 @@
 import os
 
 
-from baruwa.tasks.settings import create_ms_settings
+from baruwa.tasks.settings import create_ms_settings, create_compiled_lists
 from baruwa.commands import BaseCommand, change_user
 from baruwa.tasks.mta import create_relay_domains, create_relay_hosts, \
     create_relay_proto_domains, create_ldap_domains,\
@@ -52,6 +52,8 @@ class CreateCDBCommand(BaseCommand):
         create_callback_domains()
         create_domain_lists(1)
         create_domain_lists(2)
+        create_compiled_lists(1)
+        create_compiled_lists(2)
         create_route_data()
         create_auth_data()
         create_smtp(1)
@@ -30,27 +30,27 @@ from base64 import b64encode
 from optparse import OptionValueError
 
 from sqlalchemy import desc, func
-from marrow.mailer import Message as Msg, Mailer
+from marrow.mailer import Message as Msg
 from sqlalchemy.sql.expression import case, and_, or_, between, true
-from marrow.mailer.exc import TransportFailedException, MessageFailedException
 
-from baruwa.lib.misc import REPORTS
 from baruwa.lib.query import UserFilter
 from baruwa.model.meta import Session
 from baruwa.model.domains import Domain
-from baruwa.lib.graphs import PDFReport
+from baruwa.lib.render import draw_pdf, to_rows
+from baruwa.lib.delivery import Checkpoint, ReportPipeline
 from baruwa.lib.query import ReportQuery
 from baruwa.lib.dates import make_tz
+from baruwa.lib.batchreports import BatchReports, domain_scope, user_scope
 from baruwa.model.messages import Message
 from baruwa.model.accounts import User, domain_users
 from baruwa.model.accounts import domain_owners as dom_owns
 from baruwa.lib.cache import acquire_lock, release_lock_after
-from baruwa.commands import BaseCommand, set_lang, change_user, \
-    get_conf_options, workout_path, get_theme_dirs, check_period, \
-    get_mako_lookup
+from baruwa.commands import BaseCommand, change_user, workout_path, \
+    check_period, TEMPLATES
 
 
 PKGNAME = 'baruwa'
+REPORT_TEMPLATES = ['/email/pdfreports.txt']
 REPORTS_MAP = dict(monthly=3, weekly=2, daily=1)
 
 
@@ -155,37 +155,6 @@ def message_totals_report(model, num_of_days, tmz):
     return data
 
 
-def domain_pie_query(domain, reportid, num_of_days=0):
-    "Run domain query"
-    queryfield = getattr(Message, REPORTS[reportid]['address'])
-    orderby = REPORTS[reportid]['sort']
-    query = Session.query(queryfield.label('address'),
-                        func.count(queryfield).label('count'),
-                        func.sum(Message.size).label('size'))
-    if reportid == '10':
-        query = query.filter(queryfield != u'127.0.0.1')\
-                        .group_by(queryfield)\
-                        .order_by(desc(orderby))
-    else:
-        query = query.filter(queryfield != u'')\
-                        .group_by(queryfield)\
-                        .order_by(desc(orderby))
-    if reportid in ['5', '6', '7', '8']:
-        query = query.filter(Message.to_domain == domain)
-    else:
-        query = query.filter(func._(or_(Message.from_domain == domain,
-                                        Message.to_domain == domain)))
-    if int(num_of_days) > 0:
-        numofdays = datetime.timedelta(days=num_of_days)
-        current_time = arrow.utcnow()
-        startdate = current_time - numofdays
-        query = query.filter(between(Message.timestamp,
-                                    startdate.datetime,
-                                    current_time.datetime))
-    data = query[:10]
-    return data
-
-
 class SendPdfReports(BaseCommand):
     "Sends PDF reports"
     BaseCommand.parser.add_option('-t', '--report-type',
@@ -228,50 +197,63 @@ class SendPdfReports(BaseCommand):
     def _set_theme(self, domains):
         "Setup theme for user or for domain"
         # theme support
-        tmpldir, assetdir, cache_dir = get_theme_dirs(domains,
+        tmpldir, assetdir, cache_dir = TEMPLATES.theme_dirs(domains,
                                             self.themebase,
                                             self.conf['cache_dir'])
         if tmpldir is None or assetdir is None:
-            mako_lookup = self.mako_lookup
+            tmpldir, cache_dir = self.tmpldir, self.cache_dir
             logo = self.logo
         else:
-            mako_lookup = get_mako_lookup(tmpldir, cache_dir)
             logo = os.path.join(assetdir, 'imgs', 'logo.png')
             if not os.path.exists(logo):
                 logo = self.logo
 
-        return mako_lookup, logo
-
-    def _send_domain_report(self, pdf_file, host_url, admin, domain):
-        "Send a domain report"
-        if pdf_file:
-            mako_lookup, _ = self._set_theme([domain])
-            _ = self.translator.ugettext
-            template = mako_lookup.get_template('/email/pdfreports.txt')
-            text = template.render(user=admin, url=host_url, config=self.conf)
-            displayname = '%s %s' % (admin.firstname or '',
-                                    admin.lastname or '')
-            pname = dict(name=self.conf.get('baruwa.custom.name', 'Baruwa'),
-                        domain=domain.name)
-            productname = _('%(name)s Reports') % pname
-            subject = _('%(name)s: %(domain)s Usage Report') % pname
-            email = Msg(author=[(productname, self.send_from)],
-                            to=[(displayname, admin.email)],
-                            subject=subject)
-            email.plain = text
-            reportname = self.conf.get('baruwa.custom.name', 'baruwa')\
-                            .replace(' ', '-').lower()
-            email.attach('%s-%s-reports.pdf' % (reportname, domain.name),
-                        data=pdf_file,
-                        maintype='application',
-                        subtype='pdf')
-            try:
-                self.mailer.send(email)
-            except (TransportFailedException, MessageFailedException), err:
-                print >> sys.stderr, ("Error sending to: %s, Error: %s" %
-                        (admin.email, err))
+        return tmpldir, cache_dir, logo
+
+    def _render_text(self, tmpldir, cache_dir, **kwargs):
+        "Render the text part of a report email"
+        (text,), timings = TEMPLATES.render(tmpldir, cache_dir,
+                                            REPORT_TEMPLATES, kwargs)
+        TEMPLATES.record(timings)
+        return text
 
-    def _process_domain_report(self, domain):
+    def _send_domain_report(self, sections, logo, title, host_url, admins,
+                            domain):
+        "Queue a domain report for the domain admins"
+        tmpldir, cache_dir, _ = self._set_theme([domain])
+        _ = self.translator.ugettext
+        names = dict(name=self.conf.get('baruwa.custom.name', 'Baruwa'),
+                    domain=domain.name)
+        productname = _('%(name)s Reports') % names
+        subject = _('%(name)s: %(domain)s Usage Report') % names
+        reportname = self.conf.get('baruwa.custom.name', 'baruwa')\
+                        .replace(' ', '-').lower()
+        filename = '%s-%s-reports.pdf' % (reportname, domain.name)
+        recipients = [('domain:%s:%s' % (domain.id, admin.id),
+                    '%s %s' % (admin.firstname or '', admin.lastname or ''),
+                    admin.email,
+                    self._render_text(tmpldir, cache_dir, user=admin,
+                                    url=host_url, config=self.conf))
+                    for admin in admins]
+
+        def build(pdfdata):
+            "Build the report emails"
+            pdf_file = b64encode(pdfdata)
+            emails = []
+            for key, displayname, address, text in recipients:
+                email = Msg(author=[(productname, self.send_from)],
+                                to=[(displayname, address)],
+                                subject=subject)
+                email.plain = text
+                email.attach(filename,
+                            data=pdf_file,
+                            maintype='application',
+                            subtype='pdf')
+                emails.append((key, email))
+            return emails
+        self.pipeline.submit(draw_pdf, (logo, title, sections), build)
+
+    def _process_domain_report(self, domain, scope, admins):
         "Process domain report"
         sentry = 0
         # theme support
@@ -307,30 +289,25 @@ class SendPdfReports(BaseCommand):
                         volume=_('Mail volume'), totals=_('Totals'))
         pname = _('%s Mail Report') % \
                 self.conf.get('baruwa.custom.name', 'Baruwa')
-        pdfcreator = PDFReport(logo, pname)
+        sections = []
         for reportid in ['1', '2', '3', '4', '5', '6', '7', '8', '10']:
             sortby = reports[reportid]['sort']
-            data = domain_pie_query(domain.name, reportid, self.num_of_days)
+            data = self.batch.top(scope, reportid)
             if data:
                 sentry += 1
-                pdfcreator.add(data, reports[reportid]['title'],
-                                pieheadings, sortby)
-        data = message_totals_report(domain,
-                                    self.num_of_days,
-                                    domain.timezone)
+                sections.append((data, reports[reportid]['title'],
+                                pieheadings, sortby, 'pie'))
+        data = self.batch.totals(scope, domain.timezone)
         if data:
             if not sentry:
                 sentry += 1
-            pdfcreator.add(data,
-                            _('Message Totals'),
-                            totalsheaders,
-                            chart='bar')
+            sections.append((data, _('Message Totals'), totalsheaders,
+                            None, 'bar'))
         if sentry:
-            pdf_file = b64encode(pdfcreator.build())
-            return pdf_file
-        return None
+            self._send_domain_report(sections, logo, pname, domain.site_url,
+                                    admins, domain)
 
-    def _process_user_report(self, user):
+    def _process_user_report(self, user, scope):
         "Process user report"
         sentry = 0
         language = self.language
@@ -352,9 +329,9 @@ class SendPdfReports(BaseCommand):
                     break
 
         # theme support
-        mako_lookup, logo = self._set_theme(user.domains)
+        tmpldir, cache_dir, logo = self._set_theme(user.domains)
 
-        translator = set_lang(language, PKGNAME, self.localedir)
+        translator = TEMPLATES.translator(language, PKGNAME, self.localedir)
         _ = translator.ugettext
         reports = {
                     '1': {'address': 'from_address', 'sort': 'count',
@@ -385,49 +362,55 @@ class SendPdfReports(BaseCommand):
                         volume=_('Mail volume'), totals=_('Totals'))
         pname = _('%s Usage Report') % self.conf.get('baruwa.custom.name',
                                                     'Baruwa')
-        pdfcreator = PDFReport(logo, pname)
+        sections = []
         for reportid in ['1', '2', '3', '4', '5', '6', '7', '8', '10']:
             sortby = reports[reportid]['sort']
             if user.account_type == 3 and reportid in ['7', '8']:
                 data = None
+            elif scope is not None:
+                data = self.batch.top(scope, reportid)
             else:
-                data = pie_report_query(user, reportid, self.num_of_days)
+                data = to_rows(pie_report_query(user, reportid,
+                                                self.num_of_days))
             if data:
                 sentry += 1
-                pdfcreator.add(data, reports[reportid]['title'],
-                            pieheadings, sortby)
-        data = message_totals_report(user, self.num_of_days, timezone)
+                sections.append((data, reports[reportid]['title'],
+                                pieheadings, sortby, 'pie'))
+        if scope is not None:
+            data = self.batch.totals(scope, timezone)
+        else:
+            data = to_rows(message_totals_report(user, self.num_of_days,
+                                                timezone))
         if data:
             if not sentry:
                 sentry += 1
-            pdfcreator.add(data,
-                            _('Message Totals'),
-                            totalsheaders,
-                            chart='bar')
+            sections.append((data, _('Message Totals'), totalsheaders,
+                            None, 'bar'))
         if sentry:
-            pdf_file = b64encode(pdfcreator.build())
-            template = mako_lookup.get_template('/email/pdfreports.txt')
-            text = template.render(user=user, url=host_url, config=self.conf)
+            text = self._render_text(tmpldir, cache_dir, user=user,
+                                    url=host_url, config=self.conf)
             displayname = '%s %s' % (user.firstname or '', user.lastname or '')
-            pname = dict(name=self.conf.get('baruwa.custom.name', 'Baruwa'),
+            key = 'user:%s' % user.id
+            address = user.email
+            pdfname = dict(name=self.conf.get('baruwa.custom.name', 'Baruwa'),
                         email=user.email)
-            productname = _('%(name)s Reports') % pname
-            subject = _('%(name)s: %(email)s Usage Report') % pname
-            email = Msg(author=[(productname, self.send_from)],
-                            to=[(displayname, user.email)],
-                            subject=subject)
-            email.plain = text
+            productname = _('%(name)s Reports') % pdfname
+            subject = _('%(name)s: %(email)s Usage Report') % pdfname
             reportname = self.conf.get('baruwa.custom.name', 'baruwa')\
                             .replace(' ', '-').lower()
-            email.attach('%s-reports.pdf' % reportname,
-                        data=pdf_file,
-                        maintype='application',
-                        subtype='pdf')
-            try:
-                self.mailer.send(email)
-            except (TransportFailedException, MessageFailedException), err:
-                print >> sys.stderr, ("Error sending to: %s, Error: %s" %
-                        (user.email, err))
+
+            def build(pdfdata):
+                "Build the report email"
+                email = Msg(author=[(productname, self.send_from)],
+                                to=[(displayname, address)],
+                                subject=subject)
+                email.plain = text
+                email.attach('%s-reports.pdf' % reportname,
+                            data=b64encode(pdfdata),
+                            maintype='application',
+                            subtype='pdf')
+                return [(key, email)]
+            self.pipeline.submit(draw_pdf, (logo, pname, sections), build)
 
     def _process_domains(self):
         "process domains"
@@ -436,6 +419,7 @@ class SendPdfReports(BaseCommand):
                             self.options.exclude_org,
                             period)
 
+        scheduled = []
         for domain in domains:
             domain_time = arrow.now(domain.timezone)
             if domain_time.hour != self.send_at:
@@ -447,24 +431,30 @@ class SendPdfReports(BaseCommand):
                             % domain.name
                     continue
             admins = set()
-            self.translator = set_lang(domain.language,
-                                        PKGNAME,
-                                        self.localedir)
             for org in domain.organizations:
                 if (self.options.exclude_org and
                     self.options.exclude_org == org.id):
                     continue
                 for admin in org.admins:
-                    admins.add(admin)
-            pdf_file = self._process_domain_report(domain)
-            for admin in admins:
-                self._send_domain_report(pdf_file,
-                    domain.site_url, admin, domain)
+                    if ('domain:%s:%s' % (domain.id, admin.id)
+                        not in self.checkpoint):
+                        admins.add(admin)
+            if admins:
+                scheduled.append((domain, domain_scope(domain), admins))
+        self.batch = BatchReports(Session, self.num_of_days)
+        for _, scope, _ in scheduled:
+            self.batch.add(scope)
+        for domain, scope, admins in scheduled:
+            self.translator = TEMPLATES.translator(domain.language,
+                                                PKGNAME,
+                                                self.localedir)
+            self._process_domain_report(domain, scope, admins)
 
     def _process_users(self):
         """Process users"""
         users = get_users(self.options.org_id,
                     self.options.exclude_org)
+        scheduled = []
         for user in users:
             user_time = arrow.now(user.timezone)
             if user_time.hour != self.send_at:
@@ -475,7 +465,15 @@ class SendPdfReports(BaseCommand):
                     print "Skipped %s not scheduled for this time" \
                             % user.username
                     continue
-            self._process_user_report(user)
+            if 'user:%s' % user.id in self.checkpoint:
+                continue
+            scheduled.append((user, user_scope(Session, user)))
+        self.batch = BatchReports(Session, self.num_of_days)
+        for _, scope in scheduled:
+            if scope is not None:
+                self.batch.add(scope)
+        for user, scope in scheduled:
+            self._process_user_report(user, scope)
 
     def command(self):
         "run command"
@@ -518,14 +516,39 @@ class SendPdfReports(BaseCommand):
                                 'templates')
 
                 self.localedir = os.path.join(base, 'baruwa', 'i18n')
-                self.mako_lookup = get_mako_lookup(path, cache_dir)
-                self.mailer = Mailer(get_conf_options(self.conf))
-                self.mailer.start()
-                if self.options.report_type == 'user':
-                    self._process_users()
-                else:
-                    self._process_domains()
-                self.mailer.stop()
+                self.tmpldir = path
+                self.cache_dir = cache_dir
+                TEMPLATES.precompile(path, cache_dir, REPORT_TEMPLATES)
+                TEMPLATES.precompile_themes(self.themebase,
+                                            self.conf['cache_dir'],
+                                            REPORT_TEMPLATES)
+                runid = '%s-%s-%s-%s-%s' % (self.options.report_type,
+                                        self.options.report_period,
+                                        self.options.org_id,
+                                        self.options.exclude_org,
+                                        arrow.utcnow().format('YYYYMMDDHH'))
+                self.checkpoint = Checkpoint(
+                                    os.path.join(self.conf['cache_dir'],
+                                    'reports', 'pdfreportsng.checkpoint'),
+                                    runid)
+                self.pipeline = ReportPipeline(self.conf, self.checkpoint)
+                self.pipeline.start()
+                complete = False
+                try:
+                    if self.options.report_type == 'user':
+                        self._process_users()
+                    else:
+                        self._process_domains()
+                    complete = self.pipeline.close()
+                finally:
+                    # record the deliveries completed before an
+                    # interruption so a resumed run skips them
+                    try:
+                        self.pipeline.drain()
+                    finally:
+                        self.checkpoint.close(complete)
+                for line in TEMPLATES.report():
+                    print line
             finally:
                 Session.close()
                 # time.sleep(300)
@@ -26,23 +26,40 @@ import datetime
 
 import arrow
 
-from babel.util import UTC
-from sqlalchemy import desc
+from sqlalchemy import desc, func
 from routes.util import url_for
-from marrow.mailer import Message as Msg, Mailer
+from marrow.mailer import Message as Msg
 from sqlalchemy.sql.expression import case, and_, or_, between, true
-from marrow.mailer.exc import TransportFailedException, MessageFailedException
 
 from baruwa.lib.dates import make_tz
 from baruwa.model.meta import Session
 from baruwa.lib.query import UserFilter
+from baruwa.lib.render import to_rows
+from baruwa.lib.delivery import Checkpoint, ReportPipeline
+from baruwa.model.reports import ReportWatermark
 from baruwa.model.messages import Message, Release
 from baruwa.model.accounts import User, domain_users
 from baruwa.model.accounts import domain_owners as dom_owns
 from baruwa.lib.cache import acquire_lock, release_lock_after
 from baruwa.model.accounts import organizations_admins as oas
-from baruwa.commands import BaseCommand, set_lang, get_conf_options, \
-    gen_uuid, workout_path, get_theme_dirs, change_user, get_mako_lookup
+from baruwa.commands import BaseCommand, gen_uuid, workout_path, \
+    change_user, render_templates, TEMPLATES
+
+WATERMARK_REPORT = u'quarantine'
+REPORT_TEMPLATES = ['/email/quarantine.html', '/email/quarantine.txt']
+# Seconds below the watermark that are scanned again, scanner nodes
+# that lag behind insert messages with timestamps older than the ones
+# already reported. The messages of the margin that were reported to
+# peleb users are excluded by their release records, other users may
+# see them in two reports.
+SETTLE_TIME = 900
+
+
+def before(timestamp, messageid):
+    "Messages older than the (timestamp, id) position"
+    return func._(or_(Message.timestamp < timestamp,
+                    and_(Message.timestamp == timestamp,
+                        Message.id < messageid)))
 
 
 class QuarantineReports(BaseCommand):
@@ -75,8 +92,9 @@ class QuarantineReports(BaseCommand):
     summary = """Send quarantine reports"""
     group_name = 'baruwa'
 
-    def _send_msg(self, user, messages):
-        "Send email report"
+    def _send_msg(self, user, messages, watermark, complete=True):
+        """Queue the email report, complete is False when the report
+        was cut off at max_msgs"""
         lang = 'en'
         host_urls = dict([(domain.name, domain.site_url)
                     for domain in user.domains
@@ -85,66 +103,85 @@ class QuarantineReports(BaseCommand):
                 if domain.language != 'en']
         if langs:
             lang = langs.pop(0)
-        translator = set_lang(lang, 'baruwa', self.localedir)
+        translator = TEMPLATES.translator(lang, 'baruwa', self.localedir)
         _ = translator.ugettext
-        tmpldir, assetdir, cache_dir = get_theme_dirs(user.domains,
+        tmpldir, assetdir, cache_dir = TEMPLATES.theme_dirs(user.domains,
                                             self.themebase,
                                             self.conf['cache_dir'])
+        messages = to_rows(messages)
 
         def make_release_records(spam):
             "map function"
             uuid = gen_uuid(user)
             spam.uuid = uuid
             return Release(uuid=uuid, messageid=spam.id)
+        torelease = []
         if user.is_peleb:
             torelease = [make_release_records(spam)
                         for spam in messages]
         if tmpldir is None or assetdir is None:
-            mako_lookup = self.mako_lookup
+            tmpldir, cache_dir = self.tmpldir, self.cache_dir
             logo = self.logo
         else:
-            mako_lookup = get_mako_lookup(tmpldir, cache_dir)
             logo = os.path.join(assetdir, 'imgs', 'logo.png')
             if os.path.exists(logo):
                 with open(logo) as handle:
                     logo = base64.b64encode(handle.read())
             else:
                 logo = self.logo
-        template = mako_lookup.get_template('/email/quarantine.html')
-        html = template.render(messages=messages,
-                        host_urls=host_urls,
-                        url=url_for,
-                        config=self.conf,
-                        tzinfo=make_tz(user.timezone or UTC),
-                        userid=user.id)
-        template = mako_lookup.get_template('/email/quarantine.txt')
-        text = template.render(messages=messages,
-                            config=self.conf,
-                            tzinfo=make_tz(user.timezone or UTC))
+        kwargs = dict(messages=messages,
+                    host_urls=host_urls,
+                    url=url_for,
+                    config=dict(self.conf),
+                    tzinfo=make_tz(user.timezone or 'UTC'),
+                    userid=user.id)
         displayname = "%s %s" % (user.firstname or '', user.lastname or '')
+        address = user.email
+        key = 'user:%s' % user.id
         pname = dict(name=self.conf.get('baruwa.custom.name', 'Baruwa'))
         productname = _('%(name)s Reports') % pname
         subject = _('%(name)s Quarantine Report') % pname
-        email = Msg(author=[(productname,
-                        self.conf['baruwa.reports.sender'])],
-                        to=[(displayname, user.email)],
-                        subject=subject)
-        email.plain = text
-        email.rich = html
-        email.attach('logo.png',
-                    data=logo,
-                    maintype='image',
-                    subtype='png',
-                    inline=True)
 
-        try:
-            self.mailer.send(email)
-            if 'torelease' in locals():
-                Session.add_all(torelease)
-                Session.commit()
-        except (TransportFailedException, MessageFailedException), err:
-            print >> sys.stderr, ("Error sending to: %s, Error: %s" %
-                    (user.email, err))
+        def build(rendered):
+            "Build the report email"
+            (html, text), timings = rendered
+            TEMPLATES.record(timings)
+            email = Msg(author=[(productname,
+                            self.conf['baruwa.reports.sender'])],
+                            to=[(displayname, address)],
+                            subject=subject)
+            email.plain = text
+            email.rich = html
+            email.attach('logo.png',
+                        data=logo,
+                        maintype='image',
+                        subtype='png',
+                        inline=True)
+            return [(key, email)]
+
+        newest = messages[0]
+
+        def sent(key, success):
+            """Store the release links and advance the watermark once
+            the report is delivered. The watermark stays put when the
+            report was cut off so the older messages left out are
+            reported next time, the messages already reported are
+            then excluded by their release records"""
+            if not success:
+                return
+            if complete:
+                mark = watermark
+                if mark is None:
+                    mark = ReportWatermark(user.id, WATERMARK_REPORT)
+                    self.watermarks[user.id] = mark
+                mark.timestamp = newest.timestamp
+                mark.messageid = newest.id
+                Session.add(mark)
+            Session.add_all(torelease)
+            Session.commit()
+        self.pipeline.submit(render_templates,
+                            (tmpldir, cache_dir, REPORT_TEMPLATES, kwargs),
+                            build, sent)
 
     def _process_report(self, user):
         "Process users quarantine report"
@@ -161,22 +198,48 @@ class QuarantineReports(BaseCommand):
                         .filter(or_(Message.spam > 0,
                                 Message.nameinfected > 0,
                                 Message.otherinfected > 0))\
-                        .order_by(desc('timestamp'))
+                        .order_by(desc(Message.timestamp), desc(Message.id))
         query = UserFilter(Session, user, messages)
         messages = query.filter()
-        if int(self.options.num_days) > 0:
-            a_day = datetime.timedelta(days=self.options.num_days)
-        else:
-            a_day = datetime.timedelta(days=1)
-        current_time = arrow.utcnow()
-        startdate = current_time - a_day
         messages = messages.filter(between(Message.timestamp,
-                                    startdate.datetime,
-                                    current_time.datetime))
-        messages = messages.filter(~Message.id.in_(self.previous_records))
-        messages = messages[:self.options.max_msgs]
-        if messages:
-            self._send_msg(user, messages)
+                                    self.startdate.datetime,
+                                    self.current_time.datetime))
+        watermark = self.watermarks.get(user.id)
+        if watermark is not None:
+            settled = watermark.timestamp - \
+                        datetime.timedelta(seconds=self.settle)
+            messages = messages.filter(Message.timestamp >= settled)
+        limit = self.options.max_msgs
+        found = []
+        complete = False
+        page = messages
+        while len(found) < limit:
+            rows = page[:limit]
+            found.extend([row for row in rows
+                        if row.id not in self.reported])
+            if len(rows) < limit:
+                complete = len(found) <= limit
+                break
+            page = messages.filter(before(rows[-1].timestamp,
+                                            rows[-1].id))
+        found = found[:limit]
+        if found:
+            self._send_msg(user, found, watermark, complete)
+
+    def _load_watermarks(self):
+        "Load the quarantine report watermarks"
+        self.watermarks = dict([(watermark.user_id, watermark)
+                                for watermark in
+                                Session.query(ReportWatermark)
+                                .filter(ReportWatermark.report ==
+                                        WATERMARK_REPORT)])
+
+    def _load_reported(self):
+        """Load the messages reported within the reporting window,
+        these predate the watermarks or were reported to other users"""
+        query = Session.query(Release.messageid)\
+                .filter(Release.timestamp >= self.startdate.datetime)
+        self.reported = set([row.messageid for row in query])
 
     def _get_exclude_users(self):
         """Get exclude org users"""
@@ -236,8 +299,6 @@ class QuarantineReports(BaseCommand):
                 send_at = int(self.conf.get('baruwa.send.reports.at', 07))
                 self.themebase = self.conf.get('baruwa.themes.base',
                                         '/usr/share/baruwa/themes')
-                self.mailer = Mailer(get_conf_options(self.conf))
-                self.mailer.start()
                 base = workout_path()
                 if os.path.exists(os.path.join(self.themebase, 'templates',
                         'default')):
@@ -254,7 +315,8 @@ class QuarantineReports(BaseCommand):
                     logo = os.path.join(base, 'baruwa', 'public',
                                         'imgs', 'logo.png')
                 self.localedir = os.path.join(base, 'baruwa', 'i18n')
-                self.mako_lookup = get_mako_lookup(path, cache_dir)
+                self.tmpldir = path
+                self.cache_dir = cache_dir
                 if not os.path.exists(logo):
                     print >> sys.stderr, "The logo image: %s does not exist" \
                             % logo
@@ -272,22 +334,60 @@ class QuarantineReports(BaseCommand):
                             .filter(User.active == true())\
                             .filter(User.send_report == true())
 
-                self.previous_records = Session\
-                                        .query(Release.messageid)\
-                                        .order_by(desc('timestamp'))
-                for user in users:
-                    # Timezone support
-                    user_time = arrow.now(user.timezone)
-                    if user_time.hour != send_at:
-                        if self.options.force_send:
-                            print "Force send used sending anyway to %s" % \
-                                    user.username
-                        else:
-                            print "Skipped %s not scheduled for this time" % \
-                                    user.username
+                if int(self.options.num_days) > 0:
+                    a_day = datetime.timedelta(days=self.options.num_days)
+                else:
+                    a_day = datetime.timedelta(days=1)
+                self.current_time = arrow.utcnow()
+                self.startdate = self.current_time - a_day
+                self.settle = int(self.conf.get(
+                                    'baruwa.reports.quarantine.settle',
+                                    SETTLE_TIME))
+                self._load_watermarks()
+                self._load_reported()
+                # compile the templates before the workers are forked
+                TEMPLATES.precompile(self.tmpldir, self.cache_dir,
+                                    REPORT_TEMPLATES)
+                TEMPLATES.precompile_themes(self.themebase,
+                                            self.conf['cache_dir'],
+                                            REPORT_TEMPLATES)
+                runid = '%s-%s-%s-%s' % (self.options.org_id,
+                                        self.options.exclude_org,
+                                        self.options.num_days,
+                                        arrow.utcnow().format('YYYYMMDDHH'))
+                self.checkpoint = Checkpoint(
+                                    os.path.join(self.conf['cache_dir'],
+                                    'reports',
+                                    'quarantinereportsng.checkpoint'),
+                                    runid)
+                self.pipeline = ReportPipeline(self.conf, self.checkpoint)
+                self.pipeline.start()
+                complete = False
+                try:
+                    for user in users:
+                        # Timezone support
+                        user_time = arrow.now(user.timezone)
+                        if user_time.hour != send_at:
+                            if self.options.force_send:
+                                print "Force send used sending anyway " \
+                                        "to %s" % user.username
+                            else:
+                                print "Skipped %s not scheduled for " \
+                                        "this time" % user.username
+                                continue
+                        if 'user:%s' % user.id in self.checkpoint:
                             continue
-                    self._process_report(user)
-                self.mailer.stop()
+                        self._process_report(user)
+                    complete = self.pipeline.close()
+                finally:
+                    # record the deliveries completed before an
+                    # interruption so a resumed run skips them
+                    try:
+                        self.pipeline.drain()
+                    finally:
+                        self.checkpoint.close(complete)
+                for line in TEMPLATES.report():
+                    print line
             finally:
                 Session.close()
                 # time.sleep(300)
@@ -21,21 +21,131 @@ import os
 import sys
 import codecs
 
-from sqlalchemy.orm.exc import NoResultFound, StaleDataError
+from sqlalchemy.sql import text
 
 from baruwa.model.messages import SARule
 from baruwa.model.meta import Session
 from baruwa.commands import BaseCommand
+from baruwa.lib.sarules import bump_rules_version
 from baruwa.lib.regex import RULE_DESCRIPTION_RE, SARULE_SCORE_RE
 
 
-def _get_rule(ruleid):
-    "Return rule"
+def parse_score(scores):
+    "Return the score to use from a score line"
+    if '#' in scores:
+        scores = scores.split('#')[0]
+    scores = scores.split()
+    if len(scores) == 4:
+        score = scores[3]
+    else:
+        score = scores[0]
     try:
-        rule = Session.query(SARule).get(ruleid)
-    except NoResultFound:
-        rule = None
-    return rule
+        return float(score)
+    except ValueError:
+        return None
+
+
+def parse_rules(directories):
+    """Parse the rule names, descriptions and scores from
+    all the rule files into memory"""
+    descriptions = {}
+    scores = {}
+    for directory in directories:
+        if not os.path.isdir(directory):
+            print >> sys.stderr, "Directory '%s' does not exist" % \
+                directory
+            continue
+        for (dirname, dirs, files) in os.walk(directory):
+            for saconf in files:
+                if not saconf.endswith('.cf'):
+                    continue
+                saconfpath = os.path.join(dirname, saconf)
+                with codecs.open(saconfpath, 'r', 'utf-8', 'replace') \
+                    as rulefile:
+                    for line in rulefile:
+                        match = RULE_DESCRIPTION_RE.match(line)
+                        if match:
+                            matchdict = match.groupdict()
+                            descriptions[matchdict['ruleid']] = \
+                                matchdict['description']
+                            continue
+                        match = SARULE_SCORE_RE.match(line)
+                        if match:
+                            matchdict = match.groupdict()
+                            score = parse_score(matchdict['scores'])
+                            if score is not None:
+                                scores[matchdict['ruleid']] = score
+    return descriptions, scores
+
+
+def diff_rules(descriptions, scores):
+    """Diff the parsed rules against the sarules table returning the
+    inserts and updates. Rules that are no longer found are kept, they
+    may carry local score overrides or a rule directory may have been
+    unreadable"""
+    existing = dict((rule.id, rule) for rule in
+                    Session.query(SARule.id, SARule.description,
+                                SARule.score))
+    inserts = []
+    updates = []
+    for ruleid, description in descriptions.iteritems():
+        score = scores.get(ruleid)
+        oldrule = existing.get(ruleid)
+        if oldrule is None:
+            if not ruleid.startswith('__'):
+                inserts.append(dict(id=ruleid,
+                                    description=description,
+                                    score=score or 0))
+            continue
+        if score is None:
+            score = oldrule.score
+        if oldrule.description != description or oldrule.score != score:
+            updates.append(dict(id=ruleid,
+                                description=description,
+                                score=score))
+    return inserts, updates
+
+
+def values_clause(rows, columns):
+    """Return a multi row VALUES clause and its bind parameters,
+    SQLAlchemy 0.7 can not compile multi row inserts itself"""
+    groups = []
+    params = {}
+    for index, row in enumerate(rows):
+        names = []
+        for column, cast in columns:
+            name = '%s_%d' % (column, index)
+            params[name] = row[column]
+            names.append('CAST(:%s AS %s)' % (name, cast))
+        groups.append('(%s)' % ', '.join(names))
+    return ', '.join(groups), params
+
+
+def apply_changes(inserts, updates, chunksize=500):
+    """Apply the changes in a single transaction, inserts and
+    updates are sent as one multi row statement per chunk"""
+    columns = [('id', 'VARCHAR'), ('description', 'TEXT'),
+                ('score', 'FLOAT')]
+    try:
+        for index in xrange(0, len(inserts), chunksize):
+            values, params = values_clause(
+                                inserts[index:index + chunksize], columns)
+            Session.execute(text("INSERT INTO sarules "
+                                "(id, description, score) VALUES %s" %
+                                values), params)
+        for index in xrange(0, len(updates), chunksize):
+            values, params = values_clause(
+                                updates[index:index + chunksize], columns)
+            Session.execute(text("UPDATE sarules SET "
+                                "description = v.description, "
+                                "score = v.score FROM (VALUES %s) "
+                                "AS v(id, description, score) "
+                                "WHERE sarules.id = v.id" % values),
+                                params)
+        Session.commit()
+    except:
+        Session.rollback()
+        raise
 
 
 class UpdateSaRules(BaseCommand):
@@ -48,65 +158,16 @@ class UpdateSaRules(BaseCommand):
         "run command"
         self.init()
 
-        def updatedb(line):
-            """Update or save the rule name and
-            description to the database"""
-            match = RULE_DESCRIPTION_RE.match(line)
-            if match:
-                matchdict = match.groupdict()
-                oldrule = _get_rule(matchdict['ruleid'])
-                if oldrule is None:
-                    if not matchdict['ruleid'].startswith('__'):
-                        rule = SARule(**matchdict)
-                        Session.add(rule)
-                        Session.commit()
-                else:
-                    if oldrule.description != matchdict['description']:
-                        oldrule.description = matchdict['description']
-                        Session.add(oldrule)
-                        Session.commit()
-
-        def processfile(thefile):
-            """Open the rules file and read in the rule
-            name and description"""
-            with open(thefile, 'r') as rulefile:
-                [updatedb(line) for line in rulefile.readlines()]
-
-        def updatescores(thefile):
-            """Update the rule scores in the database"""
-            with codecs.open(thefile, 'r', 'utf-8', 'replace') as rulefile:
-                for line in rulefile.readlines():
-                    match = SARULE_SCORE_RE.match(line)
-                    if match:
-                        matchdict = match.groupdict()
-                        rule = _get_rule(matchdict['ruleid'])
-                        if rule:
-                            if '#' in matchdict['scores']:
-                                tmp = matchdict['scores'].split('#')[0]
-                                scores = tmp.split()
-                            else:
-                                scores = matchdict['scores'].split()
-                            if len(scores) == 4:
-                                score = scores[3]
-                            else:
-                                score = scores[0]
-                            try:
-                                rule.score = score
-                                Session.add(rule)
-                                Session.commit()
-                            except StaleDataError:
-                                pass
-
-        for directory in self.conf['spamassassin.dirs'].split(','):
-            directory = directory.strip()
-            if not os.path.isdir(directory):
-                print >> sys.stderr, "Directory '%s' does not exist" % \
-                    directory
-                continue
-            for (dirname, dirs, files) in os.walk(directory):
-                for saconf in files:
-                    if saconf.endswith('.cf'):
-                        saconfpath = os.path.join(dirname, saconf)
-                        processfile(saconfpath)
-                        updatescores(saconfpath)
+        directories = [directory.strip() for directory in
+                        self.conf['spamassassin.dirs'].split(',')]
+        descriptions, scores = parse_rules(directories)
+        if not descriptions:
+            print >> sys.stderr, "No rule descriptions found, not updating"
+            Session.close()
+            sys.exit(2)
+        inserts, updates = diff_rules(descriptions, scores)
+        apply_changes(inserts, updates)
+        if inserts or updates:
+            bump_rules_version(self.conf)
+        print "Rules added: %d, updated: %d" % (len(inserts), len(updates))
         Session.close()
@@ -276,6 +276,9 @@ def make_map(config):
                 r'/archived/download/{msgid:\d+}/{attachment}',
                 action='preview',
                 archive=True)
+        submap.connect('messages-stream',
+                r'/stream/{token}',
+                action='stream')
         submap.connect('messages-preview-img',
                 r'/preview/{msgid:\d+}/{img}',
                 action='preview')
@@ -304,6 +307,9 @@ def make_map(config):
         submap.connect('messages-set-items',
                 '/setitems{.format}',
                 action='setnum')
+        submap.connect('messages-feed',
+                '/feed{.format}',
+                action='feed')
     # reports
     with urlmap.submapper(path_prefix="/reports",
             controller="reports") as submap:
@@ -639,6 +645,15 @@ def make_map(config):
         submap.connect('status-auditlog-export-status',
                 r'/audit/export/status/{taskid}',
                 action='audit_export_status')
+    # background jobs
+    with urlmap.submapper(path_prefix="/jobs",
+            controller='jobs') as submap:
+        submap.connect('job-status',
+                '/{jobid}',
+                action='status')
+        submap.connect('job-cancel',
+                '/{jobid}/cancel',
+                action='cancel')
     # file manager
     with urlmap.submapper(path_prefix="/fm",
             controller='filemanager') as submap:
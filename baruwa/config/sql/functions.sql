@@ -120,6 +120,147 @@ $$ LANGUAGE plpgsql;
 -- Add to messages
 CREATE TRIGGER update_totals AFTER INSERT OR DELETE ON messages FOR EACH ROW EXECUTE PROCEDURE mktotals();
 
+-- SpamAssassin score histogram
+CREATE OR REPLACE FUNCTION sahist_domain(dom TEXT) RETURNS TEXT AS $$
+BEGIN
+    PERFORM 1 FROM current_domains WHERE name=dom;
+    IF FOUND THEN
+        RETURN dom;
+    END IF;
+    RETURN '';
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+CREATE OR REPLACE FUNCTION sahist_add(d DATE, dto TEXT, dfrom TEXT,
+    s DOUBLE PRECISION, n BIGINT) RETURNS VOID AS $$
+BEGIN
+    LOOP
+        UPDATE sascorehist SET total=total + n
+            WHERE date=d AND to_domain=dto AND from_domain=dfrom AND score=s;
+        IF FOUND OR n < 0 THEN
+            RETURN;
+        END IF;
+        BEGIN
+            INSERT INTO sascorehist (date, to_domain, from_domain, score, total)
+                VALUES(d, dto, dfrom, s, n);
+            RETURN;
+        EXCEPTION WHEN unique_violation THEN
+            -- inserted by a concurrent transaction, update it
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mksahist() RETURNS trigger AS $$
+BEGIN
+    IF (TG_OP = 'UPDATE' OR TG_OP = 'DELETE') THEN
+        IF OLD.scaned = 1 AND OLD.whitelisted != 1
+            AND OLD.sascore IS NOT NULL THEN
+            PERFORM sahist_add(OLD.date, sahist_domain(OLD.to_domain),
+                sahist_domain(OLD.from_domain), round(OLD.sascore), -1);
+        END IF;
+    END IF;
+    IF (TG_OP = 'UPDATE' OR TG_OP = 'INSERT') THEN
+        IF NEW.scaned = 1 AND NEW.whitelisted != 1
+            AND NEW.sascore IS NOT NULL THEN
+            PERFORM sahist_add(NEW.date, sahist_domain(NEW.to_domain),
+                sahist_domain(NEW.from_domain), round(NEW.sascore), 1);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_sahist AFTER INSERT OR DELETE OR UPDATE OF date, sascore,
+    scaned, whitelisted, to_domain, from_domain ON messages FOR EACH ROW
+    EXECUTE PROCEDURE mksahist();
+
+-- Rebuild the histogram from the messages, run after upgrading
+CREATE OR REPLACE FUNCTION rebuild_sahist() RETURNS VOID AS $$
+BEGIN
+    LOCK TABLE sascorehist IN EXCLUSIVE MODE;
+    DELETE FROM sascorehist;
+    INSERT INTO sascorehist (date, to_domain, from_domain, score, total)
+        SELECT date, sahist_domain(to_domain), sahist_domain(from_domain),
+            round(sascore), count(*) FROM messages
+            WHERE scaned = 1 AND whitelisted != 1 AND sascore IS NOT NULL
+            GROUP BY 1, 2, 3, 4;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Client IP statistics
+CREATE OR REPLACE FUNCTION ipstats_add(d DATE, ip TEXT, s DOUBLE PRECISION,
+    spam SMALLINT, virii SMALLINT, n BIGINT) RETURNS VOID AS $$
+DECLARE
+    b INTEGER;
+    e BIGINT;
+    sp BIGINT;
+    hm BIGINT;
+    vi BIGINT;
+BEGIN
+    b := floor(s);
+    e := CASE WHEN s = b THEN n ELSE 0 END;
+    sp := CASE WHEN spam > 0 THEN n ELSE 0 END;
+    vi := CASE WHEN virii > 0 THEN n ELSE 0 END;
+    hm := CASE WHEN spam = 0 AND virii = 0 THEN n ELSE 0 END;
+    LOOP
+        UPDATE clientipstats SET total=total + n, exact=exact + e,
+            spam=spam + sp, ham=ham + hm, virii=virii + vi
+            WHERE date=d AND clientip=ip AND score=b;
+        IF FOUND OR n < 0 THEN
+            RETURN;
+        END IF;
+        BEGIN
+            INSERT INTO clientipstats (date, clientip, score, total, exact,
+                spam, ham, virii) VALUES(d, ip, b, n, e, sp, hm, vi);
+            RETURN;
+        EXCEPTION WHEN unique_violation THEN
+            -- inserted by a concurrent transaction, update it
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mkipstats() RETURNS trigger AS $$
+BEGIN
+    IF (TG_OP = 'UPDATE' OR TG_OP = 'DELETE') THEN
+        IF OLD.clientip IS NOT NULL AND OLD.sascore IS NOT NULL THEN
+            PERFORM ipstats_add(OLD.date, OLD.clientip, OLD.sascore,
+                OLD.spam, OLD.virusinfected, -1);
+        END IF;
+    END IF;
+    IF (TG_OP = 'UPDATE' OR TG_OP = 'INSERT') THEN
+        IF NEW.clientip IS NOT NULL AND NEW.sascore IS NOT NULL THEN
+            PERFORM ipstats_add(NEW.date, NEW.clientip, NEW.sascore,
+                NEW.spam, NEW.virusinfected, 1);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_ipstats AFTER INSERT OR DELETE OR UPDATE OF date,
+    clientip, sascore, spam, virusinfected ON messages FOR EACH ROW
+    EXECUTE PROCEDURE mkipstats();
+
+-- Rebuild the client IP statistics from the messages, run after upgrading
+CREATE OR REPLACE FUNCTION rebuild_ipstats() RETURNS VOID AS $$
+BEGIN
+    LOCK TABLE clientipstats IN EXCLUSIVE MODE;
+    DELETE FROM clientipstats;
+    INSERT INTO clientipstats (date, clientip, score, total, exact, spam,
+        ham, virii)
+        SELECT date, clientip, floor(sascore), count(*),
+            sum(CASE WHEN sascore = floor(sascore) THEN 1 ELSE 0 END),
+            sum(CASE WHEN spam > 0 THEN 1 ELSE 0 END),
+            sum(CASE WHEN spam = 0 AND virusinfected = 0 THEN 1 ELSE 0 END),
+            sum(CASE WHEN virusinfected > 0 THEN 1 ELSE 0 END)
+            FROM messages
+            WHERE clientip IS NOT NULL AND sascore IS NOT NULL
+            GROUP BY 1, 2, 3;
+END;
+$$ LANGUAGE plpgsql;
+
 --updates for indexer
 CREATE OR REPLACE FUNCTION update_ts() RETURNS TRIGGER AS $$
 BEGIN
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"Background jobs controller"
+
+import json
+import time
+import logging
+
+from pylons import request, response, session, tmpl_context as c, url
+from pylons.controllers.util import abort, redirect
+from pylons.i18n.translation import _
+from repoze.what.predicates import not_anonymous
+from repoze.what.plugins.pylonshq import ControllerProtector
+
+from baruwa.forms import Form
+from baruwa.lib.base import BaseController
+from baruwa.lib.helpers import flash, flash_alert
+from baruwa.lib.jobs import get_job, FINISHED
+
+log = logging.getLogger(__name__)
+
+JSON_HEADER = 'application/json; charset=utf-8'
+
+
+@ControllerProtector(not_anonymous())
+class JobsController(BaseController):
+    "Background jobs controller"
+    def __before__(self):
+        "set context"
+        BaseController.__before__(self)
+        if self.identity:
+            c.user = self.identity['user']
+        else:
+            c.user = None
+
+    def _load_job(self, jobid):
+        "utility"
+        job = get_job(jobid, c.user.username)
+        if job is None:
+            abort(404)
+        return job
+
+    def status(self, jobid):
+        """Return the job state as json, the request is answered
+        straight away and the progress page polls on a timer"""
+        job = self._load_job(jobid)
+        state = job.update()
+        response.headers['Content-Type'] = JSON_HEADER
+        response.headers['Cache-Control'] = 'no-cache'
+        return json.dumps(dict(id=job.id,
+                                kind=job.kind,
+                                state=state,
+                                finished=state in FINISHED,
+                                elapsed=int(time.time() - job.created),
+                                timeout=job.timeout))
+
+    def cancel(self, jobid):
+        "Cancel a job"
+        job = self._load_job(jobid)
+        form = Form(request.POST, csrf_context=session)
+        if request.method != 'POST' or not form.validate():
+            abort(400)
+        if job.cancel():
+            msg = _('The request has been cancelled')
+            flash(msg)
+            log.info(msg)
+        else:
+            flash_alert(_('The request has already completed'))
+        came_from = request.POST.get('came_from', '')
+        if not came_from.startswith('/') or came_from.startswith('//'):
+            came_from = url('home')
+        redirect(came_from)
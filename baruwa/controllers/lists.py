@@ -33,7 +33,7 @@ from pylons.i18n.translation import _
 from sqlalchemy import desc
 from sqlalchemy.exc import IntegrityError
 from repoze.what.predicates import not_anonymous
-from sphinxapi import SphinxClient, SPH_MATCH_EXTENDED2
+from sphinxapi import SphinxClient, SPH_MATCH_EXTENDED2, SPH_SORT_EXTENDED
 from repoze.what.plugins.pylonshq import ControllerProtector
 
 from baruwa.model.lists import List
@@ -44,6 +44,7 @@ from baruwa.lib.api import get_listitem
 from baruwa.forms.lists import list_forms
 from baruwa.lib.base import BaseController
 from baruwa.lib.misc import convert_list_to_json
+from baruwa.lib.query import SphinxList, SPHINX_MAX_MATCHES
 from baruwa.lib.helpers import flash, flash_alert
 from baruwa.lib.backend import update_lists_backend
 from baruwa.lib.audit.msgs import lists as auditmsgs
@@ -121,21 +122,29 @@ class ListsController(BaseController):
             conn.SetServer(sphinxopts.get('host', '127.0.0.1'))
             conn.SetMatchMode(SPH_MATCH_EXTENDED2)
             conn.SetFilter('list_type', [int(list_type), ])
+            conn.SetSortMode(SPH_SORT_EXTENDED, '%s %s' % (
+                            '@id' if order_by == 'id' else order_by,
+                            'DESC' if direction == 'dsc' else 'ASC'))
             if not c.user.is_superadmin:
                 conn.SetFilter('user_id', [c.user.id, ])
-            if page == 1:
-                conn.SetLimits(0, num_items, 500)
-            else:
-                page = int(page)
-                offset = (page - 1) * num_items
-                conn.SetLimits(offset, num_items, 500)
+            page = int(page)
+            conn.SetLimits((page - 1) * num_items, num_items,
+                            int(config.get('baruwa.sphinx.max_matches',
+                                            SPHINX_MAX_MATCHES)))
 
             try:
                 results = conn.Query(qry, 'lists, lists_rt')
             except (socket.timeout, struct.error):
                 redirect(request.path_qs)
 
-            if results and results['matches']:
+            if (results and results['matches'] and
+                SphinxList.usable(results)):
+                # the index carries everything the listing shows
+                total_found = results['total_found']
+                search_time = results['time']
+                items = SphinxList.from_results(results)
+                listcount = results['total']
+            elif results and results['matches']:
                 ids = [hit['id'] for hit in results['matches']]
                 total_found = results['total_found']
                 search_time = results['time']
@@ -18,8 +18,8 @@
 #
 "Messages controller"
 
+import cgi
 import json
-import base64
 import socket
 import logging
 import struct
@@ -43,24 +43,32 @@ from repoze.what.plugins.pylonshq import ActionProtector
 from pylons import request, response, session, tmpl_context as c, url
 from pylons.controllers.util import abort, redirect
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from sphinxapi import SphinxClient, SPH_MATCH_EXTENDED2
+from sphinxapi import SphinxClient, SPH_MATCH_EXTENDED2, SPH_SORT_ATTR_DESC
 from celery.exceptions import TimeoutError, QueueNotFound
 
 from baruwa.model.meta import Session
 from baruwa.lib.audit import audit_log
 from baruwa.lib.net import system_hostname
+from baruwa.lib.jobs import SUCCESS
+from baruwa.lib.feed import session_scope, FeedBusyError, get_feed
+from baruwa.lib.feed import feed_position, MAX_WAIT as FEED_TIMEOUT
 from baruwa.lib.base import BaseController
 from baruwa.lib.pagination import paginator
 from baruwa.lib.dates import convert_date
 from baruwa.lib.caching_query import FromCache
 from baruwa.lib.helpers import flash, flash_alert
 from baruwa.lib.templates.html import image_fixups
+from baruwa.lib.mail.message import search_quarantine
+from baruwa.lib.crypto.tokens import make_token, verify_token
+from baruwa.lib.mail.parts import PartStreamer, parse_range
 from baruwa.tasks import preview_msg, update_autorelease
 from baruwa.lib.misc import jsonify_msg_list, convert_to_json
 from baruwa.lib.misc import check_num_param, extract_sphinx_opts
 from baruwa.lib.query import DynaQuery, UserFilter, filter_sphinx
+from baruwa.lib.query import SphinxMessage, SPHINX_MAX_MATCHES
 from baruwa.forms.messages import ReleaseMsgForm, BulkReleaseForm
 from baruwa.tasks import release_message, process_quarantined_msg
+from baruwa.tasks import process_quarantined_msgs
 from baruwa.lib.query import clean_sphinx_q, restore_sphinx_q, MsgCount
 from baruwa.model.messages import Message, Archive, MessageStatus
 from baruwa.lib.audit.msgs.messages import MSGDOWNLOAD_MSG, MSGPREVIEW_MSG
@@ -128,6 +136,103 @@ def process_release_results(context, msg, result, dbsession, func):
     return '<br />'.join(html)
 
 
+def batch_jobs(jobs):
+    """Group bulk processing jobs by the node holding the quarantine,
+    yields (routing_key, jobs) batches"""
+    shared = asbool(config.get('ms.quarantine.shared', 'false'))
+    size = int(config.get('baruwa.release.batch.size', 50))
+    hosts = {}
+    for job in jobs:
+        key = system_hostname() if shared else job['hostname']
+        batch = hosts.setdefault(key, [])
+        batch.append(job)
+        if len(batch) >= size:
+            yield key, batch
+            hosts[key] = []
+    for key, batch in hosts.iteritems():
+        if batch:
+            yield key, batch
+
+
+def stream_secret():
+    "Return the secret used to sign part stream tokens"
+    return config.get('baruwa.stream.secret',
+                    config['beaker.session.secret'])
+
+
+def stream_part(msgfile, attachid, imgid, range_header):
+    """Set up the response to stream a message part from the
+    local quarantine, returns the part name and the body iterator"""
+    try:
+        streamer = PartStreamer(msgfile, attachid, imgid)
+    except (IOError, TypeError, LookupError):
+        abort(404)
+    size = streamer.size
+    try:
+        byterange = parse_range(range_header, size)
+    except ValueError:
+        streamer.close()
+        response.status = 416
+        response.headers['Content-Range'] = 'bytes */%d' % size
+        return None, ''
+    disposition = 'attachment' if attachid else 'inline'
+    content_disposition = '%s; filename="%s"' % (disposition,
+                        streamer.name.encode('ascii', 'replace'))
+    response.content_type = str(streamer.content_type)
+    response.headers['Content-Disposition'] = str(content_disposition)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Pragma'] = 'public'
+    response.headers['Cache-Control'] = 'max-age=0'
+    if byterange:
+        start, end = byterange
+        response.status = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % \
+                                            (start, end, size)
+        response.headers['Content-Length'] = str(end - start + 1)
+        return streamer.name, streamer.stream(start, end)
+    response.headers['Content-Length'] = str(size)
+    return streamer.name, streamer.stream()
+
+
+def proxy_part(hostname, token, range_header):
+    """Relay a message part streamed by the node that holds
+    the quarantine, returns the part name and the body iterator"""
+    scheme = config.get('baruwa.stream.scheme', 'https')
+    req = urllib2.Request('%s://%s%s' % (scheme, hostname,
+                        url('messages-stream', token=token)))
+    if range_header:
+        req.add_header('Range', range_header)
+    try:
+        remote = urllib2.urlopen(req, timeout=30)
+    except urllib2.HTTPError, error:
+        if error.code == 416:
+            response.status = 416
+            response.headers['Content-Range'] = \
+                                        error.headers.get('Content-Range')
+            return None, ''
+        abort(404)
+    response.status = remote.getcode()
+    for header in ['Content-Type', 'Content-Length', 'Content-Range',
+                    'Content-Disposition', 'Accept-Ranges']:
+        if remote.headers.get(header):
+            response.headers[header] = remote.headers.get(header)
+    response.headers['Pragma'] = 'public'
+    response.headers['Cache-Control'] = 'max-age=0'
+    params = cgi.parse_header(remote.headers.get('Content-Disposition',
+                                                ''))[1]
+
+    def relay():
+        "Relay the remote body"
+        try:
+            chunk = remote.read(65536)
+            while chunk:
+                yield chunk
+                chunk = remote.read(65536)
+        finally:
+            remote.close()
+    return params.get('filename'), relay()
+
+
 # @ControllerProtector(not_anonymous())
 class MessagesController(BaseController):
     "Messages controller"
@@ -193,6 +298,7 @@ class MessagesController(BaseController):
         uquery = UserFilter(Session, c.user, query)
         query = uquery.filter()
         items = query[:num_items]
+        last_id = feed_position()
         if format == 'json':
             response.headers['Content-Type'] = 'application/json'
             msgs = [item.json for item in items]
@@ -201,7 +307,8 @@ class MessagesController(BaseController):
                         inbound=c.baruwa_inbound,
                         outbound=c.baruwa_outbound,
                         items=msgs,
-                        num_items=num_items
+                        num_items=num_items,
+                        last_id=last_id
                     )
             if c.user.is_admin:
                 tmp['status'] = c.baruwa_status
@@ -209,8 +316,47 @@ class MessagesController(BaseController):
 
         c.messages = items
         c.num_items = num_items
+        c.last_id = last_id
         return self.render('/messages/index.html')
 
+    @ActionProtector(not_anonymous())
+    def feed(self, format=None):
+        """Long poll for the messages received after the since id,
+        reset tells the client to reload the listing"""
+        try:
+            since = int(request.GET.get('since', 0))
+        except ValueError:
+            since = 0
+        num_items = session.get('msgs_num_items', 50)
+        scope = session_scope(session, Session, c.user)
+        # do not hold a database connection while waiting
+        Session.close()
+        timeout = int(config.get('baruwa.feed.timeout', FEED_TIMEOUT))
+        try:
+            items, last_id, reset = get_feed().wait(since, scope.match,
+                                                    num_items, timeout)
+        except FeedBusyError:
+            response.headers['Retry-After'] = '60'
+            abort(503)
+        # the totals are calculated once the wait is over so that they
+        # are current, the user was detached by the close above
+        Session.add(c.user)
+        self._set_totals(c.user)
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['Cache-Control'] = 'no-cache'
+        tmp = dict(
+                    totals=c.baruwa_totals,
+                    inbound=c.baruwa_inbound,
+                    outbound=c.baruwa_outbound,
+                    items=[item.json for item in items],
+                    num_items=num_items,
+                    last_id=last_id,
+                    reset=reset
+                )
+        if c.user.is_admin:
+            tmp['status'] = c.baruwa_status
+        return json.dumps(tmp)
+
     @ActionProtector(not_anonymous())
     def detail(self, msgid, archive=None, format=None):
         "return message detail"
@@ -407,19 +553,14 @@ class MessagesController(BaseController):
                             msgfiles=msg.msgfiles,
                             to_address=msg.to_address,
                             hostname=msg.hostname,
-                            mid=msg.id,
-                            num=num_items)
+                            mid=msg.id)
                         for msg in msgs)
 
             if formvals:
                 try:
-                    subtasks = [process_quarantined_msg.subtask(args=[formval],
-                                options=dict(routing_key=system_hostname()
-                                if asbool(config.get(
-                                                    'ms.quarantine.shared',
-                                                    'false'))
-                                else formval['hostname']))
-                                for formval in formvals]
+                    subtasks = [process_quarantined_msgs.subtask(args=[batch],
+                                options=dict(routing_key=hostname))
+                                for hostname, batch in batch_jobs(formvals)]
                     task = group(subtasks).apply_async()
                     task.save(backend=RBACKEND)
                     session['bulk_items'] = []
@@ -515,62 +656,67 @@ class MessagesController(BaseController):
                 raise ValueError
             localtmz = config.get('baruwa.timezone', 'Africa/Johannesburg')
             cdte = convert_date(message.timestamp, localtmz).strftime('%Y%m%d')
+            if attachment or img:
+                range_header = request.headers.get('Range')
+                if (asbool(config.get('ms.quarantine.shared', 'false')) or
+                    message.hostname.strip() == system_hostname()):
+                    msgfile = search_quarantine(cdte,
+                                                message.messageid,
+                                                message.msgfiles)[0]
+                    name, body = stream_part(msgfile, attachment, img,
+                                            range_header)
+                else:
+                    token = make_token(dict(messageid=message.messageid,
+                                            date=cdte,
+                                            msgfiles=message.msgfiles,
+                                            attachid=attachment,
+                                            imgid=img),
+                                        stream_secret())
+                    name, body = proxy_part(message.hostname.strip(),
+                                            token, range_header)
+                if name:
+                    info = MSGDOWNLOAD_MSG % dict(m=message.id, a=name)
+                    audit_log(c.user.username,
+                            1, unicode(info), request.host,
+                            request.remote_addr, arrow.utcnow().datetime)
+                return body
             args = [message.messageid,
                     cdte,
                     message.msgfiles,
                     attachment,
                     img,
                     allowimgs]
-            task = preview_msg.apply_async(args=args,
-                        routing_key=system_hostname() if
+            whereto = url('message-archive', msgid=msgid) if archive \
+                        else url('message-detail', msgid=msgid)
+            job = self._get_job('preview:%s' % message.id, preview_msg,
+                        args, system_hostname() if
                         asbool(config.get('ms.quarantine.shared', 'false'))
                         else message.hostname.strip())
-            task.wait(30)
-            if task.result:
-                if img:
-                    if message.isdangerous and c.user.is_peleb:
-                        abort(404)
-                    response.content_type = task.result['content_type']
-                    if task.result and 'img' in task.result:
-                        info = MSGDOWNLOAD_MSG % dict(m=message.id,
-                                                a=task.result['name'])
-                        audit_log(c.user.username,
-                                1, unicode(info), request.host,
-                                request.remote_addr, arrow.utcnow().datetime)
-                        return base64.decodestring(task.result['img'])
-                    abort(404)
-                if attachment:
-                    info = MSGDOWNLOAD_MSG % dict(m=message.id,
-                                            a=task.result['name'])
-                    audit_log(c.user.username,
-                            1, unicode(info), request.host,
-                            request.remote_addr, arrow.utcnow().datetime)
-                    response.content_type = task.result['mimetype']
-                    content_disposition = 'attachment; filename="%s"' % \
-                        task.result['name'].encode('ascii', 'replace')
-                    response.headers['Content-Disposition'] = \
-                                    str(content_disposition)
-                    response.headers['Content-Length'] = \
-                                    len(task.result['attachment'])
-                    response.headers['Pragma'] = 'public'
-                    response.headers['Cache-Control'] = 'max-age=0'
-                    return base64.decodestring(task.result['attachment'])
-                for part in task.result['parts']:
+            if job is None:
+                redirect(whereto)
+            pending = self._job_pending(job, whereto)
+            if pending is not None:
+                return pending
+            if job.state != SUCCESS:
+                raise TimeoutError(job.state)
+            result = job.result
+            if result:
+                for part in result['parts']:
                     if part['type'] == 'text/html':
-                        local_rf = (not task.result['is_multipart']
+                        local_rf = (not result['is_multipart']
                                     or richformat)
                         part['content'] = image_fixups(
                                             part['content'],
                                             msgid, archive,
                                             local_rf, allowimgs)
-                c.message = task.result
+                c.message = result
                 info = MSGPREVIEW_MSG % dict(m=message.id)
                 audit_log(c.user.username,
                         1, unicode(info), request.host,
                         request.remote_addr, arrow.utcnow().datetime)
             else:
                 c.message = {}
-        except (socket.error, TimeoutError, QueueNotFound):
+        except (socket.error, urllib2.URLError, TimeoutError, QueueNotFound):
             lmsg = _('The message could not be previewed, try again later')
             flash_alert(lmsg)
             log.info(lmsg)
@@ -593,6 +739,17 @@ class MessagesController(BaseController):
         # print c.message
         return self.render('/messages/preview.html')
 
+    def stream(self, token):
+        "Stream a message part from the local quarantine"
+        data = verify_token(token, stream_secret())
+        if data is None:
+            abort(403)
+        msgfile = search_quarantine(data['date'], data['messageid'],
+                                    data['msgfiles'])[0]
+        body = stream_part(msgfile, data['attachid'], data['imgid'],
+                            request.headers.get('Range'))[1]
+        return body
+
     def autorelease(self, uuid):
         "release a message without logging in"
         releasereq = get_releasereq(uuid)
@@ -665,7 +822,11 @@ class MessagesController(BaseController):
         results = []
         if result.ready():
             finished = True
-            results = result.join_native()
+            for item in result.join_native():
+                if isinstance(item, list):
+                    results.extend(item)
+                else:
+                    results.append(item)
         else:
             session['bulkprocess-count'] += 1
             if (session['bulkprocess-count'] >= 10 and
@@ -714,30 +875,33 @@ class MessagesController(BaseController):
         except ValueError:
             page = 1
         num_items = session.get('msgs_search_num_results', 50)
+        max_matches = int(config.get('baruwa.sphinx.max_matches',
+                                    SPHINX_MAX_MATCHES))
+        filters = session.get('filter_by', None)
         conn = SphinxClient()
         sphinxopts = extract_sphinx_opts(config['sphinx.url'])
         conn.SetServer(sphinxopts.get('host', '127.0.0.1'))
         conn.SetMatchMode(SPH_MATCH_EXTENDED2)
+        conn.SetSortMode(SPH_SORT_ATTR_DESC, 'timestamp')
         if action == 'quarantine':
             conn.SetFilter('isquarantined', [True, ])
-        if page == 1:
-            conn.SetLimits(0, num_items, 500)
-        else:
-            offset = (page - 1) * num_items
-            conn.SetLimits(offset, num_items, 500)
+        conn.SetLimits((page - 1) * num_items, num_items, max_matches)
         if not c.user.is_superadmin:
-            filter_sphinx(Session, c.user, conn)
-        else:
-            conn.SetSelect('timestamp')
+            filter_sphinx(Session, c.user, conn, '*')
         qry = clean_sphinx_q(qry)
         try:
             results = conn.Query(qry, index)
         except (socket.timeout, struct.error):
             redirect(request.path_qs)
         qry = restore_sphinx_q(qry)
-        if results and results['matches']:
+        if (results and results['matches'] and not filters and
+            SphinxMessage.usable(results)):
+            # the index carries everything the listing shows
+            messages = SphinxMessage.from_results(results)
+            total_found = results['total']
+            search_time = results['time']
+        elif results and results['matches']:
             ids = [hit['id'] for hit in results['matches']]
-            filters = session.get('filter_by', None)
             if action == 'archive':
                 messages = get_archived().filter(
                             Archive.id.in_(ids))
@@ -21,37 +21,36 @@
 import os
 import json
 import logging
-import threading
 
 import arrow
 
-from cStringIO import StringIO
-
 from pylons import request, response, session, tmpl_context as c, url, config
 from pylons.controllers.util import abort, redirect
 from pylons.i18n.translation import _
+from paste.deploy.converters import asbool
 from repoze.what.predicates import not_anonymous
 from repoze.what.plugins.pylonshq import ActionProtector
 from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
-from reportlab.lib import colors
-from reportlab.graphics import renderPM
 from webhelpers.number import format_byte_size
 
 from baruwa.lib.base import BaseController
 from baruwa.lib.helpers import flash, flash_alert
-from baruwa.lib.outputformats import CSVWriter
+from baruwa.lib.outputformats import stream_csv
 from baruwa.lib.query import DynaQuery, UserFilter, ReportQuery
 from baruwa.lib.query import sa_scores, message_totals, MsgCount
+from baruwa.lib.query import stream_query
 from baruwa.lib.graphs import PIE_COLORS, build_spam_chart
+from baruwa.lib.render import get_renderer, to_rows, RenderBusyError
+from baruwa.lib.render import RenderError
 from baruwa.lib.audit import audit_log
 from baruwa.model.meta import Session
 from baruwa.model.messages import Message
 from baruwa.model.reports import SavedFilter
 from baruwa.lib.caching_query import FromCache
 from baruwa.lib.auth.predicates import CanAccessReport
-from baruwa.lib.graphs import PieChart, PDFReport, build_barchart
+from baruwa.lib.graphs import build_pie_chart, build_barchart
 from baruwa.lib.templates.helpers import country_flag, get_hostname
 from baruwa.forms.reports import FilterForm, FILTER_BY, FILTER_ITEMS
 from baruwa.lib.audit.msgs.reports import REPORTVIEW_MSG, REPORTDL_MSG
@@ -101,8 +100,6 @@ def processfilters(filt, filters):
             'value': filt.value, 'field': filt.field,
             'filter': filt.option, 'loaded': loaded}
 
-lock = threading.RLock()
-
 
 class ReportsController(BaseController):
     "Reports Controller"
@@ -146,78 +143,45 @@ class ReportsController(BaseController):
                 session['filter_by'].append(filt)
                 session.save()
 
-    def _png(self, data, reportid):
-        "PNG"
+    def _chart(self, data, reportid):
+        "Return the chart builder and its arguments"
+        rows = to_rows(data)
         if int(reportid) == 11:
-            chart = build_barchart(data)
+            return build_barchart, (rows,)
         elif int(reportid) == 9:
-            chart = build_spam_chart(data)
-        else:
-            piedata = [getattr(row, REPORTS[reportid]['sort'])
-                        for row in data]
-            total = sum(piedata)
-            labels = [("%.1f%%" % ((1.0 * getattr(row,
-                        REPORTS[reportid]['sort']) / total) * 100))
-                        for row in data]
-            chart = PieChart(350, 284)
-            chart.chart.labels = labels
-            chart.chart.data = piedata
-            chart.chart.width = 200
-            chart.chart.height = 200
-            chart.chart.x = 90
-            chart.chart.y = 30
-            chart.chart.slices.strokeWidth = 1
-            chart.chart.slices.strokeColor = colors.black
-
-        self.imgfile = StringIO()
-        renderPM.drawToFile(chart, self.imgfile, 'PNG',
-                        bg=colors.HexColor('#FFFFFF'))
-
-    def _csv(self, data):
-        "output to csv"
-        try:
-            self.csvfile = StringIO()
-            head = data[0]
-            format = head.keys()
-            csvwriter = CSVWriter(self.csvfile, format)
-            csvwriter.writeasobj(data)
-        except IndexError:
-            pass
+            return build_spam_chart, (rows,)
+        return build_pie_chart, (rows, REPORTS[reportid]['sort'])
+
+    def _render_busy(self):
+        "Render queue is full"
+        response.headers['Retry-After'] = '30'
+        abort(503, _('Too many reports are being generated, '
+                    'try again later'))
 
     def _generate_png(self, data, reportid):
         "Generate PNG images on the fly"
-        lock.acquire()
         try:
-            self._png(data, reportid)
-            response.content_type = 'image/png'
-            response.headers['Cache-Control'] = 'max-age=0'
-            pngdata = self.imgfile.getvalue()
-            response.headers['Content-Length'] = len(pngdata)
+            builder, args = self._chart(data, reportid)
+            return self._send_chart(builder, *args)
+        except RenderBusyError:
+            self._render_busy()
         except:
             abort(404)
-        finally:
-            self.imgfile.close()
-            lock.release()
-        return pngdata
 
-    def _generate_csv(self, data, reportid):
-        "Generate CSV files on the fly"
-        lock.acquire()
-        try:
-            self._csv(data)
-            response.content_type = 'text/csv'
-            response.headers['Cache-Control'] = 'max-age=0'
-            csvdata = self.csvfile.getvalue()
-            disposition = ('attachment; filename=%s.csv' %
-                            REPORTS[reportid]['title'].replace(' ', '_'))
-            response.headers['Content-Disposition'] = str(disposition)
-            response.headers['Content-Length'] = len(csvdata)
-        except:
-            abort(404)
-        finally:
-            self.csvfile.close()
-            lock.release()
-        return csvdata
+    def _generate_csv(self, rows, reportid, keys=None):
+        """Stream CSV files on the fly, the response is sent chunked
+        and gzip compressed when enabled and accepted by the client"""
+        compress = (asbool(config.get('baruwa.exports.gzip', False)) and
+                    'gzip' in request.accept_encoding)
+        response.content_type = 'text/csv'
+        response.headers['Cache-Control'] = 'max-age=0'
+        disposition = ('attachment; filename=%s.csv' %
+                        REPORTS[reportid]['title'].replace(' ', '_'))
+        response.headers['Content-Disposition'] = str(disposition)
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+        return stream_csv(rows, keys, compress=compress)
 
     def _generate_pdf(self, data, reportid):
         "Generate PDF's on the fly"
@@ -227,31 +191,36 @@ class ReportsController(BaseController):
         else:
             logo = os.path.join(config['pylons.paths']['static_files'],
                             'imgs', 'logo.png')
-        lock.acquire()
+        pname = dict(name=config.get('baruwa.custom.name', 'Baruwa'))
+        sortby = REPORTS[reportid]['sort']
+        sections = []
+        if reportid in ['1', '2', '3', '4', '5', '6', '7', '8', '10']:
+            pieheadings = (u'', _('Address'), _('Count'), _('Volume'), u'')
+            sections.append((to_rows(data),
+                            unicode(REPORTS[reportid]['title']),
+                            pieheadings, sortby, 'pie'))
+        if reportid == '11':
+            totalsheaders = dict(date=_('Date'), mail=_('Mail totals'),
+                            spam=_('Spam totals'),
+                            virus=_('Virus totals'),
+                            volume=_('Mail volume'),
+                            totals=_('Totals'))
+            sections.append((to_rows(data), _('Message Totals'),
+                            totalsheaders, None, 'bar'))
         try:
-            pname = dict(name=config.get('baruwa.custom.name', 'Baruwa'))
-            pdfcreator = PDFReport(logo, _('%(name)s Report') % pname)
-            sortby = REPORTS[reportid]['sort']
-            if reportid in ['1', '2', '3', '4', '5', '6', '7', '8', '10']:
-                pieheadings = ('', _('Address'), _('Count'), _('Volume'), '')
-                pdfcreator.add(data, REPORTS[reportid]['title'],
-                                pieheadings, sortby)
-            if reportid == '11':
-                totalsheaders = dict(date=_('Date'), mail=_('Mail totals'),
-                                spam=_('Spam totals'),
-                                virus=_('Virus totals'),
-                                volume=_('Mail volume'),
-                                totals=_('Totals'))
-                pdfcreator.add(data, _('Message Totals'), totalsheaders,
-                                chart='bar')
-            response.headers['Content-Type'] = PDF_HEADER
-            disposition = ('attachment; filename=%s.pdf' %
-            REPORTS[reportid]['title'].replace(' ', '_'))
-            response.headers['Content-Disposition'] = str(disposition)
-            pdfdata = pdfcreator.build()
-            response.headers['Content-Length'] = len(pdfdata)
-        finally:
-            lock.release()
+            pdfdata = get_renderer().pdf(logo, _('%(name)s Report') % pname,
+                                        sections)
+        except RenderBusyError:
+            self._render_busy()
+        except RenderError:
+            response.headers['Retry-After'] = '30'
+            abort(503, _('The report could not be generated, '
+                        'try again later'))
+        response.headers['Content-Type'] = PDF_HEADER
+        disposition = ('attachment; filename=%s.pdf' %
+        REPORTS[reportid]['title'].replace(' ', '_'))
+        response.headers['Content-Disposition'] = str(disposition)
+        response.headers['Content-Length'] = len(pdfdata)
         return pdfdata
 
     def _get_data(self, format=None, success=None, errors=None):
@@ -372,10 +341,9 @@ class ReportsController(BaseController):
                         for index, item in enumerate(data)]
             template = '/reports/piereport.html'
         if reportid == '9':
-            query = sa_scores(Session, c.user)
-            if filters:
-                dynq = DynaQuery(Message, query, filters)
-                query = dynq.generate()
+            histogram = asbool(config.get('baruwa.reports.sascore.histogram',
+                                    False))
+            query = sa_scores(Session, c.user, filters, histogram)
             cachekey = u'sascores-%s' % c.user.username
             query = query.options(FromCache('sql_cache_short', cachekey))
             data = query.all()
@@ -410,6 +378,12 @@ class ReportsController(BaseController):
             if filters:
                 dynq = DynaQuery(Message, query, filters)
                 query = dynq.generate()
+            if format == 'csv':
+                info = REPORTDL_MSG % dict(r=c.report_title, f='csv')
+                audit_log(c.user.username,
+                        1, unicode(info), request.host,
+                        request.remote_addr, arrow.utcnow().datetime)
+                return self._generate_csv(stream_query(query), reportid)
             cachekey = u'msgtotals-%s' % c.user.username
             query = query.options(FromCache('sql_cache_short', cachekey))
             data = query.all()
@@ -464,12 +438,6 @@ class ReportsController(BaseController):
                         int(row.mail_total)) * 100),
                         spam_percent="%.1f" % ((1.0 * int(row.spam_total) /
                         int(row.mail_total)) * 100)) for row in data]
-            elif format == 'csv':
-                info = REPORTDL_MSG % dict(r=c.report_title, f='csv')
-                audit_log(c.user.username,
-                        1, unicode(info), request.host,
-                        request.remote_addr, arrow.utcnow().datetime)
-                return self._generate_csv(data, reportid)
             else:
                 jsondata = dict(mail=[],
                                 spam=[],
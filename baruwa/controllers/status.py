@@ -18,6 +18,7 @@
 #
 "Status controller"
 
+import os
 import json
 import base64
 import logging
@@ -25,7 +26,6 @@ import logging
 import arrow
 
 from urlparse import urlparse
-from cStringIO import StringIO
 
 from pylons import response, request, session, tmpl_context as c, url, config
 from pylons.controllers.util import abort, redirect
@@ -35,23 +35,23 @@ from repoze.what.predicates import All, not_anonymous
 from repoze.what.plugins.pylonshq import ActionProtector
 from repoze.what.plugins.pylonshq import ControllerProtector
 from webhelpers import paginate
-from reportlab.lib import colors
 from sqlalchemy import desc
 from celery.result import AsyncResult
-from reportlab.graphics import renderPM
 from sqlalchemy.orm.exc import NoResultFound
 from sphinxapi import SphinxClient, SPH_MATCH_EXTENDED2
 from celery.exceptions import TimeoutError, QueueNotFound
 
 from baruwa.lib.base import BaseController
+from baruwa.lib.net import system_hostname
 from baruwa.model.meta import Session
 from baruwa.lib.helpers import flash, flash_alert
-from baruwa.lib.graphs import PieChart
+from baruwa.lib.graphs import build_totals_chart
 from baruwa.lib.query import UserFilter
 from baruwa.lib.audit import audit_log
 from baruwa.model.settings import Server
 from baruwa.model.status import MailQueueItem, AuditLog
-from baruwa.lib.graphs import PIE_CHART_COLORS
+from baruwa.lib.render import RenderBusyError
+from baruwa.lib.outputformats import iter_file
 from baruwa.lib.misc import check_num_param, extract_sphinx_opts
 from baruwa.lib.misc import convert_settings_to_json
 from baruwa.lib.templates.html import img_fixups
@@ -68,6 +68,9 @@ from baruwa.lib.audit.msgs.status import HOSTBAYES_MSG, AUDITLOGEXPORT_MSG
 
 log = logging.getLogger(__name__)
 
+# seconds an embedded image request waits for the preview task
+IMG_WAIT = 10
+
 LABELS = dict(clean=_('Clean'),
         highspam=_('High scoring spam'),
         lowspam=_('Low scoring spam'),
@@ -139,27 +142,11 @@ class StatusController(BaseController):
                         baruwa_totals.total) * 100, attr)))
             else:
                 labels.append('0%')
-        pie = PieChart(350, 264)
-        pie.chart.labels = labels
-        pie.chart.data = piedata
-        pie.chart.width = 180
-        pie.chart.height = 180
-        pie.chart.x = 90
-        pie.chart.y = 30
-        pie.chart.slices.strokeWidth = 1
-        pie.chart.slices.strokeColor = colors.black
-        pie.chart.slices[0].fillColor = PIE_CHART_COLORS[5]
-        pie.chart.slices[1].fillColor = PIE_CHART_COLORS[0]
-        pie.chart.slices[2].fillColor = PIE_CHART_COLORS[1]
-        pie.chart.slices[3].fillColor = PIE_CHART_COLORS[9]
-        pie.chart.slices[4].fillColor = PIE_CHART_COLORS[3]
-        self.imgfile = StringIO()
-        renderPM.drawToFile(pie,
-                            self.imgfile, 'PNG',
-                            bg=colors.HexColor('#ffffff'))
-        response.content_type = 'image/png'
-        response.headers['Cache-Control'] = 'max-age=0'
-        return self.imgfile.getvalue()
+        try:
+            return self._send_chart(build_totals_chart, piedata, labels)
+        except RenderBusyError:
+            response.headers['Retry-After'] = '30'
+            abort(503)
 
     def mailq(self, serverid=None, queue='inbound', page=1, direction='dsc',
             order_by='timestamp'):
@@ -268,47 +255,71 @@ class StatusController(BaseController):
             redirect(url('mailq-status'))
 
         try:
-            task = preview_queued_msg.apply_async(args=[mailqitem.messageid,
-                    mailqitem.direction, attachid, imgid],
-                    routing_key=mailqitem.hostname)
-            task.wait(30)
-            if task.result:
+            if imgid:
+                # embedded images can not show a progress page, they
+                # are waited on briefly and not counted as user jobs
+                task = preview_queued_msg.apply_async(
+                                args=[mailqitem.messageid,
+                                mailqitem.direction, attachid, imgid],
+                                routing_key=mailqitem.hostname)
+                wait = int(config.get('baruwa.jobs.image.wait', IMG_WAIT))
+                try:
+                    task.wait(wait)
+                except TimeoutError:
+                    response.headers['Retry-After'] = str(wait)
+                    abort(503)
+                result = task.result
+            else:
+                job = self._get_job('mailq-preview:%s:%s' % (queueid,
+                                    attachid), preview_queued_msg,
+                                    [mailqitem.messageid,
+                                    mailqitem.direction, attachid, imgid],
+                                    mailqitem.hostname)
+                if job is None:
+                    redirect(url('mailq-status'))
+                pending = self._job_pending(job, url('mailq-status'))
+                if pending is not None:
+                    return pending
+                result = job.result
+            if result:
                 if imgid:
-                    response.content_type = task.result['content_type']
-                    if task.result and 'img' in task.result:
+                    response.content_type = result['content_type']
+                    if result and 'img' in result:
                         info = QUEUEDOWNLOAD_MSG % dict(m=mailqitem.messageid,
-                                                        a=task.result['name'])
+                                                        a=result['name'])
                         audit_log(c.user.username,
                                 1, unicode(info), request.host,
                                 request.remote_addr, arrow.utcnow().datetime)
-                        return base64.decodestring(task.result['img'])
+                        return base64.decodestring(result['img'])
                     abort(404)
                 if attachid:
                     info = QUEUEDOWNLOAD_MSG % dict(m=mailqitem.messageid,
-                                                    a=task.result['name'])
+                                                    a=result['name'])
                     audit_log(c.user.username,
                             1, unicode(info), request.host,
                             request.remote_addr, arrow.utcnow().datetime)
-                    response.content_type = task.result['mimetype']
-                    dispos = 'attachment; filename="%s"' % task.result['name']
+                    response.content_type = result['mimetype']
+                    dispos = 'attachment; filename="%s"' % result['name']
                     response.headers['Content-Disposition'] = str(dispos)
-                    content_len = len(task.result['attachment'])
+                    content_len = len(result['attachment'])
                     response.headers['Content-Length'] = content_len
                     response.headers['Pragma'] = 'public'
                     response.headers['Cache-Control'] = 'max-age=0'
-                    return base64.decodestring(task.result['attachment'])
-                for part in task.result['parts']:
+                    return base64.decodestring(result['attachment'])
+                for part in result['parts']:
                     if part['type'] == 'text/html':
-                        local_rf = (not task.result['is_multipart']
+                        local_rf = (not result['is_multipart']
                                     or richformat)
                         part['content'] = img_fixups(part['content'],
                                                     queueid, allowimgs,
                                                     local_rf)
-                c.message = task.result
+                c.message = result
                 info = QUEUEPREVIEW_MSG % dict(m=mailqitem.messageid)
                 audit_log(c.user.username,
                         1, unicode(info), request.host,
                         request.remote_addr, arrow.utcnow().datetime)
+            elif imgid:
+                abort(404)
             else:
                 raise TimeoutError
         except (TimeoutError, QueueNotFound), error:
@@ -355,15 +366,21 @@ class StatusController(BaseController):
                         net={},
                         cpu=0)
         try:
-            task = systemstatus.apply_async(routing_key=server.hostname)
-            task.wait(30)
-            hoststatus = task.result
-            statusdict.update(hoststatus)
-            info = HOSTSTATUS_MSG % dict(n=server.hostname)
-            audit_log(c.user.username,
-                    1, unicode(info), request.host,
-                    request.remote_addr, arrow.utcnow().datetime)
-        except (TimeoutError, QueueNotFound):
+            job = self._get_job('systemstatus:%s' % server.id, systemstatus,
+                                routing_key=server.hostname)
+            if job is None:
+                redirect(url(controller='status'))
+            pending = self._job_pending(job, url(controller='status'))
+            if pending is not None:
+                return pending
+            hoststatus = job.result
+            if hoststatus:
+                statusdict.update(hoststatus)
+                info = HOSTSTATUS_MSG % dict(n=server.hostname)
+                audit_log(c.user.username,
+                        1, unicode(info), request.host,
+                        request.remote_addr, arrow.utcnow().datetime)
+        except QueueNotFound:
             pass
 
         jsondata = [dict(tooltip=LABELS[attr],
@@ -385,9 +402,17 @@ class StatusController(BaseController):
             abort(404)
 
         try:
-            task = bayesinfo.apply_async(routing_key=server.hostname)
-            task.wait(30)
-            result = task.result
+            job = self._get_job('bayesinfo:%s' % server.id, bayesinfo,
+                                routing_key=server.hostname)
+            if job is None:
+                redirect(url('server-status', serverid=server.id))
+            pending = self._job_pending(job, url('server-status',
+                                                serverid=server.id))
+            if pending is not None:
+                return pending
+            result = job.result
+            if result is None:
+                raise TimeoutError(job.state)
             info = HOSTBAYES_MSG % dict(n=server.hostname)
             audit_log(c.user.username,
                     1, unicode(info), request.host,
@@ -406,9 +431,17 @@ class StatusController(BaseController):
             abort(404)
 
         try:
-            task = salint.apply_async(routing_key=server.hostname)
-            task.wait(30)
-            result = task.result
+            job = self._get_job('salint:%s' % server.id, salint,
+                                routing_key=server.hostname)
+            if job is None:
+                redirect(url('server-status', serverid=server.id))
+            pending = self._job_pending(job, url('server-status',
+                                                serverid=server.id))
+            if pending is not None:
+                return pending
+            result = job.result
+            if result is None:
+                raise TimeoutError(job.state)
             info = HOSTSALINT_MSG % dict(n=server.hostname)
             audit_log(c.user.username,
                     1, unicode(info), request.host,
@@ -540,13 +573,31 @@ class StatusController(BaseController):
             audit_log(c.user.username,
                     5, unicode(AUDITLOGEXPORT_MSG), request.host,
                     request.remote_addr, arrow.utcnow().datetime)
+            try:
+                handle = open(result.result['path'], 'rb')
+            except (IOError, TypeError):
+                hostname = result.result.get('hostname')
+                if (result.result['path'] and hostname and
+                    hostname != system_hostname()):
+                    # the export directory is not shared by the nodes
+                    msg = _('The audit log export was written to %(path)s'
+                            ' on %(host)s and is not available on this'
+                            ' server, baruwa.exports.dir has to be on'
+                            ' storage shared by all the nodes') % dict(
+                            path=result.result['path'], host=hostname)
+                    flash_alert(msg)
+                    log.info(msg)
+                else:
+                    flash_alert(_('The audit log export has expired, '
+                                'export the audit log again'))
+                redirect(url('status-audit-logs'))
             response.content_type = result.result['content_type']
             response.headers['Cache-Control'] = 'max-age=0'
-            respdata = result.result['f']
             disposition = 'attachment; filename=%s' % result.result['filename']
             response.headers['Content-Disposition'] = str(disposition)
-            response.headers['Content-Length'] = len(respdata)
-            return respdata
+            response.headers['Content-Length'] = str(
+                                        os.fstat(handle.fileno()).st_size)
+            return iter_file(handle)
         return self.render('/status/auditexportstatus.html')
 
     # pylint: disable-msg=R0201
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Memory aware admission of message processing jobs
+
+Jobs estimate their memory cost from the size of the quarantined file
+and queue in a priority queue shared by all the worker processes on
+the node. A queued job is admitted as soon as its cost fits the memory
+budget, otherwise the task is retried later instead of holding its
+worker while it waits. The budget is the lesser of the memory free now
+and the total memory less the cost reserved by the running jobs, the
+running jobs are already reflected in the free memory so their
+reservations are only charged against the total. Interactive jobs are
+always admitted and release jobs are queued ahead of learn jobs.
+"""
+import os
+import json
+import time
+import errno
+import fcntl
+import threading
+
+from contextlib import contextmanager
+
+from pylons import config
+
+from baruwa.lib.misc import gen_avail_mem, gen_total_mem
+
+INTERACTIVE, RELEASE, LEARN = range(3)
+
+MB = 1024 * 1024
+# (base cost, multiple of the message size) per kind of job
+JOB_COSTS = {
+    'preview': (32 * MB, 3),
+    'release': (8 * MB, 1),
+    'learn': (96 * MB, 2),
+}
+DEFAULT_RESERVE = 128 * MB
+DEFAULT_TIMEOUT = 300
+RETRY_INTERVAL = 5
+# queued jobs that have not retried within this time are dropped
+WAIT_EXPIRE = 60
+# lockf only excludes other processes
+STATE_LOCK = threading.Lock()
+
+
+def job_cost(msgfile, kind):
+    "Estimate the memory a job will use"
+    base, factor = JOB_COSTS[kind]
+    try:
+        size = os.path.getsize(msgfile)
+    except OSError:
+        size = 0
+    return base + size * factor
+
+
+def pid_alive(pid):
+    "Check if a process is still running"
+    try:
+        os.kill(pid, 0)
+    except OSError, exception:
+        return exception.errno == errno.EPERM
+    return True
+
+
+class AdmissionController(object):
+    """Node wide memory admission controller"""
+    def __init__(self, statefile, reserve=DEFAULT_RESERVE,
+                timeout=DEFAULT_TIMEOUT):
+        "init"
+        self.statefile = statefile
+        self.reserve = reserve
+        self.timeout = timeout
+
+    @contextmanager
+    def state(self):
+        "Lock, load and on exit save the shared state"
+        with STATE_LOCK:
+            with open(self.statefile, 'a+') as handle:
+                fcntl.lockf(handle, fcntl.LOCK_EX)
+                try:
+                    handle.seek(0)
+                    try:
+                        state = json.loads(handle.read())
+                    except ValueError:
+                        state = dict(seq=0, waiting={}, running={})
+                    yield state
+                    handle.seek(0)
+                    handle.truncate()
+                    handle.write(json.dumps(state))
+                    handle.flush()
+                finally:
+                    fcntl.lockf(handle, fcntl.LOCK_UN)
+
+    @staticmethod
+    def prune(state, now):
+        """Drop the reservations of processes that have died and the
+        queued jobs that are no longer being retried"""
+        for ticket, entry in state['running'].items():
+            if not pid_alive(entry['pid']):
+                del state['running'][ticket]
+        for ticket, entry in state['waiting'].items():
+            if now - entry['seen'] > WAIT_EXPIRE:
+                del state['waiting'][ticket]
+
+    def budget(self, state):
+        "Return the memory available to newly admitted jobs"
+        reserved = sum(entry['cost'] for entry in state['running'].values())
+        return min(gen_avail_mem(), gen_total_mem() - reserved) - \
+                self.reserve
+
+    def can_admit(self, state, ticket):
+        """Check if the job holding ticket can be admitted
+
+        Queued jobs are considered in priority then arrival order and
+        the first one that fits the budget is admitted, so a job too
+        large for the memory currently available does not hold up the
+        smaller jobs queued behind it."""
+        waiting = sorted(state['waiting'].iteritems(),
+                        key=lambda item: (item[1]['priority'],
+                                        item[1]['seq']))
+        budget = self.budget(state)
+        for key, entry in waiting:
+            if entry['cost'] <= budget:
+                return key == ticket
+        return False
+
+    def admit(self, ticket, cost, priority):
+        """Admit the job holding ticket or queue it, returns True once
+        admitted and False while the job should be retried. Raises
+        OSError once the job has been queued longer than the timeout"""
+        now = time.time()
+        expired = False
+        with self.state() as state:
+            self.prune(state, now)
+            entry = state['waiting'].get(ticket)
+            if entry is None:
+                state['seq'] += 1
+                entry = state['waiting'][ticket] = dict(priority=priority,
+                                                        seq=state['seq'],
+                                                        cost=cost,
+                                                        since=now)
+            entry['seen'] = now
+            if priority == INTERACTIVE or self.can_admit(state, ticket):
+                del state['waiting'][ticket]
+                state['running'][ticket] = dict(cost=cost, pid=os.getpid())
+                return True
+            if now - entry['since'] >= self.timeout:
+                del state['waiting'][ticket]
+                expired = True
+        if expired:
+            raise OSError("Insufficient memory")
+        return False
+
+    def release(self, ticket):
+        "Return the memory reserved by a job"
+        with self.state() as state:
+            state['waiting'].pop(ticket, None)
+            state['running'].pop(ticket, None)
+
+
+def get_admission_controller():
+    "Return the admission controller for this node"
+    cache_dir = config.get('cache_dir', '/var/lib/baruwa/data')
+    reserve = int(config.get('baruwa.admission.reserve', DEFAULT_RESERVE))
+    timeout = int(config.get('baruwa.admission.timeout', DEFAULT_TIMEOUT))
+    return AdmissionController(os.path.join(cache_dir, 'admission.state'),
+                                reserve, timeout)
@@ -28,7 +28,7 @@ from baruwa.tasks.settings import (create_language_based, create_message_size,
     create_highspam_scores, create_spam_scores, create_highspam_actions,
     create_spam_actions, create_virus_checks, create_spam_checks,
     update_serial, create_lists, get_ruleset, create_content_rules,
-    create_content_ruleset, create_local_scores)
+    create_content_ruleset, create_local_scores, create_compiled_lists)
 
 
 def backend_user_update(user, force=False):
@@ -136,6 +136,8 @@ def update_ldap_backend():
 def update_lists_backend(list_type):
     """Update the required backend files"""
     create_lists.apply_async(args=[list_type], exchange=FANOUT_XCHG)
+    create_compiled_lists.apply_async(args=[list_type],
+                                    exchange=FANOUT_XCHG)
     create_domain_lists.apply_async(args=[list_type], exchange=FANOUT_XCHG)
     update_serial.apply_async(exchange=FANOUT_XCHG)
 
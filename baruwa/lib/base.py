@@ -24,17 +24,21 @@ Provides the BaseController class for subclassing.
 import os
 
 from babel.util import UTC
-from pylons import request, session, config
+from pylons import request, response, session, config, url
 from pylons import tmpl_context as c
-from pylons.i18n.translation import set_lang
+from pylons.i18n.translation import set_lang, _
 from pylons.controllers import WSGIController
 from sqlalchemy.orm.exc import NoResultFound
 from pylons.templating import render_mako as render
 from sqlalchemy.orm import joinedload_all, joinedload
 
+from baruwa.forms import Form
 from baruwa.model.meta import Session
 from baruwa.lib.dates import make_tz
+from baruwa.lib.helpers import flash_alert
+from baruwa.lib.jobs import submit_job, get_job, JobLimitError
 from baruwa.lib.misc import check_language
+from baruwa.lib.chartcache import chart_digest, get_chart_cache
 from baruwa.lib.cluster import cluster_status
 from baruwa.lib.query import DailyTotals, MailQueue
 from baruwa.lib.caching_query import FromCache
@@ -89,20 +93,20 @@ class BaseController(WSGIController):
                 return False
             return True
 
+        def is_feed():
+            "the feed calculates the totals once its wait is over"
+            routes = environ['pylons.routes_dict']
+            return (routes['controller'] == 'messages' and
+                    routes.get('action') == 'feed')
+
         self.identity = environ.get('repoze.who.identity')
         if (self.identity is not None and 'user' in self.identity and
             environ['pylons.routes_dict']['controller'] != 'error' and
             check_url()):
 
             if self.identity['user']:
-                totals = DailyTotals(Session, self.identity['user'])
-                mailq = MailQueue(Session, self.identity['user'])
-                c.baruwa_totals = totals.get()
-                c.baruwa_inbound = mailq.get(1)[0]
-                c.baruwa_outbound = mailq.get(2)[0]
-                if self.identity['user'].is_admin:
-                    c.baruwa_status = cluster_status()
-
+                if not is_feed():
+                    self._set_totals(self.identity['user'])
                 tzinfo = self.identity['user'].timezone or UTC
                 c.tzinfo = make_tz(tzinfo)
         try:
@@ -110,6 +114,17 @@ class BaseController(WSGIController):
         finally:
             Session.remove()
 
+    @staticmethod
+    def _set_totals(user):
+        "Calculate the totals shown on every page"
+        totals = DailyTotals(Session, user)
+        mailq = MailQueue(Session, user)
+        c.baruwa_totals = totals.get()
+        c.baruwa_inbound = mailq.get(1)[0]
+        c.baruwa_outbound = mailq.get(2)[0]
+        if user.is_admin:
+            c.baruwa_status = cluster_status()
+
     def _get_domain(self, domainid):
         "utility to return domain"
         try:
@@ -143,3 +158,52 @@ class BaseController(WSGIController):
     def render(self, template, **kwargs):
         "utility to render pages with theme support"
         return render(template, self.theme, **kwargs)
+
+    def _get_job(self, kind, task, args=None, routing_key=None):
+        """Return the background job running task for this request,
+        the job is dispatched on the first request and later requests
+        carry its id. Returns None if the job has expired or the user
+        has too many jobs running"""
+        owner = c.user.username
+        jobid = request.GET.get('job')
+        if jobid is not None:
+            job = get_job(jobid, owner)
+            if job is None or job.kind != kind:
+                flash_alert(_('The job requested has expired or '
+                            'does not exist'))
+                return None
+            return job
+        try:
+            return submit_job(kind, task, owner, args, routing_key)
+        except JobLimitError:
+            flash_alert(_('You have too many requests being processed, '
+                        'try again later'))
+            return None
+
+    def _job_pending(self, job, came_from=None):
+        """Render the job progress page if the job has not finished,
+        returns None once it has"""
+        if job.finished:
+            return None
+        c.job = job
+        c.job_url = url.current(job=job.id)
+        c.came_from = came_from or url('home')
+        c.form = Form(csrf_context=session)
+        return self.render('/jobs/pending.html')
+
+    def _send_chart(self, builder, *args):
+        """Send the chart built by builder(*args) as PNG, rendered
+        charts are cached by content and browsers revalidate them
+        using the content digest as the ETag"""
+        digest = chart_digest(builder, args)
+        response.headers['ETag'] = '"%s"' % digest
+        response.headers['Cache-Control'] = ('private, max-age=0, '
+                                            'must-revalidate')
+        response.headers.pop('Pragma', None)
+        if digest in request.if_none_match:
+            response.status_int = 304
+            return ''
+        pngdata = get_chart_cache().render(digest, builder, args)
+        response.content_type = 'image/png'
+        response.headers['Content-Length'] = len(pngdata)
+        return pngdata
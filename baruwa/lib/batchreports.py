@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Batch report engine
+
+Computes the report data for all the recipients of a reporting run in
+a few set based passes over the messages table instead of running the
+report queries once per recipient.
+
+Every recipient is described by a scope, the domains or the addresses
+whose messages its reports cover. One pass per report field groups
+the messages of the reporting period by the in scope sender and
+recipient domain (or address) and the field, the per recipient
+reports are then assembled in memory from the groups that touch the
+recipient's scope. Results are memoized by scope so the users that
+share the same domains share the same data.
+"""
+import datetime
+
+import arrow
+
+from sqlalchemy import func
+from sqlalchemy.sql.expression import case, and_, or_, between
+
+from baruwa.lib.misc import REPORTS
+from baruwa.lib.query import user_domains
+from baruwa.lib.render import Row
+from baruwa.model.messages import Message
+
+PIE_REPORTS = ['1', '2', '3', '4', '5', '6', '7', '8', '10']
+# reports on the recipient field only cover inbound mail
+INBOUND_REPORTS = ['5', '6', '7', '8']
+KEY_COLUMNS = {
+    'domain': ('to_domain', 'from_domain'),
+    'address': ('to_address', 'from_address'),
+}
+
+
+class ReportScope(object):
+    """The domains or addresses a recipient's reports cover"""
+    def __init__(self, kind, keys):
+        "init"
+        self.kind = kind
+        self.keys = frozenset(keys)
+
+
+def domain_scope(domain):
+    "Scope of a domain report"
+    return ReportScope('domain', [domain.name])
+
+
+def user_scope(dbsession, user):
+    """Scope of a user report, None for users whose reports can not be
+    built from the batch passes"""
+    if user.is_domain_admin:
+        return ReportScope('domain', user_domains(dbsession, user))
+    if user.is_peleb:
+        addrs = [addr.address for addr in user.addresses]
+        if [addr for addr in addrs if '+*' in addr or '-*' in addr]:
+            # tagged addresses are matched with LIKE
+            return None
+        addrs.append(user.email)
+        return ReportScope('address', addrs)
+    return None
+
+
+class BatchReports(object):
+    """Report data store for a reporting run, scopes have to be added
+    before any report is requested"""
+    def __init__(self, dbsession, num_of_days=0):
+        "init"
+        self.dbsession = dbsession
+        self.num_of_days = int(num_of_days)
+        self.keys = dict(domain=set(), address=set())
+        self.data = {}
+        self.index = {}
+        self.results = {}
+        self.frozen = False
+
+    def add(self, scope):
+        "Register a scope"
+        if self.frozen:
+            raise ValueError('Scopes can not be added once loaded')
+        self.keys[scope.kind].update(scope.keys)
+
+    def _period(self, query):
+        "Restrict a query to the reporting period"
+        if self.num_of_days > 0:
+            current_time = arrow.utcnow()
+            startdate = current_time - datetime.timedelta(
+                                            days=self.num_of_days)
+            query = query.filter(between(Message.timestamp,
+                                        startdate.datetime,
+                                        current_time.datetime))
+        return query
+
+    def _pass(self, name, kind, columns, build):
+        """Run one grouped pass over the messages of the kind of scope,
+        rows are stored as (to key, from key, values...)"""
+        self.frozen = True
+        keys = list(self.keys[kind])
+        rows = []
+        if keys:
+            tocol, fromcol = [getattr(Message, attr)
+                                for attr in KEY_COLUMNS[kind]]
+            kto = case([(tocol.in_(keys), tocol)], else_=None)
+            kfrom = case([(fromcol.in_(keys), fromcol)], else_=None)
+            query = self.dbsession.query(kto.label('kto'),
+                                        kfrom.label('kfrom'), *columns)\
+                    .filter(func._(or_(tocol.in_(keys), fromcol.in_(keys))))
+            query = build(self._period(query), kto, kfrom)
+            rows = [tuple(row) for row in query]
+        index = {}
+        for pos, row in enumerate(rows):
+            if row[0] is not None:
+                index.setdefault(('to', row[0]), []).append(pos)
+            if row[1] is not None:
+                index.setdefault(('from', row[1]), []).append(pos)
+        self.data[(name, kind)] = rows
+        self.index[(name, kind)] = index
+
+    def _load_field(self, field, kind):
+        "Group the messages by the scope keys and a report field"
+        queryfield = getattr(Message, field)
+        exclude = u'127.0.0.1' if field == 'clientip' else u''
+
+        def build(query, kto, kfrom):
+            "group by field"
+            return query.filter(queryfield != exclude)\
+                        .group_by(kto, kfrom, queryfield)
+        self._pass(field, kind, [queryfield,
+                                func.count(queryfield),
+                                func.sum(Message.size)], build)
+
+    def _load_totals(self, tmz, kind):
+        "Group the messages by the scope keys and local date"
+        ldate = func.date(func.timezone(tmz, Message.timestamp))
+
+        def build(query, kto, kfrom):
+            "group by date"
+            return query.group_by(kto, kfrom, ldate)
+        self._pass(('totals', tmz), kind, [
+            ldate,
+            func.count(Message.id),
+            func.sum(case([(Message.virusinfected > 0, 1)], else_=0)),
+            func.sum(case([(and_(Message.virusinfected == 0,
+                    Message.spam > 0), 1)], else_=0)),
+            func.sum(Message.size)], build)
+
+    def _aggregate(self, name, scope, inbound, load):
+        """Sum the values of the groups in scope by their third
+        column, memoized per scope"""
+        memokey = (name, scope.kind, scope.keys, inbound)
+        if memokey in self.results:
+            return self.results[memokey]
+        if (name, scope.kind) not in self.data:
+            load()
+        rows = self.data[(name, scope.kind)]
+        index = self.index[(name, scope.kind)]
+        directions = ('to',) if inbound else ('to', 'from')
+        positions = set()
+        for key in scope.keys:
+            for direction in directions:
+                positions.update(index.get((direction, key), ()))
+        totals = {}
+        for pos in positions:
+            row = rows[pos]
+            values = totals.setdefault(row[2], [0] * (len(row) - 3))
+            for ind, value in enumerate(row[3:]):
+                values[ind] += value or 0
+        self.results[memokey] = totals
+        return totals
+
+    def top(self, scope, reportid, limit=10):
+        "Return the top items of a pie report for a scope"
+        field = REPORTS[reportid]['address']
+        sortby = REPORTS[reportid]['sort']
+        totals = self._aggregate(field, scope, reportid in INBOUND_REPORTS,
+                                lambda: self._load_field(field, scope.kind))
+        data = [Row(address=address, count=values[0], size=values[1])
+                for address, values in totals.iteritems()]
+        data.sort(key=lambda row: (-getattr(row, sortby), row.address))
+        return data[:limit]
+
+    def totals(self, scope, tmz):
+        "Return the daily message totals for a scope, newest first"
+        totals = self._aggregate(('totals', tmz), scope, False,
+                                lambda: self._load_totals(tmz, scope.kind))
+        data = [Row(ldate=ldate, mail_total=values[0],
+                    virus_total=values[1], spam_total=values[2],
+                    total_size=values[3])
+                for ldate, values in totals.iteritems()]
+        data.sort(key=lambda row: row.ldate, reverse=True)
+        return data
@@ -30,7 +30,7 @@ def cache(localconfig=None):
         server = localconfig.get('baruwa.memcached.host', '127.0.0.1')
     else:
         server = config.get('baruwa.memcached.host', '127.0.0.1')
-    beh = {"tcp_nodelay": True, "ketama": True}
+    beh = {"tcp_nodelay": True, "ketama": True, "cas": True}
     conn = Client([server], binary=True, behaviors=beh)
     return conn
 
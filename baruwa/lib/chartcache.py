@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Content addressed cache of rendered charts
+
+A chart is identified by the digest of the function that builds it and
+the data, labels and dimensions passed to it, so a chart is only
+rendered again when what it shows changes. The PNG images are kept in
+memcached, which bounds the cache and shares it between the web
+processes, and the digest doubles as the ETag of the image.
+"""
+import hashlib
+import cPickle
+
+from pylons import config
+from pylibmc import Error as CacheError
+
+from baruwa.lib.cache import cache
+from baruwa.lib.render import get_renderer
+
+# bump when the chart builders change how charts look
+CHART_VERSION = 1
+DEFAULT_TTL = 3600
+# memcached refuses items over 1MB
+DEFAULT_MAX_ENTRY = 512 * 1024
+
+
+def chart_digest(builder, args):
+    "Return the digest identifying a chart"
+    hob = hashlib.sha1()
+    hob.update('%d:%s.%s:' % (CHART_VERSION, builder.__module__,
+                            builder.__name__))
+    hob.update(cPickle.dumps(args, cPickle.HIGHEST_PROTOCOL))
+    return hob.hexdigest()
+
+
+class ChartCache(object):
+    """Rendered chart cache"""
+    def __init__(self, ttl=DEFAULT_TTL, maxentry=DEFAULT_MAX_ENTRY):
+        "init"
+        self.ttl = ttl
+        self.maxentry = maxentry
+
+    @staticmethod
+    def _key(digest):
+        "Return the cache key of a chart"
+        return 'chart:%s' % digest
+
+    def get(self, digest):
+        "Return a cached chart or None"
+        try:
+            return cache().get(self._key(digest))
+        except CacheError:
+            return None
+
+    def set(self, digest, pngdata):
+        "Store a chart, charts larger than maxentry are not stored"
+        if len(pngdata) > self.maxentry:
+            return False
+        try:
+            return cache().set(self._key(digest), pngdata, self.ttl)
+        except CacheError:
+            return False
+
+    def render(self, digest, builder, args):
+        "Return the cached chart, rendering it on a miss"
+        pngdata = self.get(digest)
+        if pngdata is None:
+            pngdata = get_renderer().png(builder, *args)
+            self.set(digest, pngdata)
+        return pngdata
+
+
+def get_chart_cache():
+    "Return the chart cache"
+    ttl = int(config.get('baruwa.charts.cache.ttl', DEFAULT_TTL))
+    maxentry = int(config.get('baruwa.charts.cache.maxentry',
+                            DEFAULT_MAX_ENTRY))
+    return ChartCache(ttl, maxentry)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Client IP rankings
+
+The topspammers and buildwhitelist commands rank the client IPs by the
+number of messages they sent scoring above or below a threshold. The
+counts are read from the clientipstats table, which a trigger on the
+messages table keeps up to date with one row per day, client IP and
+score bucket, so a run merges a few days of small aggregates instead
+of scanning the messages. Thresholds that are not whole numbers fall
+within a bucket and are counted from the messages table.
+"""
+import os
+import datetime
+
+import arrow
+
+from cdb import cdbmake
+from sqlalchemy import func, desc, cast
+from sqlalchemy.types import BigInteger
+from sqlalchemy.sql.expression import case
+
+from baruwa.model.messages import Message
+from baruwa.model.reports import ClientIpStats
+
+PERIODS = dict(daily=1, weekly=7, monthly=28)
+
+
+def period_start(period, now=None):
+    """Return the first day of a report period, a period is made up of
+    whole days from the given number of days before today up to today
+    so it always covers the last 24 hours, 7 or 28 days"""
+    days = PERIODS.get(period, 1)
+    if now is None:
+        now = arrow.utcnow()
+    return now.date() - datetime.timedelta(days=days)
+
+
+def top_clientips(dbsession, startdate, spamscore, num, above=True):
+    """Return the client IPs and counts of the IPs that sent num or
+    more messages since startdate scoring spamscore or more, or
+    spamscore or less when above is False"""
+    if spamscore == int(spamscore):
+        threshold = int(spamscore)
+        if above:
+            count = func.sum(ClientIpStats.total)
+            inscore = ClientIpStats.score >= threshold
+        else:
+            # the threshold bucket also holds the scores just above it
+            count = func.sum(case([(ClientIpStats.score < threshold,
+                                    ClientIpStats.total)],
+                                    else_=ClientIpStats.exact))
+            inscore = ClientIpStats.score <= threshold
+        query = dbsession.query(ClientIpStats.clientip,
+                                cast(count, BigInteger).label('count'))\
+                .filter(ClientIpStats.date >= startdate)\
+                .filter(inscore)\
+                .group_by(ClientIpStats.clientip)
+    else:
+        count = func.count(Message.clientip)
+        if above:
+            inscore = Message.sascore >= spamscore
+        else:
+            inscore = Message.sascore <= spamscore
+        query = dbsession.query(Message.clientip, count.label('count'))\
+                .filter(Message.date >= startdate)\
+                .filter(inscore)\
+                .group_by(Message.clientip)
+    return query.having(count >= num).order_by(desc('count'))
+
+
+class ClientIpWriter(object):
+    """Writes the client IPs to a list or CDB file, the file is
+    replaced once complete"""
+    def __init__(self, path, format='list', include_count=False):
+        "init"
+        self.path = path
+        self.tmppath = '%s.tmp' % path
+        self.include_count = include_count
+        if format == 'cdb':
+            self.maker = cdbmake(path, self.tmppath)
+            self.handle = None
+        else:
+            self.maker = None
+            self.handle = open(self.tmppath, 'w')
+
+    def add(self, clientip, count):
+        "Add a client IP"
+        if self.maker is not None:
+            self.maker.add(clientip.encode('utf-8'), str(count))
+        elif self.include_count:
+            self.handle.write('%s\t%d\n' % (clientip, count))
+        else:
+            self.handle.write('%s\n' % clientip)
+
+    def finish(self):
+        "Complete the file"
+        if self.maker is not None:
+            self.maker.finish()
+            self.maker = None
+        else:
+            self.handle.close()
+            os.rename(self.tmppath, self.path)
@@ -18,14 +18,24 @@
 #
 
 "Cluster functions"
+import time
+
+from pylons import config
 from beaker.cache import cache_region
+from celery.result import AsyncResult
+from pylibmc import Error as CacheError
 from sqlalchemy.sql.expression import true
-from celery.exceptions import TimeoutError, QueueNotFound
+from celery.exceptions import QueueNotFound
 
+from baruwa.lib.cache import cache
+from baruwa.lib.jobs import DEFAULT_TIMEOUT
 from baruwa.model.meta import Session
 from baruwa.model.settings import Server
 from baruwa.tasks.status import systemstatus
 
+HOST_CHECK_INTERVAL = 60
+HOST_STATE_TTL = 3600
+
 
 @cache_region('system_status', 'cluster-status')
 def cluster_status():
@@ -42,15 +52,8 @@ def cluster_status():
     return True
 
 
-@cache_region('system_status', 'host-status')
-def host_status(hostname):
-    "Check host status"
-    try:
-        task = systemstatus.apply_async(routing_key=hostname)
-        task.wait(30)
-        hoststatus = task.result
-    except (TimeoutError, QueueNotFound):
-        return False
+def check_host(hoststatus):
+    "Evaluate the status reported by a node"
     # check load
     if hoststatus['load'][0] > 15:
         return False
@@ -63,3 +66,45 @@ def host_status(hostname):
         if part['percent'] >= 95:
             return False
     return True
+
+
+def host_status(hostname):
+    """Check host status
+
+    The check does not wait on the node, a status check is dispatched
+    in the background and the status it last reported is returned. A
+    node that does not answer a check within the job timeout is down.
+    """
+    key = 'host-status:%s' % hostname
+    try:
+        state = cache().get(key) or {}
+    except CacheError:
+        state = {}
+    now = time.time()
+    if state.get('taskid'):
+        result = AsyncResult(state['taskid'])
+        timeout = int(config.get('baruwa.jobs.timeout', DEFAULT_TIMEOUT))
+        if result.ready():
+            state['status'] = (result.successful() and
+                                check_host(result.result))
+            state['taskid'] = None
+        elif now - state['sent'] > timeout:
+            result.revoke()
+            state['status'] = False
+            state['taskid'] = None
+        if state['taskid'] is None:
+            state['checked'] = now
+    if (not state.get('taskid') and
+        now - state.get('checked', 0) >= HOST_CHECK_INTERVAL):
+        try:
+            task = systemstatus.apply_async(routing_key=hostname)
+            state['taskid'] = task.task_id
+            state['sent'] = now
+        except QueueNotFound:
+            state['status'] = False
+            state['checked'] = now
+    try:
+        cache().set(key, state, HOST_STATE_TTL)
+    except CacheError:
+        pass
+    return state.get('status', True)
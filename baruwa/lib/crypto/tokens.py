@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Short lived signed tokens"""
+import hmac
+import json
+import time
+import base64
+import hashlib
+
+
+def _sign(payload, secret):
+    "Sign a payload"
+    return hmac.new(secret, payload, hashlib.sha256).hexdigest()
+
+
+def _compare(first, second):
+    "Constant time string comparison"
+    if len(first) != len(second):
+        return False
+    result = 0
+    for char1, char2 in zip(first, second):
+        result |= ord(char1) ^ ord(char2)
+    return result == 0
+
+
+def make_token(data, secret, ttl=60):
+    "Create a signed token carrying data that expires after ttl seconds"
+    data = dict(data, exp=int(time.time()) + ttl)
+    payload = base64.urlsafe_b64encode(json.dumps(data))
+    return '%s.%s' % (payload, _sign(payload, secret))
+
+
+def verify_token(token, secret):
+    "Return the data carried by a token or None if invalid or expired"
+    try:
+        payload, signature = str(token).rsplit('.', 1)
+    except (ValueError, UnicodeError):
+        return None
+    if not _compare(_sign(payload, secret), signature):
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(payload))
+    except (TypeError, ValueError):
+        return None
+    if data.pop('exp', 0) < time.time():
+        return None
+    return data
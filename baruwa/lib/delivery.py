@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Scheduled report delivery pipeline
+
+The reporting commands query the report data and hand each report to
+the pipeline. Reports are rendered in a bounded number of forked child
+processes while green sender threads deliver the reports already
+rendered, each sender keeping its SMTP connection open for a batch of
+messages. The commands are monkey patched by eventlet when the app is
+loaded so the pipeline only uses green primitives.
+
+Delivered recipients are recorded in a checkpoint file so a run that
+is interrupted resumes where it stopped instead of sending the reports
+again. The checkpoint is removed once a run completes.
+"""
+import os
+import sys
+import multiprocessing
+
+import eventlet
+
+from eventlet.queue import Queue, Empty
+from marrow.mailer import Mailer
+
+from baruwa.commands import get_conf_options
+from baruwa.lib.render import fork_call, RENDER_TIMEOUT
+
+DEFAULT_BATCH = 100
+DEFAULT_SENDERS = 2
+# checkpoint entries between syncs to disk
+SYNC_EVERY = 50
+
+
+class Checkpoint(object):
+    """Recipients a reporting run has delivered to
+
+    The first line of the file identifies the run, a checkpoint left
+    by a different run is discarded."""
+    def __init__(self, path, runid):
+        "init"
+        self.path = path
+        self.runid = runid
+        self.done = set()
+        self.pending = 0
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, 0700)
+        if os.path.exists(path):
+            with open(path) as handle:
+                lines = handle.read().splitlines()
+            if lines and lines[0] == runid:
+                self.done = set(lines[1:])
+        if self.done:
+            self.handle = open(path, 'a')
+        else:
+            self.handle = open(path, 'w')
+            self.handle.write('%s\n' % runid)
+            self.sync()
+
+    def __contains__(self, key):
+        "Check if a recipient was delivered to"
+        return key in self.done
+
+    def mark(self, key):
+        "Record a delivery"
+        self.done.add(key)
+        self.handle.write('%s\n' % key)
+        self.pending += 1
+        if self.pending >= SYNC_EVERY:
+            self.sync()
+
+    def sync(self):
+        "Flush the checkpoint to disk"
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.pending = 0
+
+    def close(self, complete=False):
+        "Close the checkpoint, removing it when the run completed"
+        self.sync()
+        self.handle.close()
+        if complete:
+            os.unlink(self.path)
+
+
+class ReportPipeline(object):
+    """Render reports in child processes and deliver them from sender
+    threads, at most window reports are in flight at any time"""
+    def __init__(self, conf, checkpoint, processes=None, senders=None,
+                batch=None, window=None):
+        "init"
+        self.checkpoint = checkpoint
+        if processes is None:
+            try:
+                processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                processes = 1
+        self.processes = int(conf.get('baruwa.reports.render.processes',
+                                    processes)) or 1
+        self.timeout = int(conf.get('baruwa.reports.render.timeout',
+                                    RENDER_TIMEOUT))
+        self.senders = int(conf.get('baruwa.reports.senders',
+                                    senders or DEFAULT_SENDERS))
+        batch = int(conf.get('baruwa.reports.send.batch',
+                            batch or DEFAULT_BATCH))
+        options = get_conf_options(conf)
+        # deliver synchronously, keeping the connection open for batch
+        # messages
+        options['manager.use'] = 'immediate'
+        options['transport.pipeline'] = batch
+        self.options = options
+        self.queue = Queue(window or self.processes * 4)
+        self.results = Queue()
+        self.pool = None
+        self.threads = []
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        "Start the senders"
+        self.pool = eventlet.GreenPool(self.processes)
+        for _ in range(self.senders):
+            self.threads.append(eventlet.spawn(self._sender))
+
+    def _sender(self):
+        "Deliver rendered reports"
+        mailer = Mailer(self.options)
+        mailer.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                result, build, callback = item
+                try:
+                    emails = build(result.wait())
+                except Exception, err:
+                    print >> sys.stderr, "Error rendering report: %s" % err
+                    self.results.put((None, False, callback))
+                    continue
+                for key, email in emails:
+                    try:
+                        mailer.send(email)
+                        self.results.put((key, True, callback))
+                    except Exception, err:
+                        print >> sys.stderr, ("Error sending to: %s, "
+                                            "Error: %s" % (key, err))
+                        self.results.put((key, False, callback))
+        finally:
+            mailer.stop()
+
+    def drain(self):
+        """Run the callbacks of the deliveries that have completed and
+        record them in the checkpoint"""
+        while True:
+            try:
+                key, success, callback = self.results.get_nowait()
+            except Empty:
+                break
+            if callback is not None:
+                callback(key, success)
+            if success:
+                self.sent += 1
+                self.checkpoint.mark(key)
+            else:
+                self.failed += 1
+
+    def submit(self, func, args, build, callback=None):
+        """Render func(*args) in a child process, build(rendered)
+        returns the (recipient key, email) pairs to deliver,
+        callback(key, success) is called from this thread after each
+        delivery"""
+        self.drain()
+        result = self.pool.spawn(fork_call, func, args, self.timeout)
+        self.queue.put((result, build, callback))
+
+    def close(self):
+        """Wait for the reports in flight to be delivered, returns
+        True if all the reports were delivered"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.wait()
+        self.pool.waitall()
+        self.drain()
+        return self.failed == 0
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Live message feed
+
+One tailer thread per web process follows newly inserted messages
+using a high water mark on the message id, and keeps the most recent
+ones in a bounded buffer. Subscribers long-poll for the messages newer
+than the last id they have seen, filtered to the messages they may
+see, so the query load on the messages table no longer grows with the
+number of open browser windows.
+
+Message ids are allocated when a row is inserted, not when it is
+committed, so a row can become visible after rows with higher ids.
+Every poll re-reads all the rows above the published high water mark
+and messages are only published in id order. A gap in the ids holds
+back publication until it is filled or has stayed open for the settle
+time, after which it is treated as a rolled back insert.
+
+A subscriber that falls further behind than the buffer holds is told
+to reload instead of being sent the backlog.
+
+Each waiting subscriber holds a web worker thread, or a green thread
+under the eventlet workers, until messages arrive or the wait times
+out. baruwa.feed.max.waiters caps the waiting subscribers per process
+and has to be kept below the thread pool size on threaded servers.
+"""
+import time
+import logging
+import threading
+
+from collections import deque
+
+from pylons import config
+from sqlalchemy import func
+from sqlalchemy.orm import defer
+from sqlalchemy.exc import SQLAlchemyError
+
+from baruwa.model.meta import Session
+from baruwa.model.messages import Message
+from baruwa.lib.query import user_domains
+
+log = logging.getLogger(__name__)
+
+FEED_SIZE = 1000
+POLL_INTERVAL = 2
+IDLE_TIMEOUT = 60
+SETTLE_TIME = 5
+MAX_WAIT = 25
+MAX_WAITERS = 100
+SCOPE_TTL = 300
+
+
+class FeedBusyError(Exception):
+    """Raised when too many subscribers are waiting on the feed"""
+    pass
+
+
+class FeedScope(object):
+    """The messages a user is allowed to see"""
+    def __init__(self, dbsession, user):
+        "init"
+        self.domains = None
+        self.addrs = None
+        self.tagged = []
+        if user.is_domain_admin:
+            self.domains = set(user_domains(dbsession, user))
+        if user.is_peleb:
+            self.addrs = set([addr.address for addr in user.addresses
+                    if '+*' not in addr.address and '-*' not in addr.address])
+            self.addrs.add(user.email)
+            self.tagged = [addr.address.split('*', 1)
+                        for addr in user.addresses
+                        if '+*' in addr.address or '-*' in addr.address]
+
+    def _tagged(self, address):
+        "Match tagged addresses"
+        for prefix, suffix in self.tagged:
+            if address.startswith(prefix) and address.endswith(suffix):
+                return True
+        return False
+
+    def match(self, msg):
+        "Check if a message is in scope"
+        if (self.domains is not None and
+            msg.to_domain not in self.domains and
+            msg.from_domain not in self.domains):
+            return False
+        if self.addrs is not None:
+            for address in (msg.to_address or '', msg.from_address or ''):
+                if address in self.addrs or self._tagged(address):
+                    return True
+            return False
+        return True
+
+
+class MessageFeed(object):
+    """Tail the messages table and fan new messages out to the
+    subscribers waiting on this process"""
+    def __init__(self, size=FEED_SIZE, interval=POLL_INTERVAL,
+                idle=IDLE_TIMEOUT, max_waiters=MAX_WAITERS,
+                settle=SETTLE_TIME):
+        "init"
+        self.buffer = deque(maxlen=size)
+        self.size = size
+        self.interval = interval
+        self.idle = idle
+        self.max_waiters = max_waiters
+        self.settle = settle
+        self.cond = threading.Condition()
+        # every message newer than floor is in the buffer
+        self.floor = None
+        self.lastid = None
+        # when the gap above lastid was first seen
+        self.gapsince = None
+        self.thread = None
+        self.waiters = 0
+        self.active = 0
+
+    def start(self, since):
+        "Start the tailer thread if it is not running"
+        with self.cond:
+            self.active = time.time()
+            if self.thread is not None:
+                return
+            if self.floor is None or since < self.floor:
+                # nobody has been listening, resume from this subscriber
+                self.buffer.clear()
+                self.floor = self.lastid = since or None
+            self.thread = threading.Thread(target=self.run,
+                                        name='message-feed')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        "Poll for new messages while there are subscribers"
+        try:
+            while True:
+                with self.cond:
+                    if time.time() - self.active > self.idle:
+                        self.thread = None
+                        return
+                try:
+                    self.poll()
+                except SQLAlchemyError, error:
+                    log.info("Message feed poll failed: %s", error)
+                finally:
+                    Session.remove()
+                time.sleep(self.interval)
+        except:
+            with self.cond:
+                self.thread = None
+            raise
+
+    def poll(self):
+        "Load the messages inserted since the last poll"
+        if self.lastid is None:
+            lastid = Session.query(func.max(Message.id)).scalar() or 0
+            with self.cond:
+                self.floor = self.lastid = lastid
+                self.cond.notify_all()
+            return
+        msgs = Session.query(Message)\
+                .options(defer(Message.headers), defer(Message.spamreport))\
+                .filter(Message.id > self.lastid)\
+                .order_by(Message.id)\
+                .limit(self.size).all()
+        msgs = self.publishable(msgs, time.time())
+        if not msgs:
+            return
+        for msg in msgs:
+            Session.expunge(msg)
+        with self.cond:
+            self.buffer.extend(msgs)
+            self.lastid = msgs[-1].id
+            if len(self.buffer) == self.size:
+                self.floor = max(self.floor, self.buffer[0].id - 1)
+            self.cond.notify_all()
+
+    def publishable(self, msgs, now):
+        """Return the leading run of msgs that can be published, the
+        run stops at a gap in the ids that is younger than the settle
+        time"""
+        expected = self.lastid + 1
+        for index, msg in enumerate(msgs):
+            if msg.id != expected:
+                if self.gapsince is None:
+                    self.gapsince = now
+                if now - self.gapsince < self.settle:
+                    return msgs[:index]
+            self.gapsince = None
+            expected = msg.id + 1
+        return msgs
+
+    def _collect(self, since, match, limit):
+        "Return the buffered messages newer than since in scope"
+        msgs = []
+        for msg in reversed(self.buffer):
+            if msg.id <= since:
+                break
+            if match(msg):
+                msgs.append(msg)
+                if len(msgs) >= limit:
+                    break
+        return msgs
+
+    def wait(self, since, match, limit, timeout=MAX_WAIT):
+        """Wait up to timeout seconds for messages newer than since
+        that match, returns the messages newest first, the id to
+        resume from and whether the subscriber has to reload"""
+        self.start(since)
+        deadline = time.time() + timeout
+        with self.cond:
+            if self.waiters >= self.max_waiters:
+                raise FeedBusyError('Too many subscribers waiting')
+            self.waiters += 1
+            try:
+                while True:
+                    if self.floor is not None:
+                        if since and since < self.floor:
+                            # fell behind what the buffer holds
+                            return [], self.lastid, True
+                        since = since or self.floor
+                        msgs = self._collect(since, match, limit)
+                        if msgs:
+                            return msgs, self.lastid, False
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return [], max(since, self.lastid or 0), False
+                    self.active = time.time()
+                    self.cond.wait(min(remaining, self.interval * 5))
+            finally:
+                self.waiters -= 1
+
+
+def session_scope(sess, dbsession, user, ttl=SCOPE_TTL):
+    "Return the feed scope of the user cached in the web session"
+    cached = sess.get('feed_scope')
+    if cached is None or time.time() - cached[0] > ttl:
+        cached = (time.time(), FeedScope(dbsession, user))
+        sess['feed_scope'] = cached
+        sess.save()
+    return cached[1]
+
+
+def feed_position():
+    "Return the id a new subscriber starts following the feed from"
+    return Session.query(func.max(Message.id)).scalar() or 0
+
+
+FEED_LOCK = threading.Lock()
+FEED = []
+
+
+def get_feed():
+    "Return the message feed of this process"
+    with FEED_LOCK:
+        if not FEED:
+            FEED.append(MessageFeed(
+                int(config.get('baruwa.feed.size', FEED_SIZE)),
+                int(config.get('baruwa.feed.interval', POLL_INTERVAL)),
+                max_waiters=int(config.get('baruwa.feed.max.waiters',
+                                            MAX_WAITERS)),
+                settle=int(config.get('baruwa.feed.settle', SETTLE_TIME))))
+        return FEED[0]
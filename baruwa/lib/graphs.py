@@ -366,3 +366,40 @@ def build_spam_chart(data):
     graph.chart.data = [tuple(counts)]
     graph.chart.categoryAxis.categoryNames = scores
     return graph
+
+
+def build_pie_chart(data, sortby):
+    "Build the pie chart of a top ten report"
+    piedata = [getattr(row, sortby) for row in data]
+    total = sum(piedata)
+    labels = [("%.1f%%" % ((1.0 * getattr(row, sortby) / total) * 100))
+                for row in data]
+    chart = PieChart(350, 284)
+    chart.chart.labels = labels
+    chart.chart.data = piedata
+    chart.chart.width = 200
+    chart.chart.height = 200
+    chart.chart.x = 90
+    chart.chart.y = 30
+    chart.chart.slices.strokeWidth = 1
+    chart.chart.slices.strokeColor = colors.black
+    return chart
+
+
+def build_totals_chart(piedata, labels):
+    "Build the pie chart of the message totals by type"
+    chart = PieChart(350, 264)
+    chart.chart.labels = labels
+    chart.chart.data = piedata
+    chart.chart.width = 180
+    chart.chart.height = 180
+    chart.chart.x = 90
+    chart.chart.y = 30
+    chart.chart.slices.strokeWidth = 1
+    chart.chart.slices.strokeColor = colors.black
+    chart.chart.slices[0].fillColor = PIE_CHART_COLORS[5]
+    chart.chart.slices[1].fillColor = PIE_CHART_COLORS[0]
+    chart.chart.slices[2].fillColor = PIE_CHART_COLORS[1]
+    chart.chart.slices[3].fillColor = PIE_CHART_COLORS[9]
+    chart.chart.slices[4].fillColor = PIE_CHART_COLORS[3]
+    return chart
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Non blocking background jobs
+
+A job is a celery task dispatched on behalf of a user. The web worker
+that dispatches it returns the job id straight away instead of waiting
+for the task. The job record is kept in memcached next to the task
+result, so any web worker can report on it, time it out or cancel it.
+The list of a user's active jobs is updated with compare and set so
+that concurrent requests can not exceed the per user limit.
+"""
+import time
+import uuid
+
+from pylons import config
+from celery.result import AsyncResult
+from pylibmc import Error as CacheError
+
+from baruwa.lib.cache import cache
+from baruwa.lib.crypto.hashing import sha1
+
+PENDING = 'PENDING'
+SUCCESS = 'SUCCESS'
+FAILURE = 'FAILURE'
+TIMEOUT = 'TIMEOUT'
+CANCELLED = 'CANCELLED'
+FINISHED = (SUCCESS, FAILURE, TIMEOUT, CANCELLED)
+
+JOB_TTL = 3600
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_JOBS = 4
+CAS_RETRIES = 10
+
+
+class JobLimitError(Exception):
+    """Raised when a user has too many jobs running"""
+    pass
+
+
+def job_key(jobid):
+    "Cache key of a job record"
+    return 'job:%s' % jobid
+
+
+def owner_key(owner):
+    "Cache key of the list of a user's active jobs"
+    return 'jobs-owner:%s' % sha1(owner.encode('utf-8')
+                                if isinstance(owner, unicode) else owner)
+
+
+class Job(object):
+    """A background job"""
+    def __init__(self, jobid, kind, owner, taskid, timeout,
+                created=None, state=PENDING):
+        "init"
+        self.id = jobid
+        self.kind = kind
+        self.owner = owner
+        self.taskid = taskid
+        self.timeout = timeout
+        self.created = created or time.time()
+        self.state = state
+
+    def to_dict(self):
+        "Return the job record"
+        return dict(jobid=self.id, kind=self.kind, owner=self.owner,
+                    taskid=self.taskid, timeout=self.timeout,
+                    created=self.created, state=self.state)
+
+    def save(self):
+        "Store the job record"
+        try:
+            cache().set(job_key(self.id), self.to_dict(), JOB_TTL)
+        except CacheError:
+            pass
+
+    @property
+    def task(self):
+        "The celery result of the task"
+        return AsyncResult(self.taskid)
+
+    @property
+    def finished(self):
+        "Check if the job has finished"
+        return self.update() in FINISHED
+
+    @property
+    def result(self):
+        "The task result, None unless the job succeeded"
+        if self.update() != SUCCESS:
+            return None
+        return self.task.result
+
+    def update(self):
+        "Refresh and return the state of the job"
+        if self.state in FINISHED:
+            return self.state
+        # the task id is only set once the task has been dispatched
+        task = self.task if self.taskid else None
+        if task is not None and task.ready():
+            self.state = SUCCESS if task.successful() else FAILURE
+        elif time.time() - self.created > self.timeout:
+            if task is not None:
+                task.revoke()
+            self.state = TIMEOUT
+        else:
+            return self.state
+        self.save()
+        release_slot(self.owner, self.id)
+        return self.state
+
+    def cancel(self):
+        "Cancel the job"
+        if self.update() in FINISHED:
+            return False
+        if self.taskid:
+            self.task.revoke()
+        self.state = CANCELLED
+        self.save()
+        release_slot(self.owner, self.id)
+        return True
+
+
+def active_jobs(owner):
+    "Return the ids of a user's active jobs"
+    try:
+        return cache().get(owner_key(owner)) or []
+    except CacheError:
+        return []
+
+
+def update_slots(owner, func):
+    """Replace a user's active jobs with func(jobids) using compare
+    and set, func is called again if another request changed the list
+    in the meantime. Returns False if the list could not be updated"""
+    key = owner_key(owner)
+    try:
+        client = cache()
+        for _ in xrange(CAS_RETRIES):
+            jobids, casid = client.gets(key)
+            if jobids is None:
+                if client.add(key, func([]), JOB_TTL):
+                    return True
+            elif client.cas(key, func(list(jobids)), casid, JOB_TTL):
+                return True
+    except CacheError:
+        pass
+    return False
+
+
+def release_slot(owner, jobid):
+    "Remove a job from a user's active jobs"
+    update_slots(owner, lambda jobids: [item for item in jobids
+                                        if item != jobid])
+
+
+def get_job(jobid, owner):
+    "Return a user's job or None"
+    try:
+        data = cache().get(job_key(str(jobid)))
+    except CacheError:
+        return None
+    if not data or data['owner'] != owner:
+        return None
+    return Job(**data)
+
+
+def is_active(jobid, owner):
+    "Check if a job is still running, without refreshing its state"
+    job = get_job(jobid, owner)
+    return job is not None and job.state not in FINISHED
+
+
+def submit_job(kind, task, owner, args=None, routing_key=None,
+                timeout=None):
+    """Dispatch a task as a job for owner and return the job without
+    waiting for it, raises JobLimitError if owner has too many
+    active jobs"""
+    limit = int(config.get('baruwa.jobs.max_per_user', DEFAULT_MAX_JOBS))
+    if timeout is None:
+        timeout = int(config.get('baruwa.jobs.timeout', DEFAULT_TIMEOUT))
+    # finish off the jobs that have completed or timed out
+    for jobid in active_jobs(owner):
+        job = get_job(jobid, owner)
+        if job is not None:
+            job.update()
+    job = Job(uuid.uuid4().hex, kind, owner, None, timeout)
+    job.save()
+
+    def claim(jobids):
+        "Add the job to the active jobs if the user is within the limit"
+        jobids = [jobid for jobid in jobids if is_active(jobid, owner)]
+        if len(jobids) >= limit:
+            raise JobLimitError('Too many jobs running')
+        return jobids + [job.id]
+
+    update_slots(owner, claim)
+    options = dict(args=args or [])
+    if routing_key:
+        options['routing_key'] = routing_key
+    try:
+        result = task.apply_async(**options)
+    except:
+        release_slot(owner, job.id)
+        raise
+    job.taskid = result.task_id
+    job.save()
+    return job
@@ -71,3 +71,166 @@ class Sendmail(object):
                 self.conn.quit()
             except smtplib.SMTPServerDisconnected:
                 pass
+
+
+def format_error(exception, server):
+    "Return a readable error for an exception raised while sending"
+    if isinstance(exception, socket.gaierror):
+        return 'Unable to resolve hostname: %(h)s' % dict(h=server)
+    if isinstance(exception, socket.timeout):
+        return 'SMTP connection to: %(h)s timed out' % dict(h=server)
+    if isinstance(exception, socket.error):
+        return ERRORSAN_RE.sub('', str(exception))
+    return str(exception)
+
+
+class SMTPSession(object):
+    """Persistent SMTP session used to send a batch of messages
+
+    The connection is opened on first use and kept open between
+    messages, a RSET is issued before every transaction after the
+    first. When the server supports PIPELINING the MAIL, RCPT and
+    DATA commands are sent in a single write. A dropped connection is
+    re-established and the message retried as long as the end of data
+    marker had not been sent.
+    """
+    def __init__(self, server, debug, retries=1, chunksize=65536):
+        "init"
+        self.server = server
+        self.debug = debug
+        self.retries = retries
+        self.chunksize = chunksize
+        self.errors = []
+        self.conn = None
+        self.used = False
+        self.committed = False
+
+    def connect(self):
+        "Open the SMTP connection"
+        self.disconnect()
+        self.conn = smtplib.SMTP(self.server, timeout=30)
+        if self.debug:
+            self.conn.set_debuglevel(5)
+        self.conn.ehlo_or_helo_if_needed()
+        self.used = False
+
+    def disconnect(self):
+        "Drop the connection without saying goodbye"
+        if self.conn:
+            try:
+                self.conn.close()
+            except socket.error:
+                pass
+        self.conn = None
+
+    def envelope(self, from_addr, to_addrs):
+        "Send the envelope and the DATA command"
+        mail = 'mail FROM:%s' % smtplib.quoteaddr(from_addr)
+        rcpts = ['rcpt TO:%s' % smtplib.quoteaddr(addr) for addr in to_addrs]
+        datareply = None
+        if self.conn.has_extn('pipelining'):
+            commands = [mail] + rcpts + ['data']
+            self.conn.send(''.join(['%s\r\n' % command
+                                    for command in commands]))
+            replies = [self.conn.getreply() for _ in commands]
+            mailreply, rcptreplies, datareply = (replies[0], replies[1:-1],
+                                                replies[-1])
+        else:
+            mailreply = self.conn.docmd(mail)
+            rcptreplies = []
+            if mailreply[0] == 250:
+                rcptreplies = [self.conn.docmd(rcpt) for rcpt in rcpts]
+        refused = dict((addr, reply)
+                        for addr, reply in zip(to_addrs, rcptreplies)
+                        if reply[0] not in (250, 251))
+        if mailreply[0] != 250 or len(refused) == len(to_addrs):
+            if datareply and datareply[0] == 354:
+                # the server accepted DATA regardless, the session
+                # can not be reset so start a new one
+                self.disconnect()
+            if mailreply[0] != 250:
+                raise smtplib.SMTPSenderRefused(mailreply[0], mailreply[1],
+                                                from_addr)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if datareply is None:
+            datareply = self.conn.docmd('data')
+        code, resp = datareply
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def senddata(self, lines):
+        "Stream the message lines followed by the end of data marker"
+        buf = []
+        size = 0
+        line = smtplib.CRLF
+        for line in lines:
+            line = smtplib.quotedata(line)
+            buf.append(line)
+            size += len(line)
+            if size >= self.chunksize:
+                self.conn.send(''.join(buf))
+                buf = []
+                size = 0
+        if not line.endswith(smtplib.CRLF):
+            buf.append(smtplib.CRLF)
+        buf.append('.' + smtplib.CRLF)
+        self.committed = True
+        self.conn.send(''.join(buf))
+        code, resp = self.conn.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    def transaction(self, from_addr, to_addrs, lines):
+        "Run a single mail transaction"
+        self.committed = False
+        if self.conn is None:
+            self.connect()
+        if self.used:
+            code, resp = self.conn.rset()
+            if code != 250:
+                raise smtplib.SMTPResponseException(code, resp)
+        self.used = True
+        self.envelope(from_addr, to_addrs)
+        self.senddata(lines)
+
+    def send(self, from_addr, to_addrs, filename, prepare=None):
+        """Send a message file, prepare optionally filters the
+        lines of the file before they are sent"""
+        attempts = 0
+        while True:
+            try:
+                with open(filename, 'r') as handle:
+                    lines = prepare(handle) if prepare else handle
+                    self.transaction(from_addr, to_addrs, lines)
+                return True
+            except (smtplib.SMTPServerDisconnected, socket.error), exception:
+                self.disconnect()
+                if (self.committed or attempts >= self.retries or
+                    isinstance(exception, socket.gaierror)):
+                    self.errors.append(format_error(exception, self.server))
+                    return False
+                attempts += 1
+            except IOError:
+                self.errors.append('The quarantined message not found')
+                return False
+            except smtplib.SMTPException, exception:
+                self.errors.append(format_error(exception, self.server))
+                return False
+
+    def geterrors(self):
+        "Return errors"
+        return self.errors
+
+    def reset_errors(self):
+        "Resets errors"
+        self.errors[:] = []
+
+    def close(self):
+        "Close smtp connection"
+        if self.conn:
+            try:
+                self.conn.quit()
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                pass
+        self.conn = None
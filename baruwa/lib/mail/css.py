@@ -17,14 +17,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-"""Clean up CSS"""
+"""Clean up CSS
+
+Sanitized output is memoized in a bounded per process cache keyed by
+a digest of the input, optionally backed by memcached so that workers
+share the stylesheets bulk mail repeats across messages.
+"""
 import re
 import logging
+import threading
 import cssutils
 
+from pylons import config
 from tinycss import make_parser
+from pylibmc import Error as CacheError
+from paste.deploy.converters import asbool
 
+from baruwa.lib.cache import cache
 from baruwa.lib.regex import XSS_RE
+from baruwa.lib.crypto.hashing import sha1
 
 UNCLEANTAGS = ['html', 'title', 'head', 'body', 'base']
 
@@ -34,6 +45,115 @@ CSS_FMT = """%s {
 %s
 }
 """
+CACHE_SIZE = 4096
+SHARED_TTL = 86400
+SHARED_MAX_SIZE = 512 * 1024
+
+
+class CSSCache(object):
+    """Bounded LRU memo of sanitized CSS"""
+    def __init__(self, maxsize=CACHE_SIZE):
+        "init"
+        self.maxsize = maxsize
+        self.entries = {}
+        self.tick = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        "Return a cached value or None"
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.tick += 1
+            entry[0] = self.tick
+            return entry[1]
+
+    def set(self, key, value):
+        "Store a value evicting the least recently used quarter if full"
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= self.maxsize:
+                entries = sorted(self.entries.iteritems(),
+                                key=lambda item: item[1][0])
+                for oldkey, _ in entries[:max(self.maxsize // 4, 1)]:
+                    del self.entries[oldkey]
+            self.tick += 1
+            self.entries[key] = [self.tick, value]
+
+    def count(self, counter):
+        "Increment a hit counter"
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def clear(self):
+        "Empty the cache and reset the counters"
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        "Return the hit counters"
+        with self.lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            hitrate = (self.hits + self.shared_hits) * 100.0 / lookups \
+                        if lookups else 0.0
+            return dict(entries=len(self.entries), hits=self.hits,
+                        shared_hits=self.shared_hits, misses=self.misses,
+                        hitrate=hitrate)
+
+
+CSS_CACHE = CSSCache()
+SHARED = threading.local()
+
+
+def shared_cache():
+    "Return this thread's memcached client, pylibmc is not thread safe"
+    client = getattr(SHARED, 'client', None)
+    if client is None:
+        client = SHARED.client = cache()
+    return client
+
+
+def cache_stats():
+    "Return the CSS memo cache counters for this process"
+    return CSS_CACHE.stats()
+
+
+def memoize(kind, func, css, *args):
+    """Return func(css, *args) from the memo cache, computing and
+    storing it on a miss"""
+    if not css:
+        return func(css, *args)
+    data = [part.encode('utf-8') if isinstance(part, unicode) else part
+            for part in (css,) + args]
+    key = 'css:%s:%s' % (kind, sha1('\0'.join(data)))
+    value = CSS_CACHE.get(key)
+    if value is not None:
+        CSS_CACHE.count('hits')
+        return value
+    shared = asbool(config.get('baruwa.css.cache.shared', False))
+    if shared:
+        try:
+            value = shared_cache().get(key)
+        except CacheError:
+            shared = False
+        if value is not None:
+            CSS_CACHE.count('shared_hits')
+            CSS_CACHE.set(key, value)
+            return value
+    CSS_CACHE.count('misses')
+    value = func(css, *args)
+    CSS_CACHE.set(key, value)
+    if shared and len(value) < SHARED_MAX_SIZE:
+        try:
+            ttl = int(config.get('baruwa.css.cache.ttl', SHARED_TTL))
+            shared_cache().set(key, value, ttl)
+        except CacheError:
+            pass
+    return value
 
 
 def rule_fixup(rule, target):
@@ -57,7 +177,7 @@ def rule_fixup(rule, target):
             rule.style.removeProperty(prop)
 
 
-def sanitize_css(css, target='#email-html-part'):
+def _sanitize_css(css, target):
     "Sanitize CSS"
     parser = cssutils.parse.CSSParser(parseComments=False,
                                     loglevel=logging.FATAL)
@@ -85,9 +205,19 @@ def sanitize_css(css, target='#email-html-part'):
     return parsed.cssText
 
 
-def sanitize_style(css):
+def _sanitize_style(css):
     "Sanitize style attributes"
     parsed, _ = PARSER.parse_style_attr(css)
     styles = ("%s: %s;" % (style.name, style.value.as_css())
             for style in parsed if not XSS_RE.findall(style.value.as_css()))
     return ' '.join(styles)
+
+
+def sanitize_css(css, target='#email-html-part'):
+    "Sanitize CSS"
+    return memoize('sheet', _sanitize_css, css, target)
+
+
+def sanitize_style(css):
+    "Sanitize style attributes"
+    return memoize('style', _sanitize_style, css)
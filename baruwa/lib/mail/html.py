@@ -19,10 +19,15 @@
 
 """HTML processing functions"""
 
-from lxml.html import defs
+from lxml.html import defs, tostring
 from lxml.html.clean import Cleaner
+from lxml.etree import XMLSyntaxError
 
+from baruwa.lib.regex import XSS_RE
 from baruwa.lib.mail import local_fromstring
+from baruwa.lib.mail.css import sanitize_style, sanitize_css
+
+LINK_ATTRS = tuple(defs.link_attrs)
 
 
 class CustomCleaner(Cleaner):
@@ -46,3 +51,106 @@ def get_style(msg):
         for style in html.xpath('//style'):
             styles.append(style.text or u'')
     return u'\n'.join(styles)
+
+
+def handle_links(element, link_handler):
+    "Pass the links of an element to the link handler"
+    for attribute in LINK_ATTRS:
+        link = element.get(attribute)
+        if link:
+            link_handler(element, attribute, link.strip())
+
+
+def rewrite_links(content, link_handler):
+    "Rewrite the links in sanitized HTML content"
+    html = local_fromstring(content)
+    for element in html.iter():
+        if isinstance(element.tag, basestring):
+            handle_links(element, link_handler)
+    return tostring(html)
+
+
+class HTMLSanitizer(object):
+    """Single pass HTML sanitizer
+
+    The payload is parsed once and cleaned in place, then a single walk
+    over the tree filters the style attributes, collects the style
+    blocks and passes the links to an optional link handler. The style
+    blocks are sanitized as one stylesheet and the tree is serialized
+    once.
+    """
+    def __init__(self, remove_tags=None, target='#email-html-part',
+                link_handler=None):
+        "init"
+        safe_attrs = set(defs.safe_attrs)
+        safe_attrs.add('style')
+        self.cleaner = Cleaner(remove_tags=remove_tags or [],
+                                safe_attrs_only=True,
+                                safe_attrs=safe_attrs)
+        self.target = target
+        self.link_handler = link_handler
+
+    def body_style(self, html):
+        "Get the style and class attributes of the body tag"
+        try:
+            [body] = html.xpath('//body')
+        except ValueError:
+            return None, None
+        raw = sanitize_style(body.attrib.get('style', u''))
+        body_class = body.attrib.get('class', u'')
+        style = "%s {%s}" % (self.target, raw) if raw else u''
+        return style, body_class
+
+    def walk(self, html):
+        "Filter styles and handle links, returns the style blocks"
+        styles = []
+        blocks = []
+        # newsletters repeat the same inline styles on every row
+        inline = {}
+        for element in html.iter():
+            if not isinstance(element.tag, basestring):
+                continue
+            if element.tag == 'style':
+                styles.append(element.text or u'')
+                blocks.append(element)
+                continue
+            style = element.get('style')
+            if style is not None:
+                if style not in inline:
+                    newstyle = sanitize_style(style)
+                    if XSS_RE.findall(newstyle):
+                        newstyle = None
+                    inline[style] = newstyle
+                newstyle = inline[style]
+                if newstyle:
+                    element.set('style', newstyle)
+                else:
+                    del element.attrib['style']
+            if self.link_handler is not None:
+                handle_links(element, self.link_handler)
+        for element in blocks:
+            if element.getparent() is None:
+                element.text = None
+            else:
+                element.drop_tree()
+        return styles
+
+    def sanitize(self, payload):
+        "Sanitize HTML returning the HTML and the style sheet"
+        try:
+            html = local_fromstring(payload)
+        except XMLSyntaxError:
+            return '', ''
+        styles = []
+        body_style, body_class = self.body_style(html)
+        if body_style:
+            styles.append(body_style)
+        self.cleaner(html)
+        blocks = self.walk(html)
+        if any(blocks):
+            mainstyle = sanitize_css(u'\n'.join(blocks), self.target)
+            if mainstyle:
+                styles.append(mainstyle.decode('utf-8', 'ignore'))
+        if body_class:
+            html.attrib['class'] = body_class
+        return tostring(html).strip(), u'\n'.join(styles).strip()
@@ -26,9 +26,9 @@ import smtplib
 from eventlet.green import subprocess
 
 from baruwa.lib.misc import get_config_option, get_ipaddr
-from baruwa.lib.regex import MSGID_RE, IPV4_RE, DOM_RE
-from baruwa.lib.mail.parser import EmailParser
-from baruwa.lib.mail.backends.smtp import Sendmail
+from baruwa.lib.regex import MSGID_RE, IPV4_RE, DOM_RE, SALEARN_RE
+from baruwa.lib.mail.parser import EmailParser, MAX_DECODED_SIZE
+from baruwa.lib.mail.backends.smtp import SMTPSession
 
 
 def get_message_path(qdir, date, message_id):
@@ -69,6 +69,44 @@ def search_quarantine(date, message_id, msgfiles):
         return get_message_path(qdir, date, message_id)
 
 
+def release_lines(handle):
+    """Yield the lines of a quarantined message for release, the
+    MailScanner Message-Id header and ret-id marker are removed"""
+    for line in handle:
+        if line.endswith(' ret-id none;\n'):
+            line = line.replace(' ret-id none;', '')
+        if MSGID_RE.match(line):
+            break
+        yield line
+    for line in handle:
+        yield line
+
+
+def learn_messages(msgfiles, learnas, salearn='sa-learn'):
+    """Bayesian learn several messages with a single sa-learn run
+
+    Returns (success, learned, examined, output), messages that were
+    examined but not learned had already been learnt or were too
+    small to learn from"""
+    if learnas not in ('spam', 'ham', 'forget'):
+        return False, 0, 0, 'Unsupported learn option supplied'
+    sa_learn_cmd = [salearn, '--%s' % learnas] + list(msgfiles)
+    try:
+        pipe = subprocess.Popen(sa_learn_cmd,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = pipe.communicate()
+    except (IOError, OSError), exception:
+        return False, 0, 0, str(exception)
+    if pipe.returncode != 0:
+        return False, 0, 0, stderr
+    match = SALEARN_RE.search(stdout)
+    if match is None:
+        return True, 0, 0, stdout
+    return (True, int(match.group('learned')),
+            int(match.group('examined')), stdout)
+
+
 class ProcessQuarantinedMessage(object):
     """Process a quarantined message"""
     def __init__(self, msgfile, isdir, host='127.0.0.1', debug=None):
@@ -81,30 +119,20 @@ class ProcessQuarantinedMessage(object):
         self.debug = debug
         self.salearn = 'sa-learn'
 
-    def release(self, from_addr, to_addrs):
-        "Release message from quarantine"
+    def release(self, from_addr, to_addrs, smtp=None):
+        """Release message from quarantine, smtp is an optional
+        SMTPSession shared by a batch of releases"""
+        session = smtp or SMTPSession(self.host, self.debug)
         try:
-            messagefile = open(self.msgfile, 'r')
-            message = messagefile.readlines()
-            messagefile.close()
-            for index, line in enumerate(message):
-                if line.endswith(' ret-id none;\n'):
-                    message[index] = line.replace(' ret-id none;', '')
-                if MSGID_RE.match(line):
-                    message.pop(index)
-                    break
-            message = ''.join(message)
-
-            smtp = Sendmail(self.host, self.debug)
-            if not smtp.send(from_addr, to_addrs, message):
-                self.errors.extend(smtp.geterrors())
-                smtp.close()
+            if not session.send(from_addr, to_addrs, self.msgfile,
+                                release_lines):
+                self.errors.extend(session.geterrors())
+                session.reset_errors()
                 return False
-            smtp.close()
             return True
-        except IOError, exception:
-            self.errors.append(str(exception))
-            return False
+        finally:
+            if smtp is None:
+                session.close()
 
     def setlearncmd(self, learncmd):
         "Set the salearn command"
@@ -161,9 +189,9 @@ class ProcessQuarantinedMessage(object):
 
 class PreviewMessage(object):
     """Preview message"""
-    def __init__(self, msgfile):
+    def __init__(self, msgfile, maxsize=MAX_DECODED_SIZE):
         "init"
-        self.parser = EmailParser(msgfile)
+        self.parser = EmailParser(msgfile, maxsize)
 
     def preview(self):
         "Return message"
@@ -177,6 +205,10 @@ class PreviewMessage(object):
         "Return inline image"
         return self.parser.get_img(imageid)
 
+    def close(self):
+        "Close the message file"
+        self.parser.close()
+
 
 class TestDeliveryServers(object):
     """Test deliverying mail to a server"""
@@ -19,27 +19,24 @@
 
 """Parse an email into a dictionary structure"""
 
-import pyzmail
-
 from base64 import encodestring
 from email.utils import formataddr
 from htmlentitydefs import entitydefs
 
-# from lxml import etree
-from lxml.html.clean import Cleaner
-from lxml.etree import XMLSyntaxError
-from lxml.html import defs, tostring
+from pyzmail.parse import decode_text, decode_mail_header
+from pyzmail.parse import get_mail_addresses
 
-from baruwa.lib.crypto.hashing import md5
-from baruwa.lib.mail.html import get_style
-from baruwa.lib.mail import local_fromstring
+from baruwa.lib.mail.html import HTMLSanitizer
 from baruwa.lib.regex import HTMLTITLE_RE, HTMLENTITY_RE
-from baruwa.lib.mail.css import sanitize_style, sanitize_css
-from baruwa.lib.regex import CSS_COMMENT_RE, UNICODE_ENTITY_RE, XSS_RE
+from baruwa.lib.mail.parts import index_message, iter_payload, get_payload
+from baruwa.lib.mail.parts import find_attachment, find_image
+from baruwa.lib.regex import CSS_COMMENT_RE, UNICODE_ENTITY_RE
 
 
 UNCLEANTAGS = ['html', 'title', 'head', 'link', 'a', 'body', 'base']
 ENCODINGS = ('utf8', 'latin1', 'windows-1252', 'ascii')
+MAX_DECODED_SIZE = 10 * 1024 * 1024
+SANITIZER = HTMLSanitizer(UNCLEANTAGS)
 
 
 def html_entity_decode_char(match):
@@ -76,49 +73,6 @@ def clean_payload(payload):
     return payload
 
 
-def set_body_class(payload, body_class):
-    "Set the body class attribute to the top tag"
-    if body_class:
-        payload = local_fromstring(payload)
-        payload.attrib['class'] = body_class
-        payload = tostring(payload)
-    return payload
-
-
-def get_body_style(payload, target='#email-html-part'):
-    "Get the style attribute of the body tag"
-    try:
-        html = local_fromstring(payload)
-        [body] = html.xpath('//body')
-        raw = sanitize_style(body.attrib.get('style', u''))
-        body_class = body.attrib.get('class', u'')
-        style = "%s {%s}" % (target, raw) if raw else u''
-        return style, body_class
-    except (ValueError, XMLSyntaxError):
-        return None, None
-
-
-def clean_styles(payload):
-    "Cleanup styles"
-    if not payload:
-        return ''
-
-    html = local_fromstring(payload)
-    walker = html.getiterator()
-    for tag in walker:
-        if 'style' in tag.keys():
-            newstyle = sanitize_style(tag.get('style'))
-            if newstyle:
-                tag.set('style', newstyle)
-                if XSS_RE.findall(tag.get('style')):
-                    tag.attrib.pop('style')
-            else:
-                tag.attrib.pop('style')
-        if tag.tag == 'style':
-            tag.drop_tree()
-    return tostring(html)
-
-
 def decode(strg, encodings=ENCODINGS, charset=None):
     "Decode string"
     if charset is not None:
@@ -139,55 +93,68 @@ def sanitize_payload(payload):
     "Sanitize HTML"
     if not payload:
         return '', ''
-    styles = []
-    payload = clean_payload(payload)
-    body_style, body_class = get_body_style(payload)
-    if body_style:
-        styles.append(body_style)
-    safe_attrs = set(defs.safe_attrs)
-    safe_attrs.add('style')
-    cleaner = Cleaner(remove_tags=UNCLEANTAGS,
-                    safe_attrs_only=True,
-                    safe_attrs=safe_attrs)
-    payload = HTMLTITLE_RE.sub('', payload)
-    try:
-        html = cleaner.clean_html(payload)
-    except ValueError:
-        payload = bytes(bytearray(payload, encoding='utf-8'))
-        html = cleaner.clean_html(payload)
-    except XMLSyntaxError:
-        html = ''
-    mainstyle = sanitize_css(get_style(html))
-    if mainstyle:
-        styles.append(decode(mainstyle))
-    style = u'\n'.join(styles)
-    html = clean_styles(CSS_COMMENT_RE.sub('', html))
-    html = set_body_class(html, body_class)
-    return html.strip(), style.strip()
+    payload = HTMLTITLE_RE.sub('', clean_payload(payload))
+    return SANITIZER.sanitize(payload)
 
 
 class EmailParser(object):
-    """Parses a email message"""
-    def __init__(self, path):
+    """Parses a email message
+
+    The MIME structure is indexed in a single pass over the file and
+    part bodies are only decoded on request. maxsize caps the amount
+    of decoded content held for a message, content beyond the cap is
+    truncated and flagged as such.
+    """
+    def __init__(self, path, maxsize=MAX_DECODED_SIZE):
         if not hasattr(path, 'readlines'):
-            path = open(path, 'r')
-        self.msg = pyzmail.PyzMessage.factory(path)
+            path = open(path, 'rb')
+        self.handle = path
+        self.msg, self.mailparts = index_message(path)
+        self.maxsize = maxsize
+        self.decoded = 0
+        self.truncated = False
         self.parts = []
         self.headers = {}
         self.attachments = []
 
     def get_headers(self):
         "Get the message headers"
+        msg = self.msg.headers
         for header in ['Subject', 'To', 'From', 'Date', 'Message-ID']:
+            value = msg.get(header)
             if header in ['To', 'From']:
+                addrs = get_mail_addresses(msg, header.lower())
                 self.headers[header.lower()] = \
-                    formataddr(self.msg.get_address(header.lower()))
-            elif header == 'Subject':
-                self.headers[header.lower()] = \
-                    self.msg.get_subject()
+                    formataddr(addrs[0] if addrs else ('', ''))
+            elif value is None:
+                self.headers[header.lower()] = ''
             else:
-                self.headers[header.lower()] = \
-                    self.msg.get_decoded_header(header.lower(), '')
+                self.headers[header.lower()] = decode_mail_header(value)
+
+    def get_text(self, part):
+        """Decode a text part within the memory cap, returns the
+        payload and whether it was truncated"""
+        remaining = self.maxsize - self.decoded
+        chunks = []
+        size = 0
+        truncated = False
+        for chunk in iter_payload(self.handle, part):
+            if size + len(chunk) > remaining:
+                chunks.append(chunk[:remaining - size])
+                size = remaining
+                truncated = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        self.decoded += size
+        if truncated:
+            self.truncated = True
+        payload = ''.join(chunks)
+        try:
+            payload, _ = decode_text(payload, part.charset, None)
+        except LookupError:
+            payload, _ = decode_text(payload, None, None)
+        return payload, truncated
 
     def parse(self):
         "Parse a message and return a dict"
@@ -195,15 +162,10 @@ class EmailParser(object):
         has_html = False
 
         self.get_headers()
-        for part in self.msg.mailparts:
+        for part in self.mailparts:
             style = None
             if part.is_body:
-                try:
-                    payload, _ = pyzmail.parse.decode_text(part.get_payload(),
-                            part.charset, None)
-                except LookupError:
-                    payload, _ = pyzmail.parse.decode_text(part.get_payload(),
-                            None, None)
+                payload, truncated = self.get_text(part)
                 if part.type == 'text/html':
                     payload, style = sanitize_payload(payload)
                     has_html = True
@@ -211,30 +173,29 @@ class EmailParser(object):
                     has_text = True
                 msg = dict(type=part.type, content=payload,
                             is_body=part.is_body,
-                            style=style)
+                            style=style,
+                            truncated=truncated)
                 self.parts.append(msg)
             else:
                 viewable_parts = ('text/', 'image/', 'message/delivery-statu')
                 if (part.type.startswith(viewable_parts) and
-                    part.part.get_param('attachment', None,
+                    part.get_param('attachment', None,
                     'Content-Disposition') is None):
+                    truncated = False
                     if part.type == 'text/html':
-                        payload, _ = pyzmail.parse\
-                                        .decode_text(part.get_payload(),
-                                        part.charset, None)
+                        payload, truncated = self.get_text(part)
                         payload, style = sanitize_payload(payload)
                     elif part.type in ['text/plain',
                                         'message/delivery-status']:
-                        payload, _ = pyzmail.parse\
-                                        .decode_text(part.get_payload(),
-                                        part.charset, None)
+                        payload, truncated = self.get_text(part)
                     else:
                         payload = ''
                     msg = dict(type=part.type,
                                 content=payload,
                                 is_body=part.is_body,
                                 style=style,
-                                filename=part.sanitized_filename)
+                                filename=part.sanitized_filename,
+                                truncated=truncated)
                     self.parts.append(msg)
                 else:
                     msg = dict(type=part.type,
@@ -246,32 +207,27 @@ class EmailParser(object):
                     attachments=self.attachments,
                     content_type='message/rfc822',
                     has_text=has_text, has_html=has_html,
-                    is_multipart=is_multipart)
+                    is_multipart=is_multipart,
+                    truncated=self.truncated)
 
     def get_attachment(self, attach_id):
         "Get and return an attachment"
-        for part in self.msg.mailparts:
-            hasl = md5(part.sanitized_filename)
-            if part.is_body or (part.type.startswith('image/') and
-                            part.part.get_param('attachment', None,
-                            'Content-Disposition') is None):
-                continue
-            if hasl == attach_id:
-                return dict(attachment=encodestring(part.get_payload()),
-                            name=part.sanitized_filename,
-                            mimetype=part.type)
-        return None
+        part = find_attachment(self.mailparts, attach_id)
+        if part is None:
+            return None
+        return dict(attachment=encodestring(get_payload(self.handle, part)),
+                    name=part.sanitized_filename,
+                    mimetype=part.type)
 
     def get_img(self, imgid):
         "Return an embedded image"
-        for part in self.msg.mailparts:
-            if part.is_body:
-                continue
-            if (imgid.replace('__xoxo__', '/') in
-                (part.content_id,
-                part.filename,
-                part.sanitized_filename)):
-                return dict(content_type=part.type,
-                            img=encodestring(part.get_payload()),
-                            name=part.sanitized_filename)
-        return None
+        part = find_image(self.mailparts, imgid)
+        if part is None:
+            return None
+        return dict(content_type=part.type,
+                    img=encodestring(get_payload(self.handle, part)),
+                    name=part.sanitized_filename)
+
+    def close(self):
+        "Close the message file"
+        self.handle.close()
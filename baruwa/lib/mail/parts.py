@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""MIME part index and streaming part decoder
+
+index_message makes a single pass over a message file recording the
+headers and the body offsets of every MIME part without decoding any
+of the bodies. iter_payload then decodes a single part straight from
+the file in chunks, so a part never has to be held in memory.
+
+Parts are numbered, named and classified the same way pyzmail does,
+so attachment and image ids generated from a pyzmail parse resolve
+to the same parts.
+"""
+import string
+import binascii
+import mimetypes
+
+from email.parser import HeaderParser
+
+from pyzmail.parse import get_filename
+from pyzmail.utils import sanitize_filename, handle_filename_collision
+
+from baruwa.lib.crypto.hashing import md5
+
+CHUNK_SIZE = 65536
+B64_CHARS = string.ascii_letters + string.digits + '+/='
+NON_B64_CHARS = ''.join(chr(char) for char in range(256)
+                        if chr(char) not in B64_CHARS)
+
+
+class IndexedPart(object):
+    """A MIME part located in a message file"""
+    def __init__(self, headers, start):
+        "init"
+        self.headers = headers
+        self.start = start
+        self.end = start
+        self.children = []
+        self.type = headers.get_content_type()
+        self.charset = headers.get_param('charset')
+        self.content_id = headers.get('Content-Id')
+        if (self.content_id and self.content_id.startswith('<') and
+            self.content_id.endswith('>')):
+            self.content_id = self.content_id[1:-1]
+        self.encoding = headers.get('Content-Transfer-Encoding', '')\
+                                .strip().lower()
+        self.filename = None
+        self.sanitized_filename = None
+        self.disposition = None
+        self.is_body = False
+
+    @property
+    def size(self):
+        "Size of the encoded body"
+        return self.end - self.start
+
+    @property
+    def is_multipart(self):
+        "Is this a multipart container"
+        return (self.type.startswith('multipart/') and
+                self.headers.get_param('boundary') is not None)
+
+    def get_param(self, param, failobj=None, header='content-type'):
+        "Return a header parameter"
+        return self.headers.get_param(param, failobj, header)
+
+    def get(self, name, failobj=None):
+        "Return a header"
+        return self.headers.get(name, failobj)
+
+
+class MessageIndexer(object):
+    """Single pass MIME structure indexer"""
+    def __init__(self, handle):
+        "init"
+        self.handle = handle
+        self.offset = 0
+        self.parser = HeaderParser()
+
+    def readline(self):
+        "Read a line tracking the file offset"
+        line = self.handle.readline()
+        self.offset += len(line)
+        return line
+
+    @staticmethod
+    def match_boundary(line, boundaries):
+        """Return (boundary, is_close) if the line is a boundary
+        delimiter of one of the enclosing multiparts"""
+        if not line.startswith('--'):
+            return None
+        line = line.rstrip()
+        for boundary in reversed(boundaries):
+            if line == '--' + boundary:
+                return boundary, False
+            if line == '--' + boundary + '--':
+                return boundary, True
+        return None
+
+    def read_until_boundary(self, boundaries):
+        """Skip lines until a boundary is found, returns the boundary
+        match, the offset where the line starts and the length of the
+        line ending that precedes it"""
+        eol = 0
+        while True:
+            linestart = self.offset
+            line = self.readline()
+            if not line:
+                return None, linestart, eol
+            match = self.match_boundary(line, boundaries)
+            if match:
+                return match, linestart, eol
+            eol = len(line) - len(line.rstrip('\r\n'))
+
+    def parse_part(self, boundaries):
+        "Parse a part, returns the part and the boundary that ended it"
+        lines = []
+        while True:
+            linestart = self.offset
+            line = self.readline()
+            if not line or line in ('\n', '\r\n'):
+                break
+            match = self.match_boundary(line, boundaries)
+            if match:
+                part = IndexedPart(self.parser.parsestr(''.join(lines)),
+                                    linestart)
+                return part, match
+            lines.append(line)
+        part = IndexedPart(self.parser.parsestr(''.join(lines)), self.offset)
+        if part.is_multipart:
+            boundary = part.get_param('boundary')
+            inner = boundaries + [boundary]
+            match, _, _ = self.read_until_boundary(inner)
+            while match and match[0] == boundary and not match[1]:
+                child, match = self.parse_part(inner)
+                part.children.append(child)
+            if match and match[0] == boundary:
+                # skip the epilogue
+                match, _, _ = self.read_until_boundary(boundaries)
+            part.end = self.offset
+            return part, match
+        match, linestart, eol = self.read_until_boundary(boundaries)
+        if match:
+            part.end = max(part.start, linestart - eol)
+        else:
+            part.end = linestart
+        return part, match
+
+
+def find_bodies(contents, part):
+    """Find the text and html parts that make up the message body
+    using the same rules as pyzmail"""
+    ctype = part.type
+    if part.is_multipart:
+        if ctype == 'multipart/related':
+            start = part.get_param('start', None)
+            for index, subpart in enumerate(part.children):
+                if ((not start and index == 0) or
+                    (start and start == subpart.get('Content-Id'))):
+                    find_bodies(contents, subpart)
+                    return
+        elif ctype == 'multipart/alternative':
+            for subpart in part.children:
+                find_bodies(contents, subpart)
+        elif ctype in ('multipart/report', 'multipart/signed'):
+            if part.children:
+                find_bodies(contents, part.children[0])
+        elif ctype == 'multipart/encrypted':
+            return
+        else:
+            for subpart in part.children:
+                tmp_contents = {}
+                find_bodies(tmp_contents, subpart)
+                for key, value in tmp_contents.iteritems():
+                    if not subpart.get_param('attachment', None,
+                                            'content-disposition') == '':
+                        contents.setdefault(key, value)
+    elif not ctype.startswith('message/'):
+        contents[ctype.lower()] = part
+
+
+def get_leaves(part):
+    "Return the leaf parts in document order"
+    if part.is_multipart and not part.type.startswith('message/'):
+        leaves = []
+        for child in part.children:
+            leaves.extend(get_leaves(child))
+        return leaves
+    return [part]
+
+
+def index_message(handle):
+    """Index a message file returning the top level part and the
+    list of leaf parts"""
+    handle.seek(0)
+    indexer = MessageIndexer(handle)
+    root, _ = indexer.parse_part([])
+    contents = {}
+    find_bodies(contents, root)
+    bodies = dict((id(value), key) for key, value in contents.iteritems())
+    leaves = get_leaves(root)
+    filenames = []
+    for part in leaves:
+        if part.type.startswith('message/'):
+            part.filename = 'message.eml'
+            part.is_body = None
+        else:
+            part.filename = get_filename(part.headers)
+            if part.get_param('inline', None, 'content-disposition') == '':
+                part.disposition = 'inline'
+            elif part.get_param('attachment', None,
+                                'content-disposition') == '':
+                part.disposition = 'attachment'
+            part.is_body = bodies.get(id(part), False)
+        ext = mimetypes.guess_extension(part.type)
+        if not ext:
+            ext = '.bin'
+        elif ext == '.ksh':
+            ext = '.txt'
+        sanitized = sanitize_filename(part.filename,
+                                    part.type.split('/', 1)[0], ext)
+        sanitized = handle_filename_collision(sanitized, filenames)
+        filenames.append(sanitized.lower())
+        part.sanitized_filename = sanitized
+    return root, leaves
+
+
+def read_range(handle, start, end, chunksize=CHUNK_SIZE):
+    "Read the raw bytes between start and end in chunks"
+    handle.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = handle.read(min(chunksize, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        yield block
+
+
+def read_lines(handle, start, end):
+    "Read the raw lines between start and end"
+    handle.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        line = handle.readline(remaining)
+        if not line:
+            break
+        remaining -= len(line)
+        yield line
+
+
+def iter_payload(handle, part, chunksize=CHUNK_SIZE):
+    "Decode a part from the message file in chunks"
+    if part.encoding == 'base64':
+        pending = ''
+        for block in read_range(handle, part.start, part.end, chunksize):
+            data = pending + block.translate(None, NON_B64_CHARS)
+            usable = len(data) - len(data) % 4
+            pending = data[usable:]
+            if usable:
+                try:
+                    yield binascii.a2b_base64(data[:usable])
+                except binascii.Error:
+                    return
+        if pending.rstrip('='):
+            try:
+                yield binascii.a2b_base64(pending + '=' * (-len(pending) % 4))
+            except binascii.Error:
+                pass
+    elif part.encoding == 'quoted-printable':
+        buf = []
+        buflen = 0
+        for line in read_lines(handle, part.start, part.end):
+            decoded = binascii.a2b_qp(line)
+            buf.append(decoded)
+            buflen += len(decoded)
+            if buflen >= chunksize:
+                yield ''.join(buf)
+                buf = []
+                buflen = 0
+        if buf:
+            yield ''.join(buf)
+    else:
+        for block in read_range(handle, part.start, part.end, chunksize):
+            yield block
+
+
+def get_payload(handle, part):
+    "Return the decoded payload of a part"
+    return ''.join(iter_payload(handle, part))
+
+
+def payload_size(handle, part):
+    "Return the decoded size of a part"
+    if part.encoding not in ('base64', 'quoted-printable'):
+        return part.size
+    return sum(len(chunk) for chunk in iter_payload(handle, part))
+
+
+def is_inline_image(part):
+    "Check if a part is an inline image"
+    return (part.type.startswith('image/') and
+            part.get_param('attachment', None,
+                            'Content-Disposition') is None)
+
+
+def find_attachment(leaves, attachid):
+    "Find an attachment by its id"
+    for part in leaves:
+        if part.is_body or is_inline_image(part):
+            continue
+        if md5(part.sanitized_filename) == attachid:
+            return part
+    return None
+
+
+def find_image(leaves, imgid):
+    "Find an embedded image by its id"
+    imgid = imgid.replace('__xoxo__', '/')
+    for part in leaves:
+        if part.is_body:
+            continue
+        if imgid in (part.content_id, part.filename,
+                    part.sanitized_filename):
+            return part
+    return None
+
+
+def parse_range(header, size):
+    """Parse a single HTTP byte range, returns an inclusive
+    (start, end) tuple, None when the header is not usable
+    and raises ValueError when the range is unsatisfiable"""
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[6:].strip().partition('-')
+    try:
+        if not first:
+            start = size - int(last)
+            end = size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except (TypeError, ValueError):
+        return None
+    if not first:
+        if start >= size:
+            raise ValueError('Unsatisfiable range')
+        return max(start, 0), end
+    if start >= size or end < start:
+        raise ValueError('Unsatisfiable range')
+    return start, min(end, size - 1)
+
+
+def iter_range(chunks, start, end):
+    "Yield the bytes between start and end inclusive from chunks"
+    offset = 0
+    for chunk in chunks:
+        chunklen = len(chunk)
+        if offset + chunklen <= start:
+            offset += chunklen
+            continue
+        if offset > end:
+            break
+        yield chunk[max(start - offset, 0):end - offset + 1]
+        offset += chunklen
+
+
+class PartStreamer(object):
+    """Locate a single part in a quarantined message and
+    stream it decoded"""
+    def __init__(self, msgfile, attachid=None, imgid=None):
+        "init"
+        self.handle = open(msgfile, 'rb')
+        _, leaves = index_message(self.handle)
+        if attachid:
+            self.part = find_attachment(leaves, attachid)
+        else:
+            self.part = find_image(leaves, imgid)
+        if self.part is None:
+            self.handle.close()
+            raise LookupError('Part not found')
+        self._size = None
+
+    @property
+    def name(self):
+        "The part filename"
+        return self.part.sanitized_filename
+
+    @property
+    def content_type(self):
+        "The part content type"
+        return self.part.type
+
+    @property
+    def size(self):
+        "Decoded size of the part"
+        if self._size is None:
+            self._size = payload_size(self.handle, self.part)
+        return self._size
+
+    def stream(self, start=None, end=None, chunksize=CHUNK_SIZE):
+        "Stream the decoded part, optionally only a byte range"
+        try:
+            chunks = iter_payload(self.handle, self.part, chunksize)
+            if start is not None:
+                chunks = iter_range(chunks, start, end)
+            for chunk in chunks:
+                yield chunk
+        finally:
+            self.handle.close()
+
+    def close(self):
+        "Close the message file"
+        self.handle.close()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Persistent cache of rendered quarantine message previews
+
+Entries live on the node that holds the quarantine, one file per
+message id and quarantine file digest. The modification time of an
+entry is refreshed on every hit and the least recently used entries
+are evicted once the cache grows beyond its size limit. A running
+total of the bytes stored is kept in a size file so that the cache
+is only walked once that total crosses the limit.
+"""
+import os
+import shutil
+import hashlib
+import cPickle
+
+from pylons import config
+
+from baruwa.lib.crypto.hashing import sha1
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+DEFAULT_MAX_ENTRY = 4 * 1024 * 1024
+SIZE_FILE = '.size'
+
+
+def file_digest(filename, blocksize=65536):
+    "Return the SHA1 digest of a file's content"
+    hob = hashlib.sha1()
+    with open(filename, 'rb') as handle:
+        block = handle.read(blocksize)
+        while block:
+            hob.update(block)
+            block = handle.read(blocksize)
+    return hob.hexdigest()
+
+
+class PreviewCache(object):
+    """Rendered preview cache"""
+    def __init__(self, cachedir, maxsize=DEFAULT_MAX_SIZE,
+                maxentry=DEFAULT_MAX_ENTRY):
+        "init"
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.maxentry = maxentry
+        self.sizefile = os.path.join(cachedir, SIZE_FILE)
+
+    def _msgdir(self, messageid):
+        "Return the directory holding a message's entries"
+        return os.path.join(self.cachedir, sha1(messageid))
+
+    def _path(self, messageid, digest):
+        "Return the path to an entry"
+        return os.path.join(self._msgdir(messageid), digest)
+
+    def get(self, messageid, digest):
+        "Return a cached preview or None"
+        path = self._path(messageid, digest)
+        try:
+            with open(path, 'rb') as handle:
+                data = cPickle.load(handle)
+            os.utime(path, None)
+            return data
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            return None
+
+    def set(self, messageid, digest, data):
+        "Store a preview, entries larger than maxentry are not stored"
+        data = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+        if len(data) > self.maxentry:
+            return False
+        path = self._path(messageid, digest)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            msgdir = os.path.dirname(path)
+            if not os.path.exists(msgdir):
+                os.makedirs(msgdir, 0700)
+            with open(tmp, 'wb') as handle:
+                handle.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return False
+        if self.add_size(len(data)) > self.maxsize:
+            self.evict()
+        return True
+
+    def invalidate(self, messageid):
+        "Remove all entries for a message"
+        shutil.rmtree(self._msgdir(messageid), True)
+
+    def read_size(self):
+        "Return the running size or None if it is not known"
+        try:
+            with open(self.sizefile) as handle:
+                return int(handle.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_size(self, size):
+        "Store the running size"
+        tmp = '%s.%d.tmp' % (self.sizefile, os.getpid())
+        try:
+            with open(tmp, 'w') as handle:
+                handle.write(str(size))
+            os.rename(tmp, self.sizefile)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def add_size(self, size):
+        """Add to the running size returning the new total, the total
+        is an upper bound since replaced and invalidated entries are
+        not subtracted, it is resynchronized by evict"""
+        total = self.read_size()
+        if total is None:
+            return self.maxsize + 1
+        total += size
+        self.write_size(total)
+        return total
+
+    def evict(self):
+        "Evict the least recently used entries once over the size limit"
+        entries = []
+        total = 0
+        for dirname, _, files in os.walk(self.cachedir):
+            for filename in files:
+                path = os.path.join(dirname, filename)
+                if path == self.sizefile or filename.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total > self.maxsize:
+            entries.sort()
+            # evict down to 90% to avoid evicting on every store
+            target = self.maxsize * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                    msgdir = os.path.dirname(path)
+                    if not os.listdir(msgdir):
+                        os.rmdir(msgdir)
+                except OSError:
+                    pass
+        self.write_size(total)
+
+
+def get_preview_cache():
+    "Return the preview cache for this node"
+    cache_dir = config.get('cache_dir', '/var/lib/baruwa/data')
+    maxsize = int(config.get('baruwa.preview.cache.size',
+                            DEFAULT_MAX_SIZE))
+    maxentry = int(config.get('baruwa.preview.cache.maxentry',
+                            DEFAULT_MAX_ENTRY))
+    return PreviewCache(os.path.join(cache_dir, 'previews'),
+                        maxsize, maxentry)
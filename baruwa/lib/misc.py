@@ -68,6 +68,15 @@ def gen_avail_mem():
     return mem
 
 
+def gen_total_mem():
+    """Get total mem"""
+    try:
+        mem = psutil.virtual_memory().total
+    except Exception:
+        mem = 0
+    return mem
+
+
 def get_processes(process_name):
     "Gets running processes by process name"
     count = 0
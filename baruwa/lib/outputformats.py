@@ -18,6 +18,7 @@
 #
 """Output formats"""
 import csv
+import zlib
 
 from StringIO import StringIO
 
@@ -27,6 +28,8 @@ from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate
 # from reportlab.lib.pdfencrypt import StandardEncryption
 
+CSV_CHUNK_SIZE = 64 * 1024
+
 
 class CSVWriter:
     """A CSV writer
@@ -67,21 +70,101 @@ class SignatureCleaner(Cleaner):
                     del attrib[aname]
 
 
-def build_csv(rows, keys):
-    "Build a CSV file"
+def csv_row(row, keys):
+    "Return the utf-8 encoded values of a dict or query result row"
+    if not isinstance(row, dict):
+        row = dict(zip(row.keys(), row))
+    values = {}
+    for key in keys:
+        value = row.get(key)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        values[key] = value
+    return values
+
+
+def stream_csv(rows, keys=None, heading=None, compress=False,
+                chunksize=CSV_CHUNK_SIZE):
+    """Yield a CSV file in chunks of about chunksize bytes, gzip
+    compressed if compress is set, the columns default to the keys
+    of the first row"""
+    rows = iter(rows)
+    first = None
+    if keys is None:
+        try:
+            first = rows.next()
+        except StopIteration:
+            return
+        keys = list(first.keys())
+    if heading is None:
+        heading = dict([(key, key.capitalize()) for key in keys])
+    if compress:
+        # a wbits of 31 writes the gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    csvfile = StringIO()
     try:
-        csvfile = StringIO()
-        writer = csv.DictWriter(csvfile, keys)
-        heading = {}
-        for key in keys:
-            heading[key] = "'%s'" % key
+        writer = csv.DictWriter(csvfile, keys, extrasaction='ignore')
         writer.writerow(heading)
-        writer.writerows(rows)
-        return csvfile.getvalue()
+        if first is not None:
+            writer.writerow(csv_row(first, keys))
+        for row in rows:
+            writer.writerow(csv_row(row, keys))
+            if csvfile.tell() >= chunksize:
+                chunk = csvfile.getvalue()
+                csvfile.seek(0)
+                csvfile.truncate()
+                if compress:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+        chunk = csvfile.getvalue()
+        if compress:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
     finally:
         csvfile.close()
 
 
+def build_csv(rows, keys):
+    "Build a CSV file"
+    heading = {}
+    for key in keys:
+        heading[key] = "'%s'" % key
+    return ''.join(stream_csv(rows, keys, heading))
+
+
+class FlowableStream(list):
+    """Flowables pulled from an iterator as the document consumes
+    them, so a report is laid out without building all its flowables
+    first"""
+    def __init__(self, flowables):
+        "init"
+        list.__init__(self)
+        self.source = iter(flowables)
+
+    def __len__(self):
+        "Keep the next flowables available for keep with next checks"
+        while self.source is not None and list.__len__(self) < 2:
+            try:
+                self.append(self.source.next())
+            except StopIteration:
+                self.source = None
+        return list.__len__(self)
+
+
+def iter_file(handle, chunksize=CSV_CHUNK_SIZE):
+    "Yield the contents of a file in chunks, closing it once read"
+    try:
+        while True:
+            chunk = handle.read(chunksize)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        handle.close()
+
+
 class BaruwaPDFTemplate(SimpleDocTemplate):
     "Baruwa customization"
 
@@ -19,9 +19,14 @@
 
 "Query functions"
 
+import datetime
+
+import pytz
 import MySQLdb
 
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, cast
+from sqlalchemy.types import BigInteger
+from sphinxapi import SPH_ATTR_STRING
 from pylibmc import Error as PylibmcError
 from sqlalchemy.sql.expression import true
 from sqlalchemy.sql import and_, or_, case
@@ -35,10 +40,15 @@ from baruwa.lib.caching_query import FromCache
 from baruwa.model.accounts import domain_owners as downs
 from baruwa.model.accounts import organizations_admins as oa
 from baruwa.model.reports import MessageTotals, SrcMessageTotals
-from baruwa.model.reports import DstMessageTotals
+from baruwa.model.reports import DstMessageTotals, SaScoreHistogram
 from baruwa.lib.misc import REPORTS, crc32
 from baruwa.lib.regex import CLEANQRE, EXIM_MSGID_RE, SQL_URL_RE, TAGGED_RE
 
+# report filter fields the score histogram can serve
+HISTOGRAM_FILTERS = ('date',)
+
+SPHINX_MAX_MATCHES = 10000
+
 
 class DynaQuery(object):
     "dynamic queries"
@@ -139,6 +149,23 @@ class DynaQuery(object):
         return self.query
 
 
+def user_domains(dbsession, user):
+    "Return the active domains and domain aliases a domain admin manages"
+    dquery = dbsession.query(Domain).join(downs,
+            (oa, downs.c.organization_id == oa.c.organization_id))\
+            .filter(Domain.status == true())\
+            .filter(oa.c.user_id == user.id).all()
+    domains = []
+    for domain in dquery:
+        domains.append(domain.name)
+        for domain_alias in domain.aliases:
+            if domain_alias.status:
+                domains.append(domain_alias.name)
+    if not domains:
+        domains.append('xx')
+    return domains
+
+
 class UserFilter(object):
     "filter user query"
     def __init__(self, dbsession, user, query, archived=None, model=None):
@@ -217,18 +244,7 @@ class UserFilter(object):
     def filter(self):
         "Set filters"
         if self.user.is_domain_admin:
-            dquery = self.dbsession.query(Domain).join(downs,
-                    (oa, downs.c.organization_id == oa.c.organization_id))\
-                    .filter(Domain.status == true())\
-                    .filter(oa.c.user_id == self.user.id).all()
-            domains = []
-            for domain in dquery:
-                domains.append(domain.name)
-                for domain_alias in domain.aliases:
-                    if domain_alias.status:
-                        domains.append(domain_alias.name)
-            if not domains:
-                domains.append('xx')
+            domains = user_domains(self.dbsession, self.user)
             if self.direction and self.direction == 'in':
                 self.query = self.query\
                             .filter(self.model.to_domain.in_(domains))
@@ -540,8 +556,38 @@ class MsgCount(object):
         return int(value.total or 0)
 
 
-def sa_scores(dbsession, user):
-    "SA scores query"
+def sa_histogram(dbsession, user, filters):
+    """SA scores query served from the score histogram, None when the
+    user or the filters need the messages"""
+    if user.is_peleb:
+        return None
+    if [filt for filt in filters if filt['field'] not in HISTOGRAM_FILTERS]:
+        return None
+    total = func.sum(SaScoreHistogram.total)
+    query = dbsession.query(SaScoreHistogram.score.label('score'),
+            cast(total, BigInteger).label('count'))\
+            .group_by(SaScoreHistogram.score)\
+            .having(total > 0)\
+            .order_by(SaScoreHistogram.score)
+    if user.is_domain_admin:
+        domains = user_domains(dbsession, user)
+        query = query.filter(func._(or_(
+                            SaScoreHistogram.to_domain.in_(domains),
+                            SaScoreHistogram.from_domain.in_(domains))))
+    if filters:
+        dynq = DynaQuery(SaScoreHistogram, query, filters)
+        query = dynq.generate()
+    return query
+
+
+def sa_scores(dbsession, user, filters=None, histogram=False):
+    """SA scores query, served from the score histogram if enabled
+    and it can serve the filters"""
+    filters = filters or []
+    if histogram:
+        query = sa_histogram(dbsession, user, filters)
+        if query is not None:
+            return query
     query = dbsession.query(func.round(Message.sascore).label('score'),
             func.count('score').label('count'))\
             .filter(Message.scaned == 1)\
@@ -550,6 +596,9 @@ def sa_scores(dbsession, user):
 
     uquery = UserFilter(dbsession, user, query)
     query = uquery.filter()
+    if filters:
+        dynq = DynaQuery(Message, query, filters)
+        query = dynq.generate()
     return query
 
 
@@ -572,6 +621,18 @@ def message_totals(dbsession, user):
     return query
 
 
+def stream_query(query, batch=500):
+    """Iterate the rows of a query in batches from a server side
+    cursor, the query is run on a session of its own so the rows can
+    be streamed after the request's session is removed"""
+    session = Session.session_factory()
+    try:
+        for row in query.with_session(session).yield_per(batch):
+            yield row
+    finally:
+        session.close()
+
+
 def get_dom_crcs(dbsession, user):
     "Calc CRC32 for domains"
     domains = dbsession.query(Domain).join(downs,
@@ -586,24 +647,98 @@ def get_dom_crcs(dbsession, user):
     return crcs
 
 
-def filter_sphinx(dbsession, user, conn):
-    "Set Sphinx filters"
+def filter_sphinx(dbsession, user, conn, fields=None):
+    """Set Sphinx filters, fields is an optional select list to
+    return along with the filter expression"""
+    select = None
     if user.is_domain_admin:
         crcs = get_dom_crcs(dbsession, user)
         if not crcs:
             crcs.append(crc32('xx'))
         addrs = ', '.join([str(crc) for crc in crcs])
         select = 'IN(from_dom,%s) OR IN(to_dom,%s) AS cond2' % (addrs, addrs)
-        conn.SetSelect(str(select))
-        conn.SetFilter('cond2', [1])
+        cond = 'cond2'
     if user.is_peleb:
         # crcs = [str(crc32(address.address)) for address in user.addresses]
         # crcs.append(str(crc32(user.email)))
         crcs = get_tagged_addrs(user)
         addrs = ', '.join(crcs)
         select = 'IN(from_addr,%s) OR IN(to_addr,%s) AS cond1' % (addrs, addrs)
+        cond = 'cond1'
+    if select is not None:
+        if fields:
+            select = '%s, %s' % (fields, select)
         conn.SetSelect(str(select))
-        conn.SetFilter('cond1', [1])
+        conn.SetFilter(cond, [1])
+
+
+def has_sphinx_attrs(results, attrs, strings=()):
+    """Check that the index schema of a Sphinx result carries attrs
+    and that those in strings are stored as strings"""
+    schema = dict((attr[0], attr[1]) for attr in results.get('attrs', []))
+    for attr in attrs:
+        if attr not in schema:
+            return False
+    for attr in strings:
+        if schema.get(attr) != SPH_ATTR_STRING:
+            return False
+    return True
+
+
+class SphinxMatch(object):
+    """A result row built from the attributes of a Sphinx match, so
+    listings can be rendered without loading the rows from the
+    database. names maps index attributes to model attributes"""
+    names = {}
+    attrs = ()
+    strings = ()
+
+    def __init__(self, match):
+        "init"
+        self.id = match['id']
+        for attr, value in match['attrs'].iteritems():
+            if isinstance(value, str):
+                value = value.decode('utf-8', 'replace')
+            setattr(self, self.names.get(attr, attr), value)
+
+    @classmethod
+    def usable(cls, results):
+        "Check if the results can be rendered from the index"
+        return has_sphinx_attrs(results, cls.attrs, cls.strings)
+
+    @classmethod
+    def from_results(cls, results):
+        "Return the rows of a Sphinx result"
+        return [cls(match) for match in results['matches']]
+
+
+class SphinxMessage(SphinxMatch):
+    """A message listing row"""
+    names = dict(sender='from_address',
+                recipient='to_address',
+                subj='subject')
+    attrs = ('timestamp', 'sender', 'recipient', 'subj', 'size', 'sascore',
+            'spam', 'highspam', 'virusinfected', 'nameinfected',
+            'otherinfected', 'whitelisted', 'blacklisted', 'scaned')
+    strings = ('sender', 'recipient', 'subj')
+
+    def __init__(self, match):
+        "init"
+        super(SphinxMessage, self).__init__(match)
+        self.timestamp = datetime.datetime.fromtimestamp(self.timestamp,
+                                                        pytz.UTC)
+
+
+class SphinxList(SphinxMatch):
+    """An approved/banned senders list row"""
+    attrs = ('from_address', 'to_address', 'list_type', 'user_id')
+    strings = ('from_address', 'to_address')
+
+    def tojson(self):
+        "Return json"
+        return dict(id=self.id,
+                    from_address=self.from_address,
+                    to_address=self.to_address)
 
 
 def clean_sphinx_q(query):
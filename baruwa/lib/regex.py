@@ -83,6 +83,9 @@ CONFIG_RE = re.compile(r'[^%a-zA-Z0-9]')
 
 MSGID_RE = re.compile(r'^(?:Message-Id\:\s+.+)$', re.IGNORECASE)
 
+SALEARN_RE = re.compile(r'(?:Learned|Forgot) tokens from (?P<learned>\d+) '
+    r'message\(s\) \((?P<examined>\d+) message\(s\) examined\)')
+
 HTMLTITLE_RE = re.compile(r'<title>.+</title>', re.IGNORECASE)
 
 QDIR = re.compile(r"^\d{8}$")
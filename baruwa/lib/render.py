@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Report rendering service
+
+reportlab keeps its font and renderer state in module globals so
+charts and PDF reports can not be rendered by several threads of a
+process at once. Each render is run in a child process forked for it
+instead, with its own copy of that state, so reports are rendered in
+parallel on all the cores of the node.
+
+The web process is monkey patched by eventlet, a multiprocessing pool
+would block its hub in the pool's handler threads. The child sends its
+result back over a pipe that is read cooperatively, the other requests
+of the web process are served while a render is running.
+
+The number of renders in flight per web process is bounded, a request
+that can not get a render slot within the queue timeout fails with
+RenderBusyError instead of holding the web thread indefinitely. A
+render that does not complete within the render timeout fails with
+RenderError and its child process is killed.
+"""
+import os
+import time
+import signal
+import cPickle
+import logging
+import threading
+import multiprocessing
+
+from cStringIO import StringIO
+
+import eventlet
+
+from eventlet.green import os as green_os
+from pylons import config
+from reportlab.lib import colors
+from reportlab.graphics import renderPM
+
+from baruwa.lib.graphs import PDFReport
+
+log = logging.getLogger(__name__)
+
+QUEUE_TIMEOUT = 10
+RENDER_TIMEOUT = 60
+# serializes renders when the pool is disabled
+RENDER_LOCK = threading.RLock()
+
+
+class RenderBusyError(Exception):
+    """Raised when no render slot frees up within the queue timeout"""
+    pass
+
+
+class RenderError(Exception):
+    """Raised when a render fails or does not complete in time"""
+    pass
+
+
+class Row(object):
+    """A picklable copy of a query result row"""
+    def __init__(self, **kwargs):
+        "init"
+        self.__dict__.update(kwargs)
+
+
+def to_rows(data):
+    "Copy query results into plain rows for the render processes"
+    rows = []
+    for item in data:
+        if isinstance(item, dict):
+            rows.append(Row(**item))
+        else:
+            rows.append(Row(**dict(zip(item.keys(), item))))
+    return rows
+
+
+def draw_png(builder, args):
+    "Build a chart and render it as PNG"
+    chart = builder(*args)
+    imgfile = StringIO()
+    try:
+        renderPM.drawToFile(chart, imgfile, 'PNG',
+                            bg=colors.HexColor('#FFFFFF'))
+        return imgfile.getvalue()
+    finally:
+        imgfile.close()
+
+
+def draw_pdf(logo, title, sections):
+    "Build a PDF report from (data, title, headers, sortby, chart) sections"
+    pdfcreator = PDFReport(logo, title)
+    for data, heading, headers, sortby, chart in sections:
+        pdfcreator.add(data, heading, headers, sortby, chart)
+    return pdfcreator.build()
+
+
+def run_child(wfd, func, args):
+    "Run func(*args) in the forked child and send the result to wfd"
+    status = 1
+    try:
+        # leave signal handling to the parent
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            result = (True, func(*args))
+        except Exception, err:
+            result = (False, '%s: %s' % (err.__class__.__name__, err))
+        data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        offset = 0
+        while offset < len(data):
+            offset += os.write(wfd, data[offset:offset + 65536])
+        status = 0
+    finally:
+        os._exit(status)
+
+
+def fork_call(func, args, timeout=None):
+    """Run func(*args) in a forked child process and return its result,
+    the child is killed if it does not complete within timeout seconds
+
+    The result is read from the child cooperatively so other green
+    threads keep running during the call. The child does not run the
+    hub it inherits, func must not block on green I/O."""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        run_child(wfd, func, args)
+    os.close(wfd)
+    pipe = green_os.fdopen(rfd, 'rb')
+    reaped = False
+    try:
+        with eventlet.Timeout(timeout, RenderError('Render timed out')):
+            data = pipe.read()
+            green_os.waitpid(pid, 0)
+            reaped = True
+    finally:
+        pipe.close()
+        if not reaped:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            green_os.waitpid(pid, 0)
+    try:
+        success, result = cPickle.loads(data)
+    except (EOFError, cPickle.UnpicklingError):
+        raise RenderError('Render process exited without a result')
+    if not success:
+        raise RenderError(result)
+    return result
+
+
+class RenderSlots(object):
+    """Bounded render slots with a queue timeout"""
+    def __init__(self, size):
+        "init"
+        self.size = size
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, timeout):
+        "Wait up to timeout seconds for a slot"
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.used >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            self.used += 1
+            return True
+
+    def release(self):
+        "Free a slot"
+        with self.cond:
+            self.used -= 1
+            self.cond.notify()
+
+
+class RenderService(object):
+    """Runs renders in child processes forked by this web process"""
+    def __init__(self, processes, concurrency=None,
+                queue_timeout=QUEUE_TIMEOUT, timeout=RENDER_TIMEOUT):
+        "init"
+        self.processes = processes
+        self.slots = RenderSlots(concurrency or processes or 1)
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+
+    def run(self, func, *args):
+        "Run func(*args) in a child process once a slot is free"
+        if not self.slots.acquire(self.queue_timeout):
+            raise RenderBusyError('No render slot available')
+        try:
+            if not self.processes:
+                with RENDER_LOCK:
+                    return func(*args)
+            try:
+                return fork_call(func, args, self.timeout)
+            except RenderError, err:
+                log.info("Render of %s failed: %s", func.__name__, err)
+                raise
+        finally:
+            self.slots.release()
+
+    def png(self, builder, *args):
+        "Render the chart returned by builder(*args) as PNG"
+        return self.run(draw_png, builder, args)
+
+    def pdf(self, logo, title, sections):
+        "Render a PDF report"
+        return self.run(draw_pdf, logo, title, sections)
+
+
+SERVICE_LOCK = threading.Lock()
+SERVICE = []
+
+
+def get_renderer():
+    "Return the render service of this process"
+    with SERVICE_LOCK:
+        if not SERVICE:
+            try:
+                default = multiprocessing.cpu_count()
+            except NotImplementedError:
+                default = 1
+            processes = int(config.get('baruwa.reports.render.processes',
+                                        default))
+            SERVICE.append(RenderService(
+                processes,
+                int(config.get('baruwa.reports.render.concurrency',
+                                processes)),
+                int(config.get('baruwa.reports.render.queue.timeout',
+                                QUEUE_TIMEOUT)),
+                int(config.get('baruwa.reports.render.timeout',
+                                RENDER_TIMEOUT))))
+        return SERVICE[0]
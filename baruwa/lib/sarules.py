@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""In memory SpamAssassin rule dictionary
+
+The rule descriptions are loaded once per process and reloaded only
+when the version stamp kept in memcached changes, which happens every
+time update-sa-rules modifies the sarules table.
+"""
+import time
+import threading
+
+from pylibmc import Error as CacheError
+
+from baruwa.model.meta import Session
+from baruwa.lib.cache import cache
+from baruwa.model.messages import SARule
+from baruwa.lib.regex import SARULE_RE, SPAM_REPORT
+
+VERSION_KEY = 'sarules-version'
+CHECK_INTERVAL = 60
+
+RULES_LOCK = threading.Lock()
+RULES = dict(version=None, checked=0, loaded=False, descriptions={})
+
+
+def bump_rules_version(localconfig=None):
+    "Update the rules version stamp so processes reload the rules"
+    try:
+        cache(localconfig).set(VERSION_KEY, str(time.time()))
+    except CacheError:
+        pass
+
+
+def get_rules_version():
+    "Return the current rules version stamp"
+    try:
+        return cache().get(VERSION_KEY)
+    except CacheError:
+        return RULES['version']
+
+
+def load_rules():
+    "Load the rule descriptions from the database"
+    query = Session.query(SARule.id, SARule.description)
+    return dict((rule.id, rule.description or u'') for rule in query)
+
+
+def get_rules():
+    "Return the rule dictionary, reloading it if it is stale"
+    now = time.time()
+    if RULES['loaded'] and now - RULES['checked'] < CHECK_INTERVAL:
+        return RULES['descriptions']
+    with RULES_LOCK:
+        if RULES['loaded'] and now - RULES['checked'] < CHECK_INTERVAL:
+            return RULES['descriptions']
+        version = get_rules_version()
+        if not RULES['loaded'] or version != RULES['version']:
+            RULES['descriptions'] = load_rules()
+            RULES['version'] = version
+            RULES['loaded'] = True
+        RULES['checked'] = now
+    return RULES['descriptions']
+
+
+def resolve_rules(rules):
+    """Resolve a list of 'RULE score' strings into
+    (rule, score, description) tuples"""
+    descriptions = get_rules()
+    resolved = []
+    for rule in rules:
+        match = SARULE_RE.match(rule.strip())
+        if match and match.groups()[1] != 'required':
+            rule = match.groups()[1]
+            resolved.append((rule, match.groups()[3],
+                            descriptions.get(rule, u'')))
+    return resolved
+
+
+def resolve_spam_report(report):
+    """Resolve a message spam report into a list of
+    (rule, score, description) tuples"""
+    if not report:
+        return []
+    match = SPAM_REPORT.search(report)
+    if match:
+        return resolve_rules(match.groups()[0].split(','))
+    return []
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Compiled approved/banned sender lists
+
+The compiler turns List rows into a single cdb file. Every entry is
+keyed by its kind, the recipient scope it applies to and the sender
+value, so a lookup is a handful of constant time cdb probes no matter
+how many entries the list holds.
+
+Key layout, fields separated by a tab:
+
+    e  scope  address                exact sender address
+    d  scope  domain                 sender domain
+    s  scope  suffix                 sender domain wildcard suffix
+    n  scope  version  plen  netint  network in CIDR form
+    p  scope  version                prefix lengths present in scope
+
+The scope is the recipient address, the recipient domain or 'any'.
+
+cdb files can not be modified once written, so a list edit rebuilds
+the whole file of that list type (approvedsenders.cdb or
+bannedsenders.cdb). The rebuild streams the list in id windows and
+the new file replaces the old one atomically, keeping a single file
+per list type so a lookup never has to consult more than one file.
+"""
+
+import cdb
+
+from IPy import IP
+from cdb import cdbmake
+
+SEP = '\t'
+
+
+def make_key(*parts):
+    "Build a cdb key"
+    return SEP.join(parts)
+
+
+def range_to_cidrs(start, end, bits):
+    """Split an inclusive integer range into (network, prefixlen)
+    tuples covering exactly that range"""
+    cidrs = []
+    while start <= end:
+        size = bits
+        while size > 0:
+            mask = (1 << (bits - size + 1)) - 1
+            if start & mask or start + mask > end:
+                break
+            size -= 1
+        cidrs.append((start, size))
+        start += 1 << (bits - size)
+    return cidrs
+
+
+def parse_network(value):
+    """Return a list of (version, network, prefixlen) tuples for an
+    IP address, network or range, or None if value is not one"""
+    try:
+        if '-' in value:
+            first, last = [IP(part.strip()) for part in value.split('-', 1)]
+            if first.version() != last.version():
+                return None
+            bits = 32 if first.version() == 4 else 128
+            return [(first.version(), net, plen) for net, plen in
+                    range_to_cidrs(first.int(), last.int(), bits)]
+        addr = IP(value.replace(' ', ''), make_net=True)
+        return [(addr.version(), addr.int(), addr.prefixlen())]
+    except ValueError:
+        return None
+
+
+def classify(value):
+    """Classify a sender list value returning (kind, value)
+    kind is one of e, d, s or n"""
+    value = value.strip().lower()
+    if '@' in value:
+        local, domain = value.rsplit('@', 1)
+        if local != '*':
+            return 'e', value
+        value = domain
+    if value.startswith('*.'):
+        return 's', value[1:]
+    if value.startswith('.'):
+        return 's', value
+    networks = parse_network(value)
+    if networks:
+        return 'n', networks
+    return 'd', value
+
+
+def entry_keys(item):
+    "Generate the cdb keys for a list item"
+    scope = (item.to_address or u'any').strip().lower()
+    if scope.startswith('*@'):
+        scope = scope[2:]
+    scope = scope.encode('utf-8')
+    kind, value = classify(item.from_address)
+    if kind == 'n':
+        for version, net, plen in value:
+            yield (make_key('n', scope, str(version), str(plen), str(net)),
+                    (scope, version, plen))
+    else:
+        yield make_key(kind, scope, value.encode('utf-8')), None
+
+
+def compile_lists(items, dest):
+    """Compile list items into a cdb file at dest
+
+    The file is built in dest.tmp and renamed into place by
+    cdbmake so readers never see a partial file. Returns the
+    number of entries written."""
+    maker = cdbmake(dest, dest + ".tmp")
+    prefixes = set()
+    count = 0
+    for item in items:
+        value = str(item.id)
+        for key, prefix in entry_keys(item):
+            maker.add(key, value)
+            if prefix is not None:
+                prefixes.add(prefix)
+            count += 1
+    for scope, version, plen in prefixes:
+        maker.add(make_key('p', scope, str(version)), str(plen))
+    maker.finish()
+    del(maker)
+    return count
+
+
+def to_str(value):
+    "Encode unicode values for use in cdb keys"
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def parent_domains(domain):
+    "Return the strict parent suffixes of a domain"
+    parts = domain.split('.')
+    return ['.' + '.'.join(parts[index:])
+            for index in range(1, len(parts))]
+
+
+class SenderListLookup(object):
+    """Lookup API over a compiled sender list file
+
+    >>> lookup = SenderListLookup(
+    ...     '/var/lib/baruwa/data/db/approvedsenders.cdb')
+    >>> lookup.match('user@example.com', 'rcpt@example.net', '10.0.0.1')
+    """
+    def __init__(self, filename):
+        "Init"
+        self.filename = filename
+        self.db = cdb.init(filename)
+
+    def reload(self):
+        "Reopen the cdb file after it has been rebuilt"
+        self.db = cdb.init(self.filename)
+
+    def _match_ip(self, scope, clientip):
+        "Match an IP address against networks in scope"
+        version = str(clientip.version())
+        bits = 32 if clientip.version() == 4 else 128
+        ipint = clientip.int()
+        for plen in self.db.getall(make_key('p', scope, version)):
+            mask = ((1 << int(plen)) - 1) << (bits - int(plen))
+            key = make_key('n', scope, version, plen, str(ipint & mask))
+            value = self.db.get(key)
+            if value is not None:
+                return value
+        return None
+
+    def _match_scope(self, scope, sender, domain, suffixes, clientip):
+        "Match within a single scope"
+        value = self.db.get(make_key('e', scope, sender))
+        if value is None and domain:
+            value = self.db.get(make_key('d', scope, domain))
+        if value is None:
+            for suffix in suffixes:
+                value = self.db.get(make_key('s', scope, suffix))
+                if value is not None:
+                    break
+        if value is None and clientip is not None:
+            value = self._match_ip(scope, clientip)
+        return value
+
+    def match(self, sender, recipient=None, clientip=None):
+        """Return the id of the list entry matching the sender,
+        recipient and client IP, or None"""
+        sender = to_str(sender or '').strip().lower()
+        domain = sender.rsplit('@', 1)[-1] if '@' in sender else ''
+        suffixes = parent_domains(domain) if domain else []
+        scopes = []
+        if recipient:
+            recipient = to_str(recipient).strip().lower()
+            scopes.append(recipient)
+            if '@' in recipient:
+                scopes.append(recipient.rsplit('@', 1)[1])
+        scopes.append('any')
+        if clientip:
+            try:
+                clientip = IP(clientip)
+            except ValueError:
+                clientip = None
+        for scope in scopes:
+            value = self._match_scope(scope, sender, domain,
+                                        suffixes, clientip)
+            if value is not None:
+                return int(value)
+        return None
@@ -32,12 +32,9 @@ from beaker.cache import cache_region
 from pyparsing import Word, alphas, restOfLine, Suppress
 from pyparsing import Group, SkipTo, Or, CaselessLiteral
 
-from baruwa.model import Session
-from baruwa.model.messages import SARule
 from baruwa.lib.misc import geoip_lookup, wrap_string
-from baruwa.lib.caching_query import FromCache
-from baruwa.lib.regex import RBL_RE, SARULE_RE
-from baruwa.lib.regex import LEARN_RE, SPAM_REPORT, FIND_IPS_RE
+from baruwa.lib.sarules import resolve_rules, resolve_spam_report
+from baruwa.lib.regex import RBL_RE, LEARN_RE, FIND_IPS_RE
 
 socket.setdefaulttimeout(1.0)
 
@@ -188,36 +185,14 @@ def get_rule_info(rules):
     "get spamassassin rules"
     if not rules:
         return []
-
-    def gen_rules(rule):
-        "map to generate rules"
-        rule = rule.strip()
-        match = SARULE_RE.match(rule)
-        description = ""
-        if match and match.groups()[1] != 'required':
-            rule = match.groups()[1]
-            rule_obj = Session.query(SARule)\
-                        .options(FromCache('sql_cache_long', rule))\
-                        .get(rule)
-            if rule_obj:
-                description = rule_obj.description
-            return dict(rule=rule, score=match.groups()[3],
-                            description=description)
-    tmplist = (gen_rules(rule) for rule in rules)
-    return (rule for rule in tmplist if rule)
+    return [dict(rule=rule, score=score, description=description)
+            for rule, score, description in resolve_rules(rules)]
 
 
 def spam_report(value):
     "print spam report"
-    if not value:
-        return ""
-
-    match = SPAM_REPORT.search(value)
-    if match:
-        rules = get_rule_info(match.groups()[0].split(','))
-        rows = (rule for rule in rules)
-        return rows
-    return []
+    return [dict(rule=rule, score=score, description=description)
+            for rule, score, description in resolve_spam_report(value)]
 
 
 def value_yes_no(value):
@@ -21,62 +21,49 @@ from pylons import url
 from webhelpers.html import literal
 from pylons.i18n.translation import ugettext
 from webhelpers.html.tags import link_to
-from lxml.html import tostring, iterlinks
 
 from baruwa.lib.helpers import flash
-from baruwa.lib.mail import local_fromstring
+from baruwa.lib.mail.html import rewrite_links
 from baruwa.lib.templates.helpers import media_url
 
 
+def fixup_links(content, cidurl, displayurl, allowimgs, richformat):
+    """Point CID links at the image url and block remote images
+    unless they are allowed"""
+    blocked = []
+
+    def link_handler(element, attribute, link):
+        "Rewrite a link"
+        if link.startswith('cid:'):
+            imgname = link.replace('cid:', '')
+            element.attrib['src'] = cidurl(imgname.replace('/', '__xoxo__'))
+        elif not allowimgs and attribute == 'src':
+            element.attrib['src'] = '%simgs/blocked.gif' % media_url()
+            element.attrib['title'] = link
+            blocked.append(link)
+
+    content = rewrite_links(content, link_handler)
+    if blocked and richformat:
+        flash(ugettext('This message contains external'
+            ' images, which have been blocked. ') +
+            literal(link_to(ugettext('Display images'), displayurl)))
+    return content
+
+
 def image_fixups(content, msgid, archive, richformat, allowimgs):
     "Replace the CID links stored messages"
-    html = local_fromstring(content)
-    for element, attribute, link, _ in iterlinks(html):
-        if not link.startswith('cid:'):
-            if not allowimgs and attribute == 'src':
-                element.attrib['src'] = '%simgs/blocked.gif' % media_url()
-                element.attrib['title'] = link
-                if richformat:
-                    if archive:
-                        displayurl = url('message-preview-archived-with-imgs',
-                                        msgid=msgid)
-                    else:
-                        displayurl = url('message-preview-with-imgs',
-                                        msgid=msgid)
-                    flash(ugettext('This message contains external'
-                        ' images, which have been blocked. ') +
-                        literal(link_to(ugettext('Display images'),
-                                displayurl)))
-        else:
-            imgname = link.replace('cid:', '')
-            if archive:
-                imgurl = url('messages-preview-archived-img',
-                            img=imgname.replace('/', '__xoxo__'),
-                            msgid=msgid)
-            else:
-                imgurl = url('messages-preview-img',
-                            img=imgname.replace('/', '__xoxo__'),
-                            msgid=msgid)
-            element.attrib['src'] = imgurl            
-    return tostring(html)
+    if archive:
+        displayurl = url('message-preview-archived-with-imgs', msgid=msgid)
+        cidurl = lambda img: url('messages-preview-archived-img',
+                                img=img, msgid=msgid)
+    else:
+        displayurl = url('message-preview-with-imgs', msgid=msgid)
+        cidurl = lambda img: url('messages-preview-img', img=img, msgid=msgid)
+    return fixup_links(content, cidurl, displayurl, allowimgs, richformat)
 
 
 def img_fixups(content, queueid, allowimgs, richformat):
     "Replace the CID links in Queued messages"
-    html = local_fromstring(content)
-    for element, attribute, link, _ in iterlinks(html):
-        if not link.startswith('cid:'):
-            if not allowimgs and attribute == 'src':
-                element.attrib['src'] = '%simgs/blocked.gif' % media_url()
-                element.attrib['title'] = link
-                if richformat:
-                    flash(ugettext('This message contains external '
-                    'images, which have been blocked. ') +
-                    literal(link_to(ugettext('Display images'),
-                    url('queue-preview-with-imgs', queueid=queueid))))
-        else:
-            imgname = link.replace('cid:', '')
-            element.attrib['src'] = url('queue-preview-img',
-                                    imgid=imgname.replace('/', '__xoxo__'),
-                                    queueid=queueid)
-    return tostring(html)
+    displayurl = url('queue-preview-with-imgs', queueid=queueid)
+    cidurl = lambda img: url('queue-preview-img', imgid=img, queueid=queueid)
+    return fixup_links(content, cidurl, displayurl, allowimgs, richformat)
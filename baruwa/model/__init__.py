@@ -23,7 +23,8 @@ from sqlalchemy.sql import text
 
 from baruwa.model.meta import Session, Base
 from baruwa.model.lists import List
-from baruwa.model.reports import SavedFilter
+from baruwa.model.reports import SavedFilter, ReportWatermark, \
+    SaScoreHistogram, ClientIpStats
 from baruwa.model.accounts import User, Address, Group
 from baruwa.model.status import MailQueueItem, AuditLog
 from baruwa.model.settings import Policy, Rule, PolicySettings, \
@@ -252,7 +252,7 @@ class Release(Base):
     messageid = Column(BigInteger)
     uuid = Column(String(128), unique=True)
     timestamp = Column(TIMESTAMP(timezone=True),
-                        server_default=utcnow())
+                        server_default=utcnow(), index=True)
     released = Column(Boolean(), default=False)
 
     __mapper_args__ = {'order_by': id}
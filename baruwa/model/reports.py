@@ -21,7 +21,9 @@
 from sqlalchemy import Column, ForeignKey, select, union_all
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.types import Unicode, Integer, BigInteger
-from sqlalchemy.types import SmallInteger, Float, UnicodeText
+from sqlalchemy.types import SmallInteger, Float, UnicodeText, TIMESTAMP
+from sqlalchemy.types import Date
+from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.sql.expression import Alias
 
 from baruwa.model.meta import Base
@@ -49,6 +51,56 @@ class SavedFilter(Base):
         self.user = user
 
 
+class ReportWatermark(Base):
+    "Newest message covered by a user's scheduled report"
+    __tablename__ = 'reportwatermarks'
+    __table_args__ = (UniqueConstraint('user_id', 'report'), {})
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
+    report = Column(Unicode(32))
+    timestamp = Column(TIMESTAMP(timezone=True))
+    messageid = Column(BigInteger)
+
+    def __init__(self, user_id, report):
+        "init"
+        self.user_id = user_id
+        self.report = report
+
+
+class SaScoreHistogram(Base):
+    """SpamAssassin score bucket counts per day and domain pair, the
+    domains that are not hosted are stored as empty strings"""
+    __tablename__ = 'sascorehist'
+    __table_args__ = (UniqueConstraint('date', 'to_domain', 'from_domain',
+                                        'score'), {})
+
+    id = Column(BigInteger, primary_key=True)
+    date = Column(Date, index=True)
+    to_domain = Column(Unicode(255), index=True)
+    from_domain = Column(Unicode(255), index=True)
+    score = Column(Float)
+    total = Column(BigInteger)
+
+
+class ClientIpStats(Base):
+    """Message counts per day, client IP and SpamAssassin score bucket,
+    the bucket is the floor of the score and exact counts the messages
+    scoring the bucket value exactly"""
+    __tablename__ = 'clientipstats'
+    __table_args__ = (UniqueConstraint('date', 'clientip', 'score'), {})
+
+    id = Column(BigInteger, primary_key=True)
+    date = Column(Date, index=True)
+    clientip = Column(Unicode(128), index=True)
+    score = Column(Integer)
+    total = Column(BigInteger)
+    exact = Column(BigInteger)
+    spam = Column(BigInteger)
+    ham = Column(BigInteger)
+    virii = Column(BigInteger)
+
+
 class SrcMessageTotals(Base):
     "From domain totals"
     __tablename__ = 'srcmsgtotals'
@@ -9,7 +9,7 @@ from baruwa.tasks.organizations import importdomains
 from baruwa.tasks.domains import test_smtp_server, exportdomains
 from baruwa.tasks.accounts import importaccounts, exportaccounts
 from baruwa.tasks.messages import (release_message, preview_msg,
-    process_quarantined_msg, update_autorelease)
+    process_quarantined_msg, process_quarantined_msgs, update_autorelease)
 from baruwa.tasks.status import (update_audit_log, export_auditlog,
     systemstatus, salint, bayesinfo, preview_queued_msg, process_queued_msgs)
 from baruwa.tasks.settings import (create_spam_checks, create_virus_checks,
@@ -19,7 +19,7 @@ from baruwa.tasks.settings import (create_spam_checks, create_virus_checks,
     create_text_sigs, create_sig_imgs, create_sig_img_names, get_ruleset,
     create_content_rules, create_content_ruleset, create_local_scores,
     create_ms_settings, save_dkim_key, delete_dkim_key, reload_exim,
-    delete_sig, save_dom_sig, save_user_sig)
+    delete_sig, save_dom_sig, save_user_sig, create_compiled_lists)
 from baruwa.tasks.mta import (create_relay_domains, create_relay_hosts,
     create_relay_proto_domains, create_ldap_domains, create_ldap_data,
     create_callback_domains, create_domain_lists, create_route_data,
@@ -35,6 +35,7 @@ except ImportError:
 assert release_message
 assert preview_msg
 assert process_quarantined_msg
+assert process_quarantined_msgs
 assert update_autorelease
 assert test_smtp_server
 assert exportdomains
@@ -61,6 +62,7 @@ assert create_virus_checks
 assert create_spam_actions
 assert create_highspam_actions
 assert create_lists
+assert create_compiled_lists
 assert create_message_size
 assert create_language_based
 assert create_sign_clean
@@ -3,7 +3,7 @@
 # Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
 # vim: ai ts=4 sts=4 et sw=4
 "Messages tasks"
-import time
+import uuid
 
 from pylons import config
 from celery.task import task
@@ -15,13 +15,16 @@ from sqlalchemy.orm.exc import NoResultFound
 from webhelpers.number import format_byte_size
 
 from baruwa.model.meta import Session
-from baruwa.lib.misc import gen_avail_mem
 from baruwa.model.messages import Message, Release
 from baruwa.lib.mail.message import ProcessQuarantinedMessage as PQM
 from baruwa.lib.mail.message import PreviewMessage, search_quarantine
-
-
-MEMLIMITS = {100: 2000000000, 50: 1000000000, 20: 500000000, 10: 250000000}
+from baruwa.lib.mail.message import learn_messages
+from baruwa.lib.mail.parser import MAX_DECODED_SIZE
+from baruwa.lib.mail.backends.smtp import SMTPSession
+from baruwa.lib.mail.previewcache import get_preview_cache, file_digest
+from baruwa.lib.admission import get_admission_controller, job_cost
+from baruwa.lib.admission import INTERACTIVE, RELEASE, LEARN
+from baruwa.lib.admission import RETRY_INTERVAL
 
 
 if not Session.registry.has():
@@ -32,35 +35,47 @@ if not Session.registry.has():
         pass
 
 
-def check_mem(job, logger):
-    """check if there is enough mem to execute task"""
-    if 'issingle' in job and job['issingle']:
-        return
-    mem = gen_avail_mem()
-    counter = 1
-    msgid = job['message_id']
-    memlimit = MEMLIMITS[job['num']]
-    memlimits = format_byte_size(memlimit)
-    while counter < 11:
-        if mem < memlimit:
-            logger.info("Deferring processing of: %(msgid)s "
-                "%(avail)s available %(req)s required",
-                dict(msgid=msgid, avail=format_byte_size(mem),
-                    req=memlimits))
-            if counter == 10:
-                raise OSError("Insufficient memory")
-        else:
-            logger.info("Processing %(msgid)s: "
-                "%(avail)s available %(req)s required",
-                dict(msgid=msgid, avail=format_byte_size(mem),
-                    req=memlimits))
-            break
-        time.sleep(30)
-        mem = gen_avail_mem()
-        counter += 1
+def task_ticket(current):
+    "Return an admission ticket that is kept across task retries"
+    return current.request.id or uuid.uuid4().hex
+
+
+def batch_cost(jobs):
+    """Return the memory needed by the costliest job of a batch, the
+    jobs are processed one at a time"""
+    costs = [0]
+    for job in jobs:
+        msgfile, _ = search_quarantine(job['date'], job['message_id'],
+                                        job['msgfiles'])
+        if not msgfile:
+            continue
+        for kind in ('release', 'learn'):
+            if job[kind]:
+                costs.append(job_cost(msgfile, kind))
+    return max(costs)
+
+
+def admit_jobs(current, jobs, logger):
+    """Mem zapping protection, reserve the memory the jobs need and
+    return the admission ticket. The task is retried later rather
+    than holding its worker until the memory is available"""
+    if all(job.get('issingle') for job in jobs):
+        priority = INTERACTIVE
+    elif any(job['learn'] for job in jobs):
+        priority = LEARN
+    else:
+        priority = RELEASE
+    cost = batch_cost(jobs)
+    ticket = task_ticket(current)
+    if not get_admission_controller().admit(ticket, cost, priority):
+        logger.info("Processing of %(count)d messages deferred until "
+                    "%(req)s is available",
+                    dict(count=len(jobs), req=format_byte_size(cost)))
+        raise current.retry(countdown=RETRY_INTERVAL)
+    return ticket
 
 
-def release(processor, job, result, logger):
+def release(processor, job, result, logger, smtp=None):
     """Release message"""
     if job['from_address']:
         if job['use_alt']:
@@ -68,12 +83,13 @@ def release(processor, job, result, logger):
         else:
             to_addrs = job['to_address'].split(',')
         result['release'] = processor.release(job['from_address'],
-                                                        to_addrs)
+                                                to_addrs, smtp)
         if not result['release']:
             error = ' '.join(processor.errors)
             result['errors'].append(('release', error))
             processor.reset_errors()
         else:
+            get_preview_cache().invalidate(job['message_id'])
             logger.info("Message: %(msgid)s released to: %(to)s",
                         dict(msgid=job['message_id'],
                         to=', '.join(to_addrs)))
@@ -113,6 +129,7 @@ def delete(processor, job, result, logger):
                     "error: %(error)s", dict(msgid=job['message_id'],
                     error=error))
     else:
+        get_preview_cache().invalidate(job['message_id'])
         logger.info("Message: %(msgid)s deleted from quarantine",
         dict(msgid=job['message_id']))
         sql = Message.__table__\
@@ -122,6 +139,38 @@ def delete(processor, job, result, logger):
         Session.bind.execute(sql)
 
 
+def learn_batch(learnas, queued, logger):
+    """Learn a batch of queued messages with a single sa-learn run,
+    falling back to learning each message if the run fails
+
+    sa-learn only reports how many messages it skipped, when some
+    were skipped the messages of the batch are not marked learnt."""
+    msgfiles = [processor.msgfile for processor, _, _ in queued]
+    success, learned, examined, output = learn_messages(msgfiles, learnas)
+    skipped = examined - learned
+    if success:
+        logger.info("Batch of %(count)d messages learnt as %(learn)s: "
+                    "%(learned)d learned, %(skipped)d skipped",
+                    dict(count=len(queued), learn=learnas,
+                    learned=learned, skipped=skipped))
+        for _, job, result in queued:
+            result['learn'] = skipped == 0
+            if skipped:
+                result['errors'].append(('learn',
+                    '%d of the %d messages learnt with this message '
+                    'were skipped, they may have been learnt already' %
+                    (skipped, len(queued))))
+    else:
+        logger.info("Batch learning as %(learn)s failed with "
+                    "error: %(error)s, learning messages individually",
+                    dict(learn=learnas, error=output))
+        for processor, job, result in queued:
+            learn(processor, job, result, logger)
+    for processor, job, result in queued:
+        if job['todelete']:
+            delete(processor, job, result, logger)
+
+
 def process_exception(exception, result, job, logger):
     """Process an exception"""
     for action in ['release', 'learn', 'todelete']:
@@ -135,17 +184,30 @@ def process_exception(exception, result, job, logger):
                         error=str(exception)))
 
 
-def process_message(job, logger):
-    "Process a quarantined message"
-    result = dict(message_id=job['message_id'],
-                    mid=job['mid'],
-                    date=job['date'],
-                    from_address=job['from_address'],
-                    to_address=job['to_address'],
-                    release=None,
-                    learn=None,
-                    delete=None,
-                    errors=[])
+def new_result(job):
+    "Return an empty result for a job"
+    return dict(message_id=job['message_id'],
+                mid=job['mid'],
+                date=job['date'],
+                from_address=job['from_address'],
+                to_address=job['to_address'],
+                release=None,
+                learn=None,
+                delete=None,
+                errors=[])
+
+
+def failed_result(job, exception, logger):
+    "Return the result of a job that could not be processed"
+    result = new_result(job)
+    process_exception(exception, result, job, logger)
+    return result
+
+
+def process_message(job, logger, smtp=None, learnq=None):
+    """Process a quarantined message, when learnq is supplied learning
+    and the delete that follows it are queued for learn_batch"""
+    result = new_result(job)
     try:
         msgfile, isdir = search_quarantine(job['date'], job['message_id'],
                                             job['msgfiles'])
@@ -153,12 +215,12 @@ def process_message(job, logger):
             raise OSError('Message not found')
         processor = PQM(msgfile, isdir, debug=asbool(config['debug']))
         if job['release']:
-            # Mem zapping protection
-            check_mem(job, logger)
-            release(processor, job, result, logger)
+            release(processor, job, result, logger, smtp)
+        if job['learn'] and learnq is not None:
+            learnq.setdefault(job['salearn_as'], [])\
+                .append((processor, job, result))
+            return result
         if job['learn']:
-            # Mem zapping protection
-            check_mem(job, logger)
             learn(processor, job, result, logger)
         if job['todelete']:
             delete(processor, job, result, logger)
@@ -178,6 +240,7 @@ def release_message(messageid, date, from_addr, to_addr, msgfiles):
 
     processor = PQM(msgfile, isdir, debug=asbool(config['debug']))
     if processor.release(from_addr, to_addr):
+        get_preview_cache().invalidate(messageid)
         logger.info("Message: %(id)s released to: %(addrs)s",
                     dict(id=messageid, addrs=','.join(to_addr)))
         retdict = dict(success=True, error='')
@@ -188,42 +251,105 @@ def release_message(messageid, date, from_addr, to_addr, msgfiles):
     return retdict
 
 
-@task(name='process-quarantined-msg')
+@task(name='process-quarantined-msg', max_retries=None)
 def process_quarantined_msg(*args):
     'Process quarantined message'
     job = args[0]
     logger = process_quarantined_msg.get_logger()
+    try:
+        ticket = admit_jobs(process_quarantined_msg, [job], logger)
+    except OSError, exception:
+        return failed_result(job, exception, logger)
     logger.info('Processing quarantined message: %(id)s',
                 dict(id=job['message_id']))
-    return process_message(job, logger)
+    try:
+        return process_message(job, logger)
+    finally:
+        get_admission_controller().release(ticket)
+
+
+@task(name='process-quarantined-msgs', max_retries=None)
+def process_quarantined_msgs(jobs):
+    """Process a batch of messages quarantined on this node,
+    releases share one SMTP session and messages are learnt with
+    one sa-learn run per learn type"""
+    logger = process_quarantined_msgs.get_logger()
+    try:
+        ticket = admit_jobs(process_quarantined_msgs, jobs, logger)
+    except OSError, exception:
+        return [failed_result(job, exception, logger) for job in jobs]
+    logger.info('Processing batch of %(count)d quarantined messages',
+                dict(count=len(jobs)))
+    try:
+        smtp = SMTPSession('127.0.0.1', asbool(config['debug']))
+        learnq = {}
+        try:
+            results = [process_message(job, logger, smtp, learnq)
+                        for job in jobs]
+        finally:
+            smtp.close()
+        for learnas, queued in learnq.iteritems():
+            learn_batch(learnas, queued, logger)
+        return results
+    finally:
+        get_admission_controller().release(ticket)
 
 
 # pylint: disable-msg=R0911
 # pylint: disable-msg=R0913
 # pylint: disable-msg=W0613
-@task(name='preview-message')
+@task(name='preview-message', max_retries=None)
 def preview_msg(messageid, date, msgfiles, attachid=None,
         imgid=None, allowimgs=None):
     "Preview message"
     logger = preview_msg.get_logger()
     try:
         msgfile, _ = search_quarantine(date, messageid, msgfiles)
-        previewer = PreviewMessage(msgfile)
-
-        if attachid:
-            logger.info("Download attachment: %(attachid)s of "
-                        "message: %(id)s",
-                        dict(id=messageid, attachid=attachid))
-            return previewer.attachment(attachid)
-        if imgid:
-            logger.info("Image access: %(img)s", dict(img=imgid))
-            return previewer.img(imgid)
-        logger.info("Preview of message: %(id)s", dict(id=messageid))
-        return previewer.preview()
+        if not attachid and not imgid:
+            cache = get_preview_cache()
+            digest = file_digest(msgfile)
+            result = cache.get(messageid, digest)
+            if result is not None:
+                logger.info("Preview of message: %(id)s served from cache",
+                            dict(id=messageid))
+                return result
+        maxsize = int(config.get('baruwa.preview.memory.limit',
+                                MAX_DECODED_SIZE))
+        admission = get_admission_controller()
+        ticket = task_ticket(preview_msg)
+        if not admission.admit(ticket, job_cost(msgfile, 'preview'),
+                                INTERACTIVE):
+            raise preview_msg.retry(countdown=RETRY_INTERVAL)
+        previewer = None
+        try:
+            previewer = PreviewMessage(msgfile, maxsize)
+            if attachid:
+                logger.info("Download attachment: %(attachid)s of "
+                            "message: %(id)s",
+                            dict(id=messageid, attachid=attachid))
+                return previewer.attachment(attachid)
+            if imgid:
+                logger.info("Image access: %(img)s", dict(img=imgid))
+                return previewer.img(imgid)
+            logger.info("Preview of message: %(id)s", dict(id=messageid))
+            result = previewer.preview()
+            if result['truncated']:
+                logger.info("Preview of message: %(id)s truncated at "
+                            "%(size)d bytes", dict(id=messageid, size=maxsize))
+            cache.set(messageid, digest, result)
+            return result
+        finally:
+            if previewer is not None:
+                previewer.close()
+            admission.release(ticket)
     except IOError, error:
         logger.info("Accessing message: %(id)s, Failed: %(error)s",
                     dict(id=messageid, error=error))
         return {}
+    except OSError, error:
+        logger.info("Accessing message: %(id)s, Failed: %(error)s",
+                    dict(id=messageid, error=error))
+        return {}
     except TypeError, error:
         logger.info("Accessing message: %(id)s, Failed: %(error)s",
                     dict(id=messageid, error=error))
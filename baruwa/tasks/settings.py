@@ -27,6 +27,8 @@ from lxml.html import tostring, fragments_fromstring, iterlinks
 from baruwa.model.lists import List
 from baruwa.model.meta import Session
 from baruwa.lib.templates import render
+from baruwa.lib.crypto.hashing import sha1
+from baruwa.lib.senderlists import compile_lists
 from baruwa.model.domains import Domain
 from baruwa.model.messages import SARule
 from baruwa.config.routing import make_map
@@ -162,37 +164,96 @@ def create_local_table(conn):
     value TEXT
     )
     """
+    digest_sql = """CREATE TABLE IF NOT EXISTS settings_digest
+    (
+    digest TEXT
+    )
+    """
+    try:
+        conn.execute(initial_sql)
+        conn.execute(digest_sql)
+    except DatabaseError:
+        pass
+
+
+def create_local_indexes(conn):
+    """Create the sqlite indexes"""
     index1 = "CREATE INDEX internal_idx ON quickpeek(internal)"
     index2 = "CREATE INDEX external_idx ON quickpeek(external)"
     try:
-        conn.execute(initial_sql)
         conn.execute(index1)
         conn.execute(index2)
     except DatabaseError:
         pass
 
 
-def make_connection():
-    """Make a connection to the SQLite DB"""
-    change_owner = False
+def get_local_dbfile():
+    """Return the path to the SQLite settings DB"""
     dbdir = config.get('cache_dir', '/var/lib/baruwa/data')
     dbdir = os.path.join(dbdir, 'db')
-    dbfile = os.path.join(dbdir, 'baruwa2.db')
+    return os.path.join(dbdir, 'baruwa2.db')
+
+
+def make_connection(dbfile=None):
+    """Make a connection to the SQLite DB"""
+    change_owner = False
+    if dbfile is None:
+        dbfile = get_local_dbfile()
     if not os.path.exists(dbfile):
         change_owner = True
-    eng = create_engine('sqlite:///%s' % dbfile)
+    eng = create_engine('sqlite:///%s' % dbfile, poolclass=NullPool)
     conn = eng.connect()
     if change_owner:
         uid = pwd.getpwnam("baruwa").pw_uid
         gid = grp.getgrnam("exim").gr_gid
         try:
             os.chown(dbfile, uid, gid)
-            create_local_table(conn)
         except OSError:
             pass
     return conn
 
 
+def get_local_digest(dbfile):
+    """Return the settings digest stored in the SQLite DB"""
+    if not os.path.exists(dbfile):
+        return None
+    conn = make_connection(dbfile)
+    try:
+        row = conn.execute(text("SELECT digest FROM settings_digest"))\
+                    .fetchone()
+        return row.digest if row else None
+    except DatabaseError:
+        return None
+    finally:
+        conn.close()
+
+
+def build_local_db(dbfile, params, digest):
+    """Build a fresh SQLite settings DB in a single transaction"""
+    if os.path.exists(dbfile):
+        os.unlink(dbfile)
+    conn = make_connection(dbfile)
+    insert_sql = text("""INSERT INTO quickpeek
+    (rank, internal, external, hostname, value)
+    VALUES(:rank, :internal, :external, :hostname, :value)
+    """)
+    digest_sql = text("""INSERT INTO settings_digest (digest)
+    VALUES(:digest)""")
+    trans = conn.begin()
+    try:
+        create_local_table(conn)
+        if params:
+            conn.execute(insert_sql, params)
+        create_local_indexes(conn)
+        conn.execute(digest_sql, digest=digest)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+
+
 @task(name="update-serial", ignore_result=True)
 def update_serial():
     "update serial number task"
@@ -673,6 +734,28 @@ def create_lists(list_type):
     Session.close()
 
 
+@task(name='create-compiled-lists', ignore_result=True)
+def create_compiled_lists(list_type):
+    """Compile approved and banned lists into cdb lookup files, the
+    file of the list type is rebuilt in full on every list edit"""
+    logger = create_compiled_lists.get_logger()
+    if list_type == 1:
+        filename = 'approvedsenders.cdb'
+    else:
+        filename = 'bannedsenders.cdb'
+    items = Session.query(List).filter(List.list_type == list_type)
+    items = windowed_query(items, List.id, 500)
+    cache_dir = config.get('cache_dir', '/var/lib/baruwa/data')
+    dest = os.path.join(cache_dir, 'db', filename)
+    count = compile_lists(items, dest)
+    os.chmod(dest, 0640)
+    uid = pwd.getpwnam("baruwa").pw_uid
+    gid = grp.getgrnam("exim").gr_gid
+    os.chown(dest, uid, gid)
+    logger.info('Compiled %d list entries into: %s' % (count, dest))
+    Session.close()
+
+
 @task(name='create-message-size-rules', ignore_result=True)
 def create_message_size():
     "Generate file based message size ruleset"
@@ -807,6 +890,7 @@ def create_local_scores():
 @task(name='create-local-settings', ignore_result=True)
 def create_ms_settings():
     """Create MS local SETTINGS_MAP"""
+    logger = create_ms_settings.get_logger()
     sql = text("""SELECT * FROM quickpeek""")
     proxy = Session.execute(sql)
     params = [dict(rank=row.rank,
@@ -815,10 +899,23 @@ def create_ms_settings():
             hostname=row.hostname,
             value=dbval(row.value))
             for row in proxy]
-    conn = make_connection()
-    insert_sql = text("""INSERT INTO quickpeek
-    (rank, internal, external, hostname, value)
-    VALUES(:rank, :internal, :external, :hostname, :value)
-    """)
-    conn.execute(text("DELETE FROM quickpeek"))
-    conn.execute(insert_sql, params)
+    Session.close()
+    params.sort(key=lambda item: (item['internal'], item['hostname'],
+                                    item['rank'], item['external']))
+    digest = sha1(repr([(item['rank'], item['internal'],
+                        item['external'], item['hostname'],
+                        item['value']) for item in params]))
+    dbfile = get_local_dbfile()
+    if get_local_digest(dbfile) == digest:
+        logger.info('Scanner settings unchanged, not rebuilding: %s' %
+                    dbfile)
+        return
+    tmpfile = '%s.%d.tmp' % (dbfile, os.getpid())
+    try:
+        build_local_db(tmpfile, params, digest)
+        os.rename(tmpfile, dbfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+    logger.info('Scanner settings rebuilt with %d entries: %s' %
+                (len(params), dbfile))
@@ -6,7 +6,9 @@
 "status tasks"
 
 import os
+import time
 import datetime
+import tempfile
 
 import psutil
 
@@ -16,7 +18,8 @@ from pylons import config
 from celery.task import task
 from sqlalchemy.pool import NullPool
 from eventlet.green import subprocess
-from sqlalchemy import desc
+from sqlalchemy import desc, func
+from sqlalchemy.sql import and_, or_
 from sqlalchemy import engine_from_config
 from sqlalchemy.exc import DatabaseError
 from sphinxapi import SphinxClient, SPH_MATCH_EXTENDED2
@@ -39,11 +42,16 @@ from baruwa.lib.mail.queue.search import search_queue
 from baruwa.model.status import AuditLog, CATEGORY_MAP
 from baruwa.commands.queuestats import update_queue_stats
 from baruwa.lib.regex import EXIM_MSGID_RE, BAYES_INFO_RE
-from baruwa.lib.outputformats import build_csv, BaruwaPDFTemplate
+from baruwa.lib.outputformats import stream_csv, BaruwaPDFTemplate
+from baruwa.lib.outputformats import FlowableStream
 from baruwa.lib.misc import get_processes, get_config_option, wrap_string, _
 
 
 STYLES = getSampleStyleSheet()
+EXPORT_BATCH = 1000
+# exports are removed a day after they are created
+EXPORT_TTL = 86400
+PDF_TABLE_ROWS = 100
 
 
 if not Session.registry.has():
@@ -278,22 +286,8 @@ def update_audit_log(username,
         Session.close()
 
 
-def build_pdf(rows):
-    "Build PDF"
-    pdffile = StringIO()
-    doc = BaruwaPDFTemplate(pdffile, topMargin=50, bottomMargin=18)
-    import baruwa
-    here = os.path.dirname(
-                os.path.dirname(os.path.abspath(baruwa.__file__))
-            )
-    logo = os.path.join(here, 'baruwa', 'public', 'imgs', 'logo.png')
-    img = Image(logo)
-    logobj = [(img, _('Audit Log exported report'))]
-    logo_table = Table(logobj, [2.0 * inch, 5.4 * inch])
-    logo_table.setStyle(PIE_TABLE)
-    parts = [logo_table]
-    parts.append(Spacer(1, 20))
-    parts.append(Paragraph(_('Audit Logs'), STYLES['Heading1']))
+def audit_table(rows):
+    "Build a table of audit log rows"
     heading = ((Paragraph(_('Date/Time'), STYLES["Heading6"]),
             Paragraph(_('Username'), STYLES["Heading6"]),
             Paragraph(_('Info'), STYLES["Heading6"]),
@@ -303,17 +297,88 @@ def build_pdf(rows):
     rows.insert(0, heading)
     table = Table(rows, [1.10 * inch, 1.23 * inch,
                         1.96 * inch, 1.69 * inch,
-                        0.95 * inch, 0.45 * inch, ])
+                        0.95 * inch, 0.45 * inch, ], repeatRows=1)
     table.setStyle(TableStyle([
             ('FONTSIZE', (0, 0), (-1, -1), 8),
             ('FONT', (0, 0), (-1, -1), 'Helvetica'),
             ('FONT', (0, 0), (-1, 0), 'Helvetica-Bold'),
             ('GRID', (0, 0), (-1, -1), 0.15, colors.black),
     ]))
-    parts.append(table)
+    return table
+
+
+def audit_flowables(rows):
+    "Yield the flowables of the audit log report"
+    import baruwa
+    here = os.path.dirname(
+                os.path.dirname(os.path.abspath(baruwa.__file__))
+            )
+    logo = os.path.join(here, 'baruwa', 'public', 'imgs', 'logo.png')
+    img = Image(logo)
+    logobj = [(img, _('Audit Log exported report'))]
+    logo_table = Table(logobj, [2.0 * inch, 5.4 * inch])
+    logo_table.setStyle(PIE_TABLE)
+    yield logo_table
+    yield Spacer(1, 20)
+    yield Paragraph(_('Audit Logs'), STYLES['Heading1'])
+    # small tables are cheaper to split across pages than one large one
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == PDF_TABLE_ROWS:
+            yield audit_table(batch)
+            batch = []
+    if batch:
+        yield audit_table(batch)
+
+
+def build_pdf(rows, handle):
+    "Build PDF"
+    doc = BaruwaPDFTemplate(handle, topMargin=50, bottomMargin=18)
     doc.title = _('Baruwa Audit log export')
-    doc.build(parts)
-    return pdffile.getvalue()
+    doc.build(FlowableStream(audit_flowables(rows)))
+
+
+def get_export_dir():
+    "Return the export directory, removing the expired exports"
+    exportdir = config.get('baruwa.exports.dir',
+                        os.path.join(config.get('cache_dir',
+                                    tempfile.gettempdir()), 'exports'))
+    if not os.path.exists(exportdir):
+        os.makedirs(exportdir, 0700)
+    expired = time.time() - EXPORT_TTL
+    for name in os.listdir(exportdir):
+        path = os.path.join(exportdir, name)
+        try:
+            if os.path.getmtime(path) < expired:
+                os.unlink(path)
+        except OSError:
+            pass
+    return exportdir
+
+
+def iter_auditlog(dbquery, progress, batchsize=EXPORT_BATCH):
+    """Yield the audit log entries newest first, reading them in
+    keyset batches"""
+    done = 0
+    last = None
+    while True:
+        query = dbquery
+        if last is not None:
+            query = query.filter(func._(or_(AuditLog.timestamp < last[0],
+                                and_(AuditLog.timestamp == last[0],
+                                    AuditLog.id < last[1]))))
+        batch = query.order_by(desc(AuditLog.timestamp),
+                                desc(AuditLog.id))\
+                    .limit(batchsize).all()
+        for item in batch:
+            yield item
+        done += len(batch)
+        progress(done)
+        if len(batch) < batchsize:
+            break
+        last = (batch[-1].timestamp, batch[-1].id)
+        Session.expunge_all()
 
 
 @task(name='export-audit-log')
@@ -323,10 +388,12 @@ def export_auditlog(format, query):
     filename = 'auditlog-%s.%s' % (export_auditlog.request.id, format)
     content_type = 'text/csv' if format == 'csv' else 'application/pdf'
     results = dict(id=export_auditlog.request.id,
-                    f=None,
+                    path=None,
+                    hostname=system_hostname(),
                     content_type=content_type,
                     filename=filename,
                     errormsg='')
+    handle = None
     try:
         dbquery = Session.query(AuditLog)
         if query:
@@ -340,36 +407,55 @@ def export_auditlog(format, query):
             if qresults and qresults['matches']:
                 ids = [hit['id'] for hit in qresults['matches']]
                 dbquery = dbquery.filter(AuditLog.id.in_(ids))
-
-        dbquery = dbquery.order_by(desc('timestamp')).all()
+        total = dbquery.count()
+
+        def progress(done):
+            "Report the export progress"
+            export_auditlog.update_state(state='PROGRESS',
+                                        meta=dict(done=done, total=total))
+
+        exportdir = get_export_dir()
+        handle = tempfile.NamedTemporaryFile(dir=exportdir,
+                                            prefix='.auditlog-',
+                                            delete=False)
+        items = iter_auditlog(dbquery, progress)
         if format == 'pdf':
             PS = ParagraphStyle('auditlogp',
                                     fontName='Helvetica',
                                     fontSize=8,
                                     borderPadding=(2, 2, 2, 2))
-            rows = [(Paragraph(item.timestamp.strftime('%Y-%m-%d %H:%M'), PS),
+            rows = ((Paragraph(item.timestamp.strftime('%Y-%m-%d %H:%M'), PS),
                     Paragraph(wrap_string(item.username, 27), PS),
                     Paragraph(wrap_string(item.info, 33), PS),
                     Paragraph(wrap_string(item.hostname, 27), PS),
                     Paragraph(wrap_string(item.remoteip, 15), PS),
                     Paragraph(CATEGORY_MAP[item.category], PS))
-                    for item in dbquery]
-            pdf = build_pdf(rows)
-            results['f'] = pdf
+                    for item in items)
+            build_pdf(rows, handle)
         elif format == 'csv':
-            rows = [item.tojson() for item in dbquery]
+            rows = (item.tojson() for item in items)
             keys = ('timestamp',
                     'username',
                     'info',
                     'hostname',
                     'remoteip',
                     'category')
-            results['f'] = build_csv(rows, keys)
+            heading = dict([(key, "'%s'" % key) for key in keys])
+            for chunk in stream_csv(rows, keys, heading):
+                handle.write(chunk)
+        handle.close()
+        path = os.path.join(exportdir, filename)
+        os.rename(handle.name, path)
+        results['path'] = path
         logger.info("Audit Log export complete: %s" % results['filename'])
         return results
-    except (DatabaseError), err:
+    except (DatabaseError, IOError, OSError), err:
         results['errormsg'] = str(err)
         logger.info("Audit Log export FAILURE: %s" % str(err))
         return results
     finally:
+        if handle is not None and not handle.closed:
+            handle.close()
+        if handle is not None and os.path.exists(handle.name):
+            os.unlink(handle.name)
         Session.close()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+"Memory admission tests"
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from baruwa.lib import admission
+from baruwa.lib.admission import AdmissionController, INTERACTIVE, \
+    RELEASE, LEARN, MB
+
+
+class TestAdmission(TestCase):
+    "Admission controller"
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.avail_mem = admission.gen_avail_mem
+        self.total_mem = admission.gen_total_mem
+        self.avail = 1000 * MB
+        admission.gen_avail_mem = lambda: self.avail
+        admission.gen_total_mem = lambda: 1000 * MB
+        self.controller = AdmissionController(
+                            os.path.join(self.tmpdir, 'admission.state'),
+                            reserve=100 * MB, timeout=300)
+
+    def tearDown(self):
+        admission.gen_avail_mem = self.avail_mem
+        admission.gen_total_mem = self.total_mem
+        shutil.rmtree(self.tmpdir)
+
+    def test_admit(self):
+        self.assertTrue(self.controller.admit('a', 500 * MB, RELEASE))
+        # the running job's memory is in use, its reservation is
+        # only charged against the total
+        self.avail = 500 * MB
+        self.assertTrue(self.controller.admit('b', 300 * MB, RELEASE))
+        self.assertFalse(self.controller.admit('c', 300 * MB, RELEASE))
+        self.controller.release('a')
+        self.assertTrue(self.controller.admit('c', 300 * MB, RELEASE))
+
+    def test_order(self):
+        self.assertTrue(self.controller.admit('a', 800 * MB, LEARN))
+        self.assertFalse(self.controller.admit('b', 200 * MB, LEARN))
+        self.assertFalse(self.controller.admit('c', 150 * MB, RELEASE))
+        self.controller.release('a')
+        # release jobs are queued ahead of learn jobs
+        self.assertFalse(self.controller.admit('b', 200 * MB, LEARN))
+        self.assertTrue(self.controller.admit('c', 150 * MB, RELEASE))
+        self.assertTrue(self.controller.admit('b', 200 * MB, LEARN))
+
+    def test_large_job_does_not_block(self):
+        self.assertFalse(self.controller.admit('a', 2000 * MB, RELEASE))
+        self.assertTrue(self.controller.admit('b', 100 * MB, RELEASE))
+
+    def test_interactive(self):
+        self.avail = 0
+        self.assertTrue(self.controller.admit('a', 500 * MB, INTERACTIVE))
+
+    def test_timeout(self):
+        self.controller.timeout = 0
+        self.assertRaises(OSError, self.controller.admit, 'a',
+                        2000 * MB, RELEASE)
+        with self.controller.state() as state:
+            self.assertEqual(state['waiting'], {})
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+"Batch report engine tests"
+import datetime
+
+from unittest import TestCase
+
+from baruwa.lib.batchreports import BatchReports, ReportScope
+
+
+class FakeQuery(object):
+    "Query returning canned grouped rows"
+    def __init__(self, rows):
+        self.rows = rows
+
+    def filter(self, *args):
+        return self
+
+    def group_by(self, *args):
+        return self
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeSession(object):
+    "Session counting the passes run"
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def query(self, *args):
+        self.queries += 1
+        return FakeQuery(self.rows)
+
+
+class TestBatchReports(TestCase):
+    "Per scope assembly of the grouped passes"
+    def test_top(self):
+        # (to domain, from domain, from address, count, size)
+        rows = [(u'a.com', None, u'x@ext.com', 5, 500),
+                (u'a.com', u'b.com', u'y@b.com', 2, 200),
+                (None, u'b.com', u'y@b.com', 4, 100),
+                (u'c.com', None, u'x@ext.com', 7, 70)]
+        dbsession = FakeSession(rows)
+        reports = BatchReports(dbsession)
+        scope_a = ReportScope('domain', [u'a.com'])
+        scope_b = ReportScope('domain', [u'b.com'])
+        scope_ac = ReportScope('domain', [u'a.com', u'c.com'])
+        for scope in (scope_a, scope_b, scope_ac):
+            reports.add(scope)
+        top = reports.top(scope_a, '1')
+        self.assertEqual([(row.address, row.count, row.size)
+                        for row in top],
+                        [(u'x@ext.com', 5, 500), (u'y@b.com', 2, 200)])
+        top = reports.top(scope_b, '1')
+        self.assertEqual([(row.address, row.count) for row in top],
+                        [(u'y@b.com', 6)])
+        top = reports.top(scope_ac, '1', limit=1)
+        self.assertEqual([(row.address, row.count) for row in top],
+                        [(u'x@ext.com', 12)])
+        # one pass serves every scope
+        self.assertEqual(dbsession.queries, 1)
+        self.assertRaises(ValueError, reports.add, scope_a)
+
+    def test_inbound(self):
+        # (to domain, from domain, to address, count, size)
+        rows = [(u'a.com', None, u'u@a.com', 3, 30),
+                (None, u'a.com', u'z@ext.com', 9, 90)]
+        reports = BatchReports(FakeSession(rows))
+        scope = ReportScope('domain', [u'a.com'])
+        reports.add(scope)
+        top = reports.top(scope, '5')
+        self.assertEqual([row.address for row in top], [u'u@a.com'])
+
+    def test_totals(self):
+        day1 = datetime.date(2014, 1, 1)
+        day2 = datetime.date(2014, 1, 2)
+        rows = [(u'u@a.com', None, day1, 10, 1, 2, 1000),
+                (None, u'u@a.com', day1, 5, 0, None, 500),
+                (u'u@a.com', None, day2, 1, 0, 0, 10)]
+        reports = BatchReports(FakeSession(rows))
+        scope = ReportScope('address', [u'u@a.com'])
+        reports.add(scope)
+        totals = reports.totals(scope, 'UTC')
+        self.assertEqual([(row.ldate, row.mail_total, row.virus_total,
+                        row.spam_total, row.total_size) for row in totals],
+                        [(day2, 1, 0, 0, 10), (day1, 15, 1, 2, 1500)])
+
+    def test_empty_scope(self):
+        dbsession = FakeSession([])
+        reports = BatchReports(dbsession)
+        scope = ReportScope('address', [])
+        reports.add(scope)
+        self.assertEqual(reports.top(scope, '1'), [])
+        self.assertEqual(dbsession.queries, 0)
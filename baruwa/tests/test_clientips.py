@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+"Client IP ranking tests"
+import os
+import shutil
+import datetime
+import tempfile
+
+from unittest import TestCase
+
+import cdb
+import arrow
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from baruwa.model.reports import ClientIpStats
+from baruwa.lib.clientips import period_start, top_clientips, \
+    ClientIpWriter
+
+
+class TestClientIps(TestCase):
+    "Client IP rankings from the per day rollups"
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        ClientIpStats.__table__.create(engine)
+        self.dbsession = sessionmaker(bind=engine)()
+        self.today = arrow.utcnow().date()
+        yesterday = self.today - datetime.timedelta(days=1)
+        old = self.today - datetime.timedelta(days=10)
+        rows = [(self.today, u'10.0.0.1', 5, 3, 1),
+                (self.today, u'10.0.0.1', 10, 2, 2),
+                (yesterday, u'10.0.0.1', 7, 4, 0),
+                (self.today, u'10.0.0.2', 0, 6, 4),
+                (self.today, u'10.0.0.2', 5, 1, 0),
+                (old, u'10.0.0.3', 12, 50, 50)]
+        for rowid, row in enumerate(rows):
+            date, clientip, score, total, exact = row
+            self.dbsession.add(ClientIpStats(id=rowid + 1, date=date,
+                                            clientip=clientip, score=score,
+                                            total=total, exact=exact))
+        self.dbsession.commit()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.dbsession.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_period_start(self):
+        self.assertEqual(period_start('daily'),
+                        self.today - datetime.timedelta(days=1))
+        self.assertEqual(period_start('weekly'),
+                        self.today - datetime.timedelta(days=7))
+        self.assertEqual(period_start('monthly'),
+                        self.today - datetime.timedelta(days=28))
+
+    def test_period_start_early(self):
+        # an hour into the day the period still covers the last day
+        now = arrow.get(2014, 3, 10, 1, 0)
+        for period, days, first in (('daily', 1, (2014, 3, 9)),
+                                    ('weekly', 7, (2014, 3, 3)),
+                                    ('monthly', 28, (2014, 2, 10))):
+            start = period_start(period, now)
+            self.assertEqual(start, datetime.date(*first))
+            window = now.datetime - datetime.timedelta(days=days)
+            self.assertTrue(start <= window.date())
+
+    def test_above(self):
+        query = top_clientips(self.dbsession, period_start('weekly'), 5, 1)
+        self.assertEqual([tuple(row) for row in query],
+                        [(u'10.0.0.1', 9), (u'10.0.0.2', 1)])
+        query = top_clientips(self.dbsession, period_start('daily'), 5, 2)
+        self.assertEqual([tuple(row) for row in query], [(u'10.0.0.1', 9)])
+
+    def test_below(self):
+        # only the messages scoring exactly 5 count from the 5 bucket
+        query = top_clientips(self.dbsession, period_start('daily'), 5, 1,
+                            above=False)
+        self.assertEqual([tuple(row) for row in query],
+                        [(u'10.0.0.2', 6), (u'10.0.0.1', 1)])
+
+    def test_writer(self):
+        path = os.path.join(self.tmpdir, 'clientips')
+        writer = ClientIpWriter(path, include_count=True)
+        writer.add(u'10.0.0.1', 9)
+        self.assertFalse(os.path.exists(path))
+        writer.finish()
+        with open(path) as handle:
+            self.assertEqual(handle.read(), '10.0.0.1\t9\n')
+        path = os.path.join(self.tmpdir, 'clientips.cdb')
+        writer = ClientIpWriter(path, 'cdb')
+        writer.add(u'10.0.0.1', 9)
+        writer.finish()
+        self.assertEqual(cdb.init(path).get('10.0.0.1'), '9')
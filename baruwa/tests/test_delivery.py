@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+"Report delivery checkpoint tests"
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+
+from unittest import TestCase
+
+from baruwa.lib.delivery import Checkpoint
+
+# the commands are monkey patched, the pipeline is run in a fresh
+# interpreter so the patching does not leak into the other tests
+SCRIPT = """
+import eventlet
+eventlet.monkey_patch()
+
+import os
+import sys
+
+from baruwa.lib import delivery
+from baruwa.lib.delivery import Checkpoint, ReportPipeline
+
+
+class Mailer(object):
+    def __init__(self, options):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def send(self, email):
+        if email == 'fail':
+            raise ValueError(email)
+        eventlet.sleep(0.01)
+
+
+def render(name):
+    return name, os.getpid()
+
+
+def build(rendered):
+    name, pid = rendered
+    return [(name, 'fail' if pid == os.getpid() else name)]
+
+
+def sent(key, success):
+    print key, success
+
+delivery.Mailer = Mailer
+checkpoint = Checkpoint(sys.argv[1], 'run-1')
+pipeline = ReportPipeline({}, checkpoint, processes=2)
+pipeline.start()
+for num in range(3):
+    pipeline.submit(render, ('user%d' % num,), build, sent)
+print pipeline.close()
+checkpoint.close()
+"""
+
+
+class TestCheckpoint(TestCase):
+    "Delivery checkpoints"
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'reports', 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume(self):
+        checkpoint = Checkpoint(self.path, 'run-1')
+        checkpoint.mark('user@example.com')
+        checkpoint.mark('other@example.com')
+        checkpoint.close()
+        checkpoint = Checkpoint(self.path, 'run-1')
+        self.assertTrue('user@example.com' in checkpoint)
+        self.assertTrue('other@example.com' in checkpoint)
+        self.assertFalse('new@example.com' in checkpoint)
+        checkpoint.mark('new@example.com')
+        checkpoint.close()
+        with open(self.path) as handle:
+            self.assertEqual(handle.read().splitlines(),
+                            ['run-1', 'user@example.com',
+                            'other@example.com', 'new@example.com'])
+
+    def test_other_run(self):
+        checkpoint = Checkpoint(self.path, 'run-1')
+        checkpoint.mark('user@example.com')
+        checkpoint.close()
+        checkpoint = Checkpoint(self.path, 'run-2')
+        self.assertFalse('user@example.com' in checkpoint)
+        checkpoint.close()
+        with open(self.path) as handle:
+            self.assertEqual(handle.read().splitlines(), ['run-2'])
+
+    def test_complete(self):
+        checkpoint = Checkpoint(self.path, 'run-1')
+        checkpoint.mark('user@example.com')
+        checkpoint.close(complete=True)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestReportPipeline(TestCase):
+    "Report rendering and delivery in a monkey patched process"
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_patched(self):
+        process = subprocess.Popen([sys.executable, '-c', SCRIPT,
+                                    self.path],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+        deadline = time.time() + 30
+        while process.poll() is None:
+            if time.time() > deadline:
+                os.kill(process.pid, signal.SIGKILL)
+                process.wait()
+                self.fail('The pipeline did not complete')
+            time.sleep(0.1)
+        lines = process.stdout.read().splitlines()
+        self.assertEqual(sorted(lines[:-1]), ['user0 True', 'user1 True',
+                                            'user2 True'])
+        self.assertEqual(lines[-1], 'True')
+        with open(self.path) as handle:
+            self.assertEqual(sorted(handle.read().splitlines()),
+                            ['run-1', 'user0', 'user1', 'user2'])
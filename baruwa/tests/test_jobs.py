@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+"Background job tests"
+import time
+
+from unittest import TestCase
+
+from baruwa.lib import jobs
+from baruwa.lib.jobs import submit_job, get_job, active_jobs, \
+    release_slot, JobLimitError, PENDING, SUCCESS, TIMEOUT, CANCELLED
+
+
+class FakeCache(object):
+    "memcached client with compare and set"
+    store = {}
+
+    def get(self, key):
+        return self.store.get(key, (None, None))[0]
+
+    def gets(self, key):
+        return self.store.get(key, (None, None))
+
+    def set(self, key, value, ttl=0):
+        casid = self.store.get(key, (None, 0))[1] or 0
+        self.store[key] = (value, casid + 1)
+        return True
+
+    def add(self, key, value, ttl=0):
+        if key in self.store:
+            return False
+        return self.set(key, value, ttl)
+
+    def cas(self, key, value, casid, ttl=0):
+        if self.store.get(key, (None, None))[1] != casid:
+            return False
+        return self.set(key, value, ttl)
+
+
+class FakeResult(object):
+    "celery task result"
+    finished = set()
+    revoked = set()
+
+    def __init__(self, taskid):
+        self.task_id = taskid
+
+    def ready(self):
+        return self.task_id in self.finished
+
+    def successful(self):
+        return True
+
+    def revoke(self):
+        self.revoked.add(self.task_id)
+
+
+class FakeTask(object):
+    "celery task"
+    count = 0
+
+    def apply_async(self, **kwargs):
+        FakeTask.count += 1
+        return FakeResult('task-%d' % self.count)
+
+
+class TestJobs(TestCase):
+    "Job records and the per user limit"
+    def setUp(self):
+        self.cache = jobs.cache
+        self.result = jobs.AsyncResult
+        FakeCache.store = {}
+        FakeResult.finished = set()
+        FakeResult.revoked = set()
+        jobs.cache = FakeCache
+        jobs.AsyncResult = FakeResult
+        jobs.config['baruwa.jobs.max_per_user'] = '2'
+
+    def tearDown(self):
+        jobs.cache = self.cache
+        jobs.AsyncResult = self.result
+        del jobs.config['baruwa.jobs.max_per_user']
+
+    def test_submit(self):
+        job = submit_job('preview', FakeTask(), u'user')
+        self.assertEqual(job.update(), PENDING)
+        self.assertEqual(get_job(job.id, u'user').taskid, job.taskid)
+        self.assertEqual(get_job(job.id, u'other'), None)
+        self.assertEqual(active_jobs(u'user'), [job.id])
+        FakeResult.finished.add(job.taskid)
+        self.assertEqual(job.update(), SUCCESS)
+        self.assertEqual(active_jobs(u'user'), [])
+
+    def test_limit(self):
+        first = submit_job('preview', FakeTask(), u'user')
+        submit_job('preview', FakeTask(), u'user')
+        self.assertRaises(JobLimitError, submit_job, 'preview',
+                        FakeTask(), u'user')
+        submit_job('preview', FakeTask(), u'other')
+        FakeResult.finished.add(first.taskid)
+        submit_job('preview', FakeTask(), u'user')
+        self.assertEqual(len(active_jobs(u'user')), 2)
+
+    def test_timeout_and_cancel(self):
+        job = submit_job('preview', FakeTask(), u'user', timeout=30)
+        job.created = time.time() - 60
+        self.assertEqual(job.update(), TIMEOUT)
+        self.assertTrue(job.taskid in FakeResult.revoked)
+        job = submit_job('preview', FakeTask(), u'user')
+        self.assertTrue(job.cancel())
+        self.assertEqual(get_job(job.id, u'user').state, CANCELLED)
+        self.assertFalse(job.cancel())
+        self.assertEqual(active_jobs(u'user'), [])
+
+    def test_release_slot(self):
+        job = submit_job('preview', FakeTask(), u'user')
+        release_slot(u'user', job.id)
+        release_slot(u'user', job.id)
+        self.assertEqual(active_jobs(u'user'), [])
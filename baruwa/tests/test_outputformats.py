@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+"Streamed output format tests"
+import csv
+import zlib
+
+from StringIO import StringIO
+from unittest import TestCase
+
+from baruwa.lib.outputformats import stream_csv, build_csv, FlowableStream
+
+
+class Row(tuple):
+    "Query result row"
+    def __new__(cls, **kwargs):
+        row = tuple.__new__(cls, kwargs.values())
+        row.names = kwargs.keys()
+        return row
+
+    def keys(self):
+        return self.names
+
+
+def parse(data):
+    "Parse a CSV file"
+    return list(csv.reader(StringIO(data)))
+
+
+class TestStreamCSV(TestCase):
+    "Chunked CSV output"
+    def setUp(self):
+        self.rows = [dict(name=u'caf\xe9 %d' % num, count=num)
+                    for num in range(100)]
+
+    def test_chunks(self):
+        chunks = list(stream_csv(self.rows, ['name', 'count'],
+                                chunksize=256))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(max(len(chunk) for chunk in chunks[:-1]) < 512)
+        lines = parse(''.join(chunks))
+        self.assertEqual(lines[0], ['Name', 'Count'])
+        self.assertEqual(lines[1], ['caf\xc3\xa9 0', '0'])
+        self.assertEqual(len(lines), 101)
+
+    def test_compress(self):
+        plain = ''.join(stream_csv(self.rows, ['name', 'count']))
+        chunks = list(stream_csv(self.rows, ['name', 'count'],
+                                compress=True, chunksize=256))
+        self.assertEqual(zlib.decompress(''.join(chunks), 31), plain)
+
+    def test_keys_from_rows(self):
+        rows = [Row(address=u'a@example.com', count=2)]
+        lines = parse(''.join(stream_csv(iter(rows))))
+        self.assertEqual(sorted(lines[0]), ['Address', 'Count'])
+        self.assertEqual(sorted(lines[1]), ['2', 'a@example.com'])
+        self.assertEqual(list(stream_csv([])), [])
+
+    def test_build_csv(self):
+        lines = parse(build_csv(self.rows[:1], ['count']))
+        self.assertEqual(lines, [["'count'"], ['0']])
+
+
+class TestFlowableStream(TestCase):
+    "Lazily consumed flowables"
+    def test_consume(self):
+        pulled = []
+
+        def flowables():
+            for num in range(5):
+                pulled.append(num)
+                yield num
+        stream = FlowableStream(flowables())
+        self.assertEqual(pulled, [])
+        self.assertEqual(len(stream), 2)
+        self.assertEqual(pulled, [0, 1])
+        consumed = []
+        while len(stream):
+            consumed.append(stream.pop(0))
+            self.assertTrue(len(pulled) - len(consumed) <= 2)
+        self.assertEqual(consumed, range(5))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+"MIME part index tests"
+import base64
+import quopri
+
+from StringIO import StringIO
+from unittest import TestCase
+
+from pyzmail import PyzMessage
+
+from baruwa.lib.mail.parts import index_message, get_payload, \
+    iter_payload, parse_range, iter_range
+
+IMAGE = ''.join(chr(char) for char in range(256)) * 20
+TEXT = 'caf\xe9 = cr\xe8me br\xfbl\xe9e, ' * 10 + '\nend of text\n'
+
+MULTIPART = """From: sender@example.com
+To: rcpt@example.com
+Subject: multipart
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+This is a multi-part message in MIME format.
+--outer
+Content-Type: text/plain; charset=iso-8859-1
+Content-Transfer-Encoding: quoted-printable
+
+%(qp)s
+--outer
+Content-Type: image/png; name="image.png"
+Content-Transfer-Encoding: base64
+Content-Disposition: attachment; filename="image.png"
+
+%(b64)s
+--outer--
+epilogue
+""" % dict(qp=quopri.encodestring(TEXT), b64=base64.encodestring(IMAGE))
+
+NESTED = """From: sender@example.com
+To: rcpt@example.com
+Subject: nested
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner
+Content-Type: text/plain; charset=us-ascii
+
+plain body
+--inner
+Content-Type: multipart/related; boundary="related"
+
+--related
+Content-Type: text/html; charset=us-ascii
+
+<p>html body <img src="cid:logo@example.com"></p>
+--related
+Content-Type: image/gif
+Content-Id: <logo@example.com>
+Content-Transfer-Encoding: base64
+
+%(b64)s
+--related--
+--inner--
+--outer
+Content-Type: message/rfc822
+
+From: inner@example.com
+Subject: forwarded
+
+forwarded body
+--outer
+Content-Type: application/octet-stream
+Content-Disposition: attachment; filename="data.bin"
+
+raw data
+--outer--
+""" % dict(b64=base64.encodestring(IMAGE[:300]))
+
+
+def summary(handle):
+    "Return the index_message view of the leaf parts"
+    _, leaves = index_message(handle)
+    return [(part.type, part.filename, part.sanitized_filename,
+            part.is_body, get_payload(handle, part)) for part in leaves]
+
+
+def pyzmail_summary(data):
+    "Return the pyzmail view of the leaf parts"
+    msg = PyzMessage.factory(data)
+    return [(part.type, part.filename, part.sanitized_filename,
+            part.is_body, part.get_payload()) for part in msg.mailparts]
+
+
+class TestParts(TestCase):
+    "Compare the part index against pyzmail"
+    def check(self, data):
+        """Compare a sample, message parts are served as the raw
+        embedded message while pyzmail serializes the wrapper part"""
+        expected = pyzmail_summary(data)
+        parts = summary(StringIO(data))
+        self.assertEqual(len(parts), len(expected))
+        for part, pyzpart in zip(parts, expected):
+            if part[0].startswith('message/'):
+                self.assertEqual(part[:4], pyzpart[:4])
+                self.assertTrue(pyzpart[4].endswith(
+                                part[4].replace('\r\n', '\n')))
+            else:
+                self.assertEqual(part, pyzpart)
+        return expected
+
+    def test_multipart(self):
+        parts = self.check(MULTIPART)
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(parts[0][4], TEXT)
+        self.assertEqual(parts[1][4], IMAGE)
+
+    def test_nested(self):
+        parts = self.check(NESTED)
+        self.assertEqual([part[0] for part in parts],
+                        ['text/plain', 'text/html', 'image/gif',
+                        'message/rfc822', 'application/octet-stream'])
+        _, leaves = index_message(StringIO(NESTED))
+        self.assertEqual(leaves[2].content_id, 'logo@example.com')
+
+    def test_crlf(self):
+        self.check(MULTIPART.replace('\n', '\r\n'))
+        self.check(NESTED.replace('\n', '\r\n'))
+
+    def test_chunked_decode(self):
+        handle = StringIO(MULTIPART)
+        _, leaves = index_message(handle)
+        for part in leaves:
+            self.assertEqual(''.join(iter_payload(handle, part, 7)),
+                            get_payload(handle, part))
+
+    def test_single_part(self):
+        data = ('Subject: single\nContent-Type: text/plain\n'
+                'Content-Transfer-Encoding: base64\n\n%s' %
+                base64.encodestring(TEXT))
+        parts = self.check(data)
+        self.assertEqual(parts[0][4], TEXT)
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=500-', 1000), (500, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-2000', 1000), (0, 999))
+        self.assertEqual(parse_range('bytes=900-5000', 1000), (900, 999))
+        self.assertEqual(parse_range(None, 1000), None)
+        self.assertEqual(parse_range('items=0-1', 1000), None)
+        self.assertEqual(parse_range('bytes=0-1,5-6', 1000), None)
+        self.assertEqual(parse_range('bytes=a-b', 1000), None)
+        self.assertRaises(ValueError, parse_range, 'bytes=1000-', 1000)
+        self.assertRaises(ValueError, parse_range, 'bytes=5-4', 1000)
+        self.assertRaises(ValueError, parse_range, 'bytes=-0', 1000)
+
+    def test_iter_range(self):
+        chunks = ['abc', 'def', 'ghi']
+        self.assertEqual(''.join(iter_range(chunks, 2, 6)), 'cdefg')
+        self.assertEqual(''.join(iter_range(chunks, 0, 8)), 'abcdefghi')
+        self.assertEqual(''.join(iter_range(chunks, 8, 8)), 'i')
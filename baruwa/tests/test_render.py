@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+"Report rendering service tests"
+import os
+import sys
+import time
+import signal
+import subprocess
+
+from unittest import TestCase
+
+# the web process is monkey patched, the service is run in a fresh
+# interpreter so the patching does not leak into the other tests
+SCRIPT = """
+import eventlet
+eventlet.monkey_patch()
+
+import os
+import time
+import operator
+
+from eventlet.patcher import original
+from baruwa.lib.render import RenderService, RenderError, \\
+    RenderBusyError
+
+
+# the children must not switch to the hub they inherit
+sleep = original('time').sleep
+
+
+def crash():
+    raise ValueError('bad chart')
+
+
+def ticker(ticks):
+    while True:
+        eventlet.sleep(0.05)
+        ticks.append(1)
+
+ticks = []
+eventlet.spawn(ticker, ticks)
+service = RenderService(2, 2, 1, 1)
+print service.run(operator.add, 1, 2)
+print service.run(os.getpid) != os.getpid()
+try:
+    service.run(crash)
+except RenderError, err:
+    print err
+# the hub keeps running while the child sleeps, the child is killed
+# once the render timeout expires
+started = time.time()
+try:
+    service.run(sleep, 30)
+except RenderError, err:
+    print err
+print time.time() - started < 5, len(ticks) > 5
+service = RenderService(1, 1, 0, 5)
+render = eventlet.spawn(service.run, sleep, 0.5)
+eventlet.sleep(0.1)
+try:
+    service.run(operator.add, 1, 2)
+except RenderBusyError:
+    print 'busy'
+print render.wait()
+"""
+
+
+def run_patched(script, timeout=30):
+    "Run script in a new interpreter, returns its output lines"
+    process = subprocess.Popen([sys.executable, '-c', script],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    deadline = time.time() + timeout
+    while process.poll() is None:
+        if time.time() > deadline:
+            os.kill(process.pid, signal.SIGKILL)
+            process.wait()
+            raise AssertionError('Script did not complete in %ds' %
+                                timeout)
+        time.sleep(0.1)
+    return process.stdout.read().splitlines()
+
+
+class TestRenderService(TestCase):
+    "Renders in a monkey patched process"
+    def test_patched(self):
+        self.assertEqual(run_patched(SCRIPT),
+                        ['3', 'True', 'ValueError: bad chart',
+                        'Render timed out', 'True True', 'busy', 'None'])
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+"Spam score report tests"
+import datetime
+
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from baruwa.lib import query as querymod
+from baruwa.lib.query import sa_histogram, sa_scores
+from baruwa.model.reports import SaScoreHistogram
+
+
+class User(object):
+    "Report user"
+    def __init__(self, account_type):
+        self.is_superadmin = account_type == 1
+        self.is_domain_admin = account_type == 2
+        self.is_peleb = account_type == 3
+        self.id = 1
+        self.email = u'user@a.com'
+        self.addresses = []
+
+
+def date_filter(filt, value):
+    "Return a report date filter"
+    return dict(field='date', filter=filt, value=value)
+
+
+class TestSaScores(TestCase):
+    "Score histogram and raw messages queries"
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        SaScoreHistogram.__table__.create(engine)
+        self.dbsession = sessionmaker(bind=engine)()
+        day1 = datetime.date(2014, 3, 1)
+        day2 = datetime.date(2014, 3, 2)
+        # (date, to domain, from domain, score, total)
+        rows = [(day1, u'a.com', u'', 1.0, 3),
+                (day1, u'', u'a.com', 5.0, 1),
+                (day1, u'b.com', u'', 1.0, 2),
+                (day2, u'a.com', u'b.com', 5.0, 4),
+                (day2, u'b.com', u'', 9.0, 6),
+                (day2, u'c.com', u'', 2.0, 0)]
+        for rowid, row in enumerate(rows):
+            date, to_domain, from_domain, score, total = row
+            self.dbsession.add(SaScoreHistogram(id=rowid + 1, date=date,
+                                                to_domain=to_domain,
+                                                from_domain=from_domain,
+                                                score=score, total=total))
+        self.dbsession.commit()
+        self.user_domains = querymod.user_domains
+        querymod.user_domains = lambda dbsession, user: [u'a.com']
+
+    def tearDown(self):
+        querymod.user_domains = self.user_domains
+        self.dbsession.close()
+
+    def scores(self, query):
+        "Return the (score, count) rows"
+        return [(row.score, row.count) for row in query]
+
+    def test_superadmin(self):
+        query = sa_histogram(self.dbsession, User(1), [])
+        self.assertEqual(self.scores(query), [(1.0, 5), (5.0, 5),
+                                            (9.0, 6)])
+
+    def test_domain_admin(self):
+        # messages to or from the admin's domains
+        query = sa_histogram(self.dbsession, User(2), [])
+        self.assertEqual(self.scores(query), [(1.0, 3), (5.0, 5)])
+
+    def test_date_filter(self):
+        filters = [date_filter('1', datetime.date(2014, 3, 2))]
+        query = sa_histogram(self.dbsession, User(1), filters)
+        self.assertEqual(self.scores(query), [(5.0, 4), (9.0, 6)])
+        filters = [date_filter('4', datetime.date(2014, 3, 2))]
+        query = sa_histogram(self.dbsession, User(2), filters)
+        self.assertEqual(self.scores(query), [(1.0, 3), (5.0, 1)])
+
+    def test_fallback(self):
+        self.assertEqual(sa_histogram(self.dbsession, User(3), []), None)
+        filters = [date_filter('1', datetime.date(2014, 3, 2)),
+                    dict(field='from_address', filter='1',
+                        value=u'x@b.com')]
+        self.assertEqual(sa_histogram(self.dbsession, User(1), filters),
+                        None)
+        for user, filts in ((User(3), []), (User(1), filters)):
+            query = sa_scores(self.dbsession, user, filts, histogram=True)
+            self.assertTrue('FROM messages' in str(query.statement))
+        query = sa_scores(self.dbsession, User(1), histogram=False)
+        self.assertTrue('FROM messages' in str(query.statement))
+        query = sa_scores(self.dbsession, User(1), histogram=True)
+        self.assertTrue('FROM sascorehist' in str(query.statement))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+"Compiled sender list tests"
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from baruwa.lib.senderlists import range_to_cidrs, classify, \
+    compile_lists, SenderListLookup
+
+
+class Item(object):
+    "List row"
+    def __init__(self, id, from_address, to_address=u'any'):
+        self.id = id
+        self.from_address = from_address
+        self.to_address = to_address
+
+
+class TestSenderLists(TestCase):
+    "Sender list compiler and lookups"
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmpdir, 'approvedsenders.cdb')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_range_to_cidrs(self):
+        self.assertEqual(range_to_cidrs(0, 255, 32), [(0, 24)])
+        self.assertEqual(range_to_cidrs(1, 2, 32), [(1, 32), (2, 32)])
+        self.assertEqual(range_to_cidrs(0, 2, 32), [(0, 31), (2, 32)])
+
+    def test_classify(self):
+        self.assertEqual(classify(u'User@Example.com'),
+                        ('e', u'user@example.com'))
+        self.assertEqual(classify(u'*@example.com'), ('d', u'example.com'))
+        self.assertEqual(classify(u'*.example.com'), ('s', u'.example.com'))
+        self.assertEqual(classify(u'10.0.0.0/8')[0], 'n')
+
+    def test_lookup(self):
+        items = [Item(1, u'user@example.com'),
+                Item(2, u'*.example.org'),
+                Item(3, u'192.168.1.0/24', u'rcpt@example.net'),
+                Item(4, u'example.info', u'example.net')]
+        self.assertEqual(compile_lists(items, self.dest), 4)
+        lookup = SenderListLookup(self.dest)
+        self.assertEqual(lookup.match(u'user@example.com'), 1)
+        self.assertEqual(lookup.match(u'a@mail.example.org'), 2)
+        self.assertEqual(lookup.match(u'a@b.com', u'rcpt@example.net',
+                                    u'192.168.1.20'), 3)
+        self.assertEqual(lookup.match(u'a@b.com', u'other@example.net',
+                                    u'192.168.1.20'), None)
+        self.assertEqual(lookup.match(u'x@example.info',
+                                    u'other@example.net'), 4)
+        self.assertEqual(lookup.match(u'nobody@example.net'), None)
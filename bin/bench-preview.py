@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"Benchmark message previews on synthetic large messages"
+
+import os
+import sys
+import time
+import shutil
+import base64
+import resource
+import tempfile
+
+from optparse import OptionParser
+
+from baruwa.lib.mail.parser import EmailParser, MAX_DECODED_SIZE
+from baruwa.lib.mail.parser import sanitize_payload
+from baruwa.lib.mail import css
+
+
+HEADERS = """From: Sender <sender@example.com>
+To: Recipient <recipient@example.net>
+Subject: Synthetic %(name)s
+Date: Mon, 19 Oct 2015 10:00:00 +0200
+Message-ID: <%(name)s@example.com>
+MIME-Version: 1.0
+"""
+
+
+def write_attachments(handle, name, size, count):
+    "Message with a short body and large base64 attachments"
+    boundary = 'bench-%s' % name
+    handle.write(HEADERS % dict(name=name))
+    handle.write('Content-Type: multipart/mixed; boundary="%s"\n\n'
+                % boundary)
+    handle.write('--%s\nContent-Type: text/plain; charset=utf-8\n\n'
+                'Please find the files attached.\n' % boundary)
+    block = os.urandom(57 * 1024)
+    for index in range(count):
+        handle.write('--%s\nContent-Type: application/octet-stream\n'
+                    'Content-Transfer-Encoding: base64\n'
+                    'Content-Disposition: attachment; '
+                    'filename="file%d.bin"\n\n' % (boundary, index))
+        written = 0
+        while written < size:
+            handle.write(base64.encodestring(block))
+            written += len(block)
+    handle.write('--%s--\n' % boundary)
+
+
+def write_html(handle, name, size, count):
+    "Message with a huge quoted-printable html body"
+    boundary = 'bench-%s' % name
+    handle.write(HEADERS % dict(name=name))
+    handle.write('Content-Type: multipart/alternative; boundary="%s"\n\n'
+                % boundary)
+    row = '<tr><td style=3D"color:red">row</td><td>%s</td></tr>\n' % (
+            'x' * 60)
+    for ctype in ('plain', 'html'):
+        handle.write('--%s\nContent-Type: text/%s; charset=utf-8\n'
+                    'Content-Transfer-Encoding: quoted-printable\n\n'
+                    % (boundary, ctype))
+        if ctype == 'html':
+            handle.write('<html><body><table>\n')
+        written = 0
+        while written < size * count:
+            handle.write(row)
+            written += len(row)
+        if ctype == 'html':
+            handle.write('</table></body></html>\n')
+    handle.write('--%s--\n' % boundary)
+
+
+def newsletter(size):
+    "Newsletter style HTML of roughly size bytes"
+    row = ('<tr><td style="padding:4px;color:#333;font-family:Arial">'
+            '<a href="http://example.com/%(i)d">Item %(i)d</a> '
+            '<img src="http://img.example.com/%(i)d.png" width="40"> '
+            'Lorem ipsum dolor sit amet</td></tr>\n')
+    rows = []
+    written = 0
+    index = 0
+    while written < size:
+        rows.append(row % dict(i=index))
+        written += len(rows[-1])
+        index += 1
+    return ('<html><head><style>td {color: red} .x {margin: 0}'
+            '@media screen {.y {padding: 1px}}</style></head>'
+            '<body style="margin: 0" class="newsletter"><table>%s</table>'
+            '<img src="cid:logo"></body></html>' % ''.join(rows))
+
+
+def bench_sanitizer(size, runs):
+    "Report the HTML sanitizer throughput"
+    html = newsletter(size)
+    htmlsize = len(html) / (1024.0 * 1024)
+    elapsed = []
+    for _ in range(runs):
+        start = time.time()
+        sanitize_payload(html)
+        elapsed.append(time.time() - start)
+    print '%-12s %10.1f %10.3f %12.2f' % ('newsletter', htmlsize,
+                                        min(elapsed),
+                                        htmlsize / min(elapsed))
+
+
+def bench_css(count, runs):
+    "Compare uncached and memoized CSS sanitization of repeated input"
+    styles = ['padding: %dpx; color: #333; font-family: Arial' % (index % 20)
+            for index in range(count)]
+    sheet = newsletter(0).split('<style>')[1].split('</style>')[0]
+    cases = (('inline', css._sanitize_style, css.sanitize_style, styles,
+                ()),
+            ('stylesheet', css._sanitize_css, css.sanitize_css,
+                [sheet] * (count // 10), ('#email-html-part',)))
+    for name, raw, memoized, inputs, args in cases:
+        css.CSS_CACHE.clear()
+        timings = []
+        for func in (raw, memoized):
+            elapsed = []
+            for _ in range(runs):
+                start = time.time()
+                for value in inputs:
+                    func(value, *args)
+                elapsed.append(time.time() - start)
+            timings.append(min(elapsed))
+        stats = css.cache_stats()
+        print '%-12s %8d %10.3f %10.3f %9.1f%%' % (name, len(inputs),
+                                                timings[0], timings[1],
+                                                stats['hitrate'])
+
+
+CORPUS = (('attachments', write_attachments),
+        ('html', write_html))
+
+
+def run(filename, maxsize):
+    """Parse a message in a child process returning the elapsed
+    time and the peak resident size of the child in KB"""
+    rpipe, wpipe = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rpipe)
+        start = time.time()
+        parser = EmailParser(filename, maxsize)
+        result = parser.parse()
+        parser.close()
+        elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(wpipe, '%f %d %d' % (elapsed, peak, result['truncated']))
+        os._exit(0)
+    os.close(wpipe)
+    data = os.read(rpipe, 1024)
+    os.close(rpipe)
+    os.waitpid(pid, 0)
+    elapsed, peak, truncated = data.split()
+    return float(elapsed), int(peak), bool(int(truncated))
+
+
+def main(argv):
+    "Main function"
+    parser = OptionParser()
+    parser.add_option('-s', '--size', dest="size", type="int",
+                    help="Size of each part in MB", default=20)
+    parser.add_option('-n', '--parts', dest="parts", type="int",
+                    help="Number of attachments", default=3)
+    parser.add_option('-m', '--max-decoded', dest="maxsize", type="int",
+                    help="Decoded content cap in bytes",
+                    default=MAX_DECODED_SIZE)
+    parser.add_option('-r', '--runs', dest="runs", type="int",
+                    help="Runs per message", default=3)
+    parser.add_option('-t', '--sanitizer', dest="sanitizer",
+                    help="Only measure the HTML sanitizer throughput",
+                    action="store_true", default=False)
+    parser.add_option('-x', '--css', dest="css",
+                    help="Only measure the CSS memo cache",
+                    action="store_true", default=False)
+    options, _ = parser.parse_args(argv)
+    if options.css:
+        print '%-12s %8s %10s %10s %10s' % ('css', 'count', 'raw s',
+                                            'memo s', 'hit rate')
+        print '-' * 54
+        bench_css(20000, options.runs)
+        return
+    if options.sanitizer:
+        print '%-12s %10s %10s %12s' % ('html', 'size MB', 'time s', 'MB/s')
+        print '-' * 48
+        bench_sanitizer(options.size * 1024 * 1024, options.runs)
+        return
+    tmpdir = tempfile.mkdtemp(prefix='baruwa-bench-')
+    try:
+        print '%-12s %10s %10s %12s %10s' % ('message', 'size MB',
+                                            'time s', 'peak RSS MB',
+                                            'truncated')
+        print '-' * 60
+        for name, writer in CORPUS:
+            filename = os.path.join(tmpdir, name)
+            with open(filename, 'wb') as handle:
+                writer(handle, name, options.size * 1024 * 1024,
+                        options.parts)
+            msgsize = os.path.getsize(filename) / (1024.0 * 1024)
+            results = [run(filename, options.maxsize)
+                        for _ in range(options.runs)]
+            elapsed = min(result[0] for result in results)
+            peak = max(result[1] for result in results) / 1024.0
+            print '%-12s %10.1f %10.3f %12.1f %10s' % (name, msgsize,
+                                                    elapsed, peak,
+                                                    results[0][2])
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+
+if __name__ == '__main__':
+    # run the thing
+    main(sys.argv)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+# Baruwa - Web 2.0 MailScanner front-end.
+# Copyright (C) 2010-2015  Andrew Colin Kissa <andrew@topdog.za.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"Benchmark concurrent report rendering on synthetic report data"
+
+import sys
+import time
+import random
+import datetime
+import threading
+import multiprocessing
+
+from optparse import OptionParser
+
+from baruwa.lib.render import RenderService, RenderBusyError, Row
+from baruwa.lib.graphs import build_pie_chart, build_barchart
+
+
+def top_ten():
+    "Rows of a top ten report"
+    return [Row(address='user%d@example.com' % index,
+                count=random.randint(1, 10000),
+                size=random.randint(1024, 1024 * 1024 * 100))
+            for index in range(10)]
+
+
+def totals(days):
+    "Rows of the message totals report"
+    today = datetime.date.today()
+    rows = []
+    for index in range(days):
+        mail = random.randint(1000, 100000)
+        rows.append(Row(ldate=today - datetime.timedelta(days=index),
+                        mail_total=mail,
+                        spam_total=random.randint(0, mail),
+                        virus_total=random.randint(0, mail / 100),
+                        total_size=mail * random.randint(2048, 65536)))
+    return rows
+
+
+def render(service, kind, errors):
+    "Render one report"
+    try:
+        if kind == 'png':
+            service.png(build_pie_chart, top_ten(), 'count')
+        elif kind == 'bar':
+            service.png(build_barchart, totals(30))
+        else:
+            headers = ('', 'Address', 'Count', 'Volume', '')
+            service.pdf('/nonexistent.png', 'Baruwa Report',
+                        [(top_ten(), 'Top Senders by Quantity', headers,
+                        'count', 'pie')])
+    except RenderBusyError:
+        errors.append(kind)
+
+
+def client(service, kinds, count, errors):
+    "Render count reports back to back"
+    for index in range(count):
+        render(service, kinds[index % len(kinds)], errors)
+
+
+def bench(processes, clients, count, kinds, queue_timeout):
+    """Render count reports per client from clients threads, returns
+    the elapsed time and the number of renders that were refused"""
+    service = RenderService(processes, queue_timeout=queue_timeout)
+    # start the workers outside the timing
+    render(service, kinds[0], [])
+    errors = []
+    threads = [threading.Thread(target=client,
+                                args=(service, kinds, count, errors))
+                for _ in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    service.close()
+    return elapsed, len(errors)
+
+
+def main(argv):
+    "Main function"
+    parser = OptionParser()
+    parser.add_option('-c', '--clients', dest="clients", type="int",
+                    help="Concurrent clients", default=16)
+    parser.add_option('-n', '--count', dest="count", type="int",
+                    help="Reports per client", default=10)
+    parser.add_option('-p', '--processes', dest="processes", type="int",
+                    help="Maximum render processes",
+                    default=multiprocessing.cpu_count())
+    parser.add_option('-k', '--kinds', dest="kinds",
+                    help="Comma separated report kinds: png,bar,pdf",
+                    default="png,bar,pdf")
+    parser.add_option('-q', '--queue-timeout', dest="queue_timeout",
+                    type="int", help="Render queue timeout", default=600)
+    options, _ = parser.parse_args(argv)
+    kinds = options.kinds.split(',')
+    total = options.clients * options.count
+    print '%-10s %10s %10s %12s %10s %10s' % ('processes', 'reports',
+                                            'time s', 'reports/s',
+                                            'speedup', 'refused')
+    print '-' * 68
+    # 0 processes renders in the web process under a single lock
+    # which is how reports were rendered before the pool
+    baseline = None
+    steps = [0] + sorted(set([1, 2, 4, 8, 16, options.processes]))
+    for processes in steps:
+        if processes > options.processes:
+            continue
+        elapsed, refused = bench(processes, options.clients, options.count,
+                                kinds, options.queue_timeout)
+        rate = (total - refused) / elapsed
+        if baseline is None:
+            baseline = rate
+        print '%-10s %10d %10.2f %12.1f %9.1fx %10d' % (
+                processes or 'lock', total, elapsed, rate,
+                rate / baseline, refused)
+
+
+if __name__ == '__main__':
+    # run the thing
+    main(sys.argv)
@@ -142,8 +142,13 @@ def update_index(surl, msgs):
         print_(" Indexing: %d" % mesg.id)
         params = {}
         for field in ['id', 'messageid', 'subject', 'headers',
-                    'hostname', 'timestamp', 'isquarantined']:
+                    'hostname', 'timestamp', 'isquarantined', 'size',
+                    'sascore', 'spam', 'highspam', 'virusinfected',
+                    'nameinfected', 'otherinfected', 'whitelisted',
+                    'blacklisted', 'scaned']:
             params[field] = getattr(mesg, field)
+        params['sender'] = getattr(mesg, 'from_address')
+        params['recipient'] = getattr(mesg, 'to_address')
         params['from_addr'] = crc32(getattr(mesg, 'from_address'))
         params['to_addr'] = crc32(getattr(mesg, 'to_address'))
         params['from_dom'] = crc32(getattr(mesg, 'from_domain'))
@@ -154,11 +159,18 @@ def update_index(surl, msgs):
         sql = """INSERT INTO messages_rt (id, messageid,
                     subject, headers, hostname, from_addr,
                     to_addr, from_dom, to_dom, timestamp,
-                    isquarantined) VALUES(
+                    isquarantined, sender, recipient, subj, size,
+                    sascore, spam, highspam, virusinfected, nameinfected,
+                    otherinfected, whitelisted, blacklisted,
+                    scaned) VALUES(
                     %(id)s, %(messageid)s, %(subject)s, %(headers)s,
                     %(hostname)s, %(from_addr)s, %(to_addr)s,
                     %(from_dom)s, %(to_dom)s, %(timestamp)s,
-                    %(isquarantined)s)"""
+                    %(isquarantined)s, %(sender)s, %(recipient)s,
+                    %(subject)s, %(size)s, %(sascore)s, %(spam)s,
+                    %(highspam)s, %(virusinfected)s, %(nameinfected)s,
+                    %(otherinfected)s, %(whitelisted)s, %(blacklisted)s,
+                    %(scaned)s)"""
         try:
             cursor.execute(sql, params)
             count += 1
@@ -72,7 +72,13 @@ sub index_record {
             $$message{hostname}, crc32($$message{from_address}),
             crc32($$message{to_address}),  crc32($$message{from_domain}),
             crc32($$message{to_domain}),   $$message{indexerts},
-            $$message{isquarantined}
+            $$message{isquarantined},      $$message{from_address},
+            $$message{to_address},         $$message{subject},
+            $$message{size},               $$message{sascore},
+            $$message{spam},               $$message{highspam},
+            $$message{virusinfected},      $$message{nameinfected},
+            $$message{otherinfected},      $$message{whitelisted},
+            $$message{blacklisted},        $$message{scaned}
         );
         MailScanner::Log::InfoLog("BaruwaSQL: $$message{messageid}: Indexed");
     };
@@ -390,8 +396,12 @@ sub connect2sphinxql {
             $spth = $sphinx->prepare(
                 "INSERT INTO messages_rt (
                 id, messageid, subject, headers, hostname, from_addr,
-                to_addr, from_dom, to_dom, timestamp, isquarantined)
-                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                to_addr, from_dom, to_dom, timestamp, isquarantined,
+                sender, recipient, subj, size, sascore, spam, highspam,
+                virusinfected, nameinfected, otherinfected, whitelisted,
+                blacklisted, scaned)
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                ?, ?, ?, ?, ?, ?)"
             );
             alarm(0);
         };